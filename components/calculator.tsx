@@ -1,6 +1,6 @@
 "use client"
 
-import { useState, useEffect, useCallback } from "react"
+import { useState, useEffect, useCallback, useRef } from "react"
 import { Button } from "@/components/ui/button"
 import { ScrollArea } from "@/components/ui/scroll-area"
 import { Card, CardContent } from "@/components/ui/card"
@@ -128,14 +128,42 @@ export function Calculator() {
     intermediate?: string;
   }
 
-  const calculateWithPython = async (expression: string): Promise<{ result: string; intermediate: string | null }> => {
+  // 逐次評価セッションに送った式 (null は未送信かエラーの後で、次は set で送り直す)
+  const sessionTextRef = useRef<string | null>(null);
+
+  // 前回送った式との差分 (追加・削除) だけを送る (1キーごとの処理が式全体の長さによらない)
+  const calculateDelta = (text: string): Promise<CalculationResult> => {
+    const previous = sessionTextRef.current;
+    sessionTextRef.current = text;
+    // @ts-ignore - window.electronAPI は preload.js 定義
+    const api = window.electronAPI;
+    if (previous !== null && text.startsWith(previous)) {
+      return api.calculateDelta('append', text.slice(previous.length));
+    }
+    if (previous !== null && previous.startsWith(text)) {
+      return api.calculateDelta('backspace', '', previous.length - text.length);
+    }
+    return api.calculateDelta('set', text);
+  };
+
+  const calculateWithPython = async (expression: string, record = false): Promise<{ result: string; intermediate: string | null }> => {
     try {
       const normalizedExpression = expression
         .replace(/×/g, '*')
         .replace(/÷/g, '/');
 
-      // @ts-ignore - window.electronAPI は preload.js 定義
-      const result: CalculationResult = await window.electronAPI.calculate(normalizedExpression);
+      let result: CalculationResult;
+      try {
+        // 確定 (=) のときだけ式全体を record 付きで送って履歴に残す
+        result = record
+          // @ts-ignore - window.electronAPI は preload.js 定義
+          ? await window.electronAPI.calculate(JSON.stringify({ expression: normalizedExpression, record: true }))
+          : await calculateDelta(normalizedExpression);
+      } catch (error) {
+        // セッションの状態が分からなくなったため、次は式全体を送り直す
+        sessionTextRef.current = null;
+        throw error;
+      }
       if (!result) {
         throw new Error('計算エラーが発生しました');
       }
@@ -304,7 +332,7 @@ export function Calculator() {
         expressionToCalculate = expressionToCalculate.slice(0, -1);
       }
 
-      const result = await calculateWithPython(expressionToCalculate);
+      const result = await calculateWithPython(expressionToCalculate, true);
       
       let displayResult = "";
       if (result.intermediate && result.intermediate !== "Error") {
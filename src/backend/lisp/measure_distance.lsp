@@ -1,4 +1,4 @@
-(defun c:measure_two_points ()
+(defun c:measure_two_points (/ pt1 pt2 dist result)
   (setvar "CMDECHO" 0)  ; コマンドエコーを無効化
   (setq old-error *error* *error* measure_error)  ; エラーハンドラを設定
   
@@ -8,9 +8,11 @@
       (setq pt2 (getpoint pt1 "\n2点目を選択してください: "))
       (if pt2
         (progn
-          (command "_measuregeom" pt1 pt2)
-          (setq distance (getvar "measuregeom"))
-          (setq result (strcat "(distance . " (rtos distance 2 3) ")"))
+          (setq dist (distance pt1 pt2))
+          ; 計測サービスに結果を渡す (USERR1 = 距離、USERI1 = 結果ごとに増える番号)
+          (setvar "USERR1" dist)
+          (setvar "USERI1" (if (< (getvar "USERI1") 32767) (1+ (getvar "USERI1")) 0))
+          (setq result (strcat "(distance . " (rtos dist 2 3) ")"))
           (princ result)
           (princ)
         )
@@ -38,4 +40,90 @@
   (setq *error* old-error)
   (setvar "CMDECHO" 1)
   (princ)
-) 
\ No newline at end of file
+) 
+;; 以下は複数の点・ポリライン・選択セットの計測
+;; 座標は計測サービスが USERS1 に指定したファイルに書き出し、計算は Python 側でまとめて行う
+(vl-load-com)
+
+;; 点列を書き出す (chains は (閉じているか 点1 点2 ...) のリスト)
+;; 書式: 点列ごとに "M 1" (閉じている) または "M 0" の行、続けて1行に1点 "x y z"
+(defun measure_write_chains (chains / file)
+  (setq file (open (getvar "USERS1") "w"))
+  (foreach chain chains
+    (write-line (if (car chain) "M 1" "M 0") file)
+    (foreach pt (cdr chain)
+      (write-line
+        (strcat (rtos (car pt) 2 8) " " (rtos (cadr pt) 2 8) " "
+                (rtos (if (caddr pt) (caddr pt) 0.0) 2 8))
+        file
+      )
+    )
+  )
+  (close file)
+  (setvar "USERI1" (if (< (getvar "USERI1") 32767) (1+ (getvar "USERI1")) 0))
+)
+
+;; 図形の頂点を点列にする (LWPOLYLINE と LINE。円弧の膨らみは考慮しない)
+(defun measure_entity_chain (ent / ed kind)
+  (setq ed (entget ent)
+        kind (cdr (assoc 0 ed)))
+  (cond
+    ((= kind "LWPOLYLINE")
+     (cons (= 1 (logand 1 (cdr (assoc 70 ed))))
+           (mapcar 'cdr (vl-remove-if-not '(lambda (item) (= (car item) 10)) ed))))
+    ((= kind "LINE")
+     (list nil (cdr (assoc 10 ed)) (cdr (assoc 11 ed))))
+  )
+)
+
+;; 点を続けて選択し、Enterで終了する
+(defun c:measure_points (/ pts pt)
+  (setvar "CMDECHO" 0)
+  (if (setq pt (getpoint "\n1点目を選択してください: "))
+    (progn
+      (setq pts (list pt))
+      (while (setq pt (getpoint pt "\n次の点を選択してください (Enterで終了): "))
+        (setq pts (cons pt pts))
+      )
+      (if (cdr pts)
+        (measure_write_chains (list (cons nil (reverse pts))))
+        (princ "\nキャンセルされました")
+      )
+    )
+    (princ "\nキャンセルされました")
+  )
+  (setvar "CMDECHO" 1)
+  (princ)
+)
+
+;; ポリラインまたは線分を1つ選択する
+(defun c:measure_polyline (/ selected chain)
+  (setvar "CMDECHO" 0)
+  (if (and (setq selected (entsel "\nポリラインを選択してください: "))
+           (setq chain (measure_entity_chain (car selected))))
+    (measure_write_chains (list chain))
+    (princ "\nキャンセルされました")
+  )
+  (setvar "CMDECHO" 1)
+  (princ)
+)
+
+;; 複数のポリライン・線分をまとめて選択する
+(defun c:measure_selection (/ ss index chains chain)
+  (setvar "CMDECHO" 0)
+  (if (setq ss (ssget '((0 . "LINE,LWPOLYLINE"))))
+    (progn
+      (setq index 0)
+      (while (< index (sslength ss))
+        (if (setq chain (measure_entity_chain (ssname ss index)))
+          (setq chains (cons chain chains))
+        )
+        (setq index (1+ index))
+      )
+      (measure_write_chains (reverse chains))
+    )
+    (princ "\nキャンセルされました")
+  )
+  (setvar "CMDECHO" 1)
+  (princ)
+)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import calculator
+
+# 計算モードの比較に使う式 (整数のみ、小数、π、三角関数、割り切れない除算)
+MODE_CORPUS = [
+    "1200+350×4-75",
+    "123456789×987654321",
+    "0.1+0.2+0.3",
+    "12.5×3.2÷4",
+    "2π×1.5",
+    "π÷4×0.6^2",
+    "sin30+cos60",
+    "sin45×2",
+    "1÷3+1÷7",
+    "(1+π)^2",
+]
+
+# 処理段階ごとの計測に使う式 (種類ごと)
+STAGE_CORPUS = {
+    "short": ["1+2", "12×3", "100÷4", "7-2", "0.5+0.25", "9×9"],
+    "long": [
+        "+".join(str(n) for n in range(1, 101)),
+        "×".join(["1.5", "2", "0.5"] * 20),
+        "-".join(f"{n}.25" for n in range(60)),
+    ],
+    "nested": [
+        "((((1+2)×3)-4)÷5)",
+        "(" * 30 + "1" + "+1)" * 30,
+        "((2+3)×(4-1))÷((6-2)×(1+1))",
+    ],
+    "trig": ["sin30+cos60", "sin45×cos45+tan30", "sin(30)×2+cos(60)÷2", "tan45-sin90"],
+    "pi": ["2π×1.5", "π÷4×0.6^2", "ππ+π2", "(1+π)^2×π"],
+    "trailing_operator": ["1+2+", "12×3×", "100÷4-", "sin30+cos60÷", "(1+2)×"],
+    # 評価前の見積もりで打ち切る・浮動小数点に切り替える式 (1件あたりの最悪の遅延)
+    "pathological": ["9^9^9", "2^(2^20)", "(1+π)^200", "(" * 90 + "1" + ")" * 90, "+".join(["7"] * 600),
+                     "×".join(["(2^65000)"] * 1000)],
+}
+
+# format_number() の計測に使う数値
+FORMAT_CORPUS = [3, 0.5, 2 * math.pi, 1 / 3, 123456789.125, 1e-7, -42.0, math.pi / 6]
+
+# 端から端までの計測に使うリクエスト (式と各種コマンド)
+E2E_CORPUS = [expression for expressions in STAGE_CORPUS.values() for expression in expressions[:2]]
+
+def time_calls(func, items, repeat):
+    """items をすべて処理する時間を repeat 回測り、最短時間を返す"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_modes(repeat=5, rounds=200):
+    """float / exact モードの処理速度を比較"""
+    items = MODE_CORPUS * rounds
+    results = {}
+    for mode in ('float', 'exact'):
+        elapsed = time_calls(lambda expression: calculator.calculate(expression, mode), items, repeat)
+        results[mode] = {
+            "ops_per_sec": round(len(items) / elapsed),
+            "us_per_op": round(elapsed / len(items) * 1e6, 3)
+        }
+    return results
+
+def _ignore_errors(func):
+    # 不完全な式で例外になる段階も、例外までの処理時間を計測する
+    def call(item):
+        try:
+            func(item)
+        except Exception:
+            pass
+    return call
+
+def _parse_uncached(normalized):
+    return calculator._Parser(calculator.tokenize(normalized)).parse()
+
+def bench_stages(repeat=5, rounds=50):
+    """式の種類ごとに、処理段階ごとの1件あたりの時間 (マイクロ秒) を計測"""
+    stages = {
+        "normalize_operators": (calculator.normalize_operators, False),
+        "tokenize": (calculator.tokenize, True),
+        "parse": (_parse_uncached, True),
+        "compile_cached": (calculator.compile_expression, False),
+        "validate_expression": (calculator.validate_expression, False),
+        "calculate": (calculator.calculate, False),
+    }
+    results = {}
+    for category, expressions in STAGE_CORPUS.items():
+        items = expressions * rounds
+        normalized = [calculator.normalize_operators(expression) for expression in items]
+        results[category] = {}
+        for stage, (func, takes_normalized) in stages.items():
+            elapsed = time_calls(_ignore_errors(func), normalized if takes_normalized else items, repeat)
+            results[category][stage] = round(elapsed / len(items) * 1e6, 3)
+    items = FORMAT_CORPUS * rounds * 10
+    elapsed = time_calls(calculator.format_number, items, repeat)
+    results["format_number"] = round(elapsed / len(items) * 1e6, 3)
+    return results
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _start_backend(script):
+    # 計測で履歴を増やさないように履歴を無効にして起動
+    env = {**os.environ, "CALCULATOR_HISTORY": "0"}
+    return subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+        bufsize=0
+    )
+
+def bench_end_to_end(script="calculator.py", requests=2000):
+    """実際のプロセスをパイプ経由で動かし、遅延 (p50/p99) と1秒あたりの処理件数を計測"""
+    process = _start_backend(script)
+    messages = [
+        (json.dumps({"id": index, "expression": E2E_CORPUS[index % len(E2E_CORPUS)]}, ensure_ascii=False) + '\n').encode('utf-8')
+        for index in range(requests)
+    ]
+    try:
+        # 起動待ち (最初の応答が返るまで)
+        start = time.perf_counter()
+        process.stdin.write(b'{"id": -1, "command": "hello"}\n')
+        process.stdout.readline()
+        startup = time.perf_counter() - start
+
+        # 1件ずつ応答を待つ場合の遅延
+        latencies = []
+        start = time.perf_counter()
+        for message in messages:
+            sent = time.perf_counter()
+            process.stdin.write(message)
+            process.stdout.readline()
+            latencies.append(time.perf_counter() - sent)
+        sequential = time.perf_counter() - start
+        latencies.sort()
+
+        # 応答を待たずに連続で送る場合の処理件数
+        writer = threading.Thread(target=lambda: [process.stdin.write(message) for message in messages])
+        start = time.perf_counter()
+        writer.start()
+        for _ in messages:
+            process.stdout.readline()
+        pipelined = time.perf_counter() - start
+        writer.join()
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    return {
+        "requests": requests,
+        "startup_ms": round(startup * 1e3, 2),
+        "p50_us": round(_percentile(latencies, 50) * 1e6, 1),
+        "p99_us": round(_percentile(latencies, 99) * 1e6, 1),
+        "sequential_rps": round(requests / sequential),
+        "pipelined_rps": round(requests / pipelined),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="計算エンジンのベンチマーク")
+    parser.add_argument('--repeat', type=int, default=5, help="計測の繰り返し回数 (最短時間を採用)")
+    parser.add_argument('-o', '--output', help="結果を保存するJSONファイル")
+    parser.add_argument('--requests', type=int, default=2000, help="端から端までの計測で送るリクエスト数")
+    parser.add_argument('--skip-e2e', action='store_true', help="プロセスを起動する計測を省略")
+    args = parser.parse_args()
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "modes": bench_modes(args.repeat),
+        "stages": bench_stages(args.repeat),
+    }
+    if not args.skip_e2e:
+        report["end_to_end"] = {
+            "calculator": bench_end_to_end("calculator.py", args.requests),
+            "worker_pool": bench_end_to_end("worker_pool.py", args.requests),
+        }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == "__main__":
+    main()
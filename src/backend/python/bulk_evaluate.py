@@ -0,0 +1,150 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+from calculator import calculate_batch
+
+# 読み書きのバッファサイズ
+IO_BUFFER_SIZE = 1 << 20
+
+# 1チャンクあたりの行数
+DEFAULT_CHUNK_SIZE = 2000
+
+# CSVに追加する結果の列
+RESULT_COLUMNS = ['result', 'intermediate', 'error']
+
+def detect_format(path, explicit_format):
+    """入出力形式を決定 (指定がなければ拡張子から判定)"""
+    if explicit_format:
+        return explicit_format
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+def open_input(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    return open(path, 'r', encoding='utf-8-sig', newline='', buffering=IO_BUFFER_SIZE)
+
+def open_output(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='', write_through=False)
+    return open(path, 'w', encoding='utf-8', newline='', buffering=IO_BUFFER_SIZE)
+
+def row_to_item(row):
+    """CSVの1行を calculate_batch() の項目に変換"""
+    expression = row.get('expression')
+    if expression:
+        return expression
+    if row.get('from_unit') and row.get('to_unit'):
+        return {
+            "command": "convert_unit",
+            "value": row.get('value'),
+            "from_unit": row['from_unit'],
+            "to_unit": row['to_unit']
+        }
+    return {"command": None}
+
+def read_jsonl_rows(stream):
+    """JSONLを1行ずつ読み込む (文字列は式、オブジェクトはコマンドとして扱う)"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            # JSONでない行は式そのものとして扱う
+            item = line
+        if not isinstance(item, (str, dict)):
+            item = str(item)
+        yield item, item
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _chunk_items(chunk):
+    # ワーカーへは評価項目だけを送る
+    return [item for _, item in chunk]
+
+def evaluate_chunks(chunks, workers):
+    """チャンクごとの評価結果を入力順に返す (workers > 1 ならプロセスプールで並列化)"""
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, calculate_batch(_chunk_items(chunk))
+        return
+
+    with Pool(workers) as pool:
+        # 先読みするチャンク数を制限してメモリ使用量を一定に保つ
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append((chunk, pool.apply_async(calculate_batch, (_chunk_items(chunk),))))
+            if len(in_flight) >= workers * 2:
+                done_chunk, pending = in_flight.popleft()
+                yield done_chunk, pending.get()
+        while in_flight:
+            done_chunk, pending = in_flight.popleft()
+            yield done_chunk, pending.get()
+
+def format_jsonl_chunk(chunk, results):
+    lines = []
+    for (item, _), result in zip(chunk, results):
+        # 入力にidがあれば結果にも付ける
+        if isinstance(item, dict) and 'id' in item:
+            result = {**result, "id": item["id"]}
+        lines.append(json.dumps(result, ensure_ascii=False))
+    lines.append('')
+    return '\n'.join(lines)
+
+def format_csv_chunk(chunk, results, fieldnames):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    for (row, _), result in zip(chunk, results):
+        writer.writerow({**row, **{column: result.get(column, '') for column in RESULT_COLUMNS}})
+    return buffer.getvalue()
+
+def run(input_path, output_path, input_format=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """入力ファイルを読みながら評価し、結果を逐次書き出す"""
+    input_format = detect_format(input_path, input_format)
+    count = 0
+    with open_input(input_path) as source, open_output(output_path) as sink:
+        if input_format == 'csv':
+            reader = csv.DictReader(source)
+            fieldnames = list(reader.fieldnames or []) + [c for c in RESULT_COLUMNS if c not in (reader.fieldnames or [])]
+            csv.DictWriter(sink, fieldnames=fieldnames).writeheader()
+            rows = ((row, row_to_item(row)) for row in reader)
+        else:
+            rows = read_jsonl_rows(source)
+
+        for chunk, results in evaluate_chunks(chunked(rows, chunk_size), workers):
+            if input_format == 'csv':
+                sink.write(format_csv_chunk(chunk, results, fieldnames))
+            else:
+                sink.write(format_jsonl_chunk(chunk, results))
+            count += len(chunk)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV/JSONLの式と単位変換を一括で評価します")
+    parser.add_argument('input', help="入力ファイル (- で標準入力)")
+    parser.add_argument('-o', '--output', default='-', help="出力ファイル (省略時は標準出力)")
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'], help="入力形式 (省略時は拡張子から判定)")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="並列処理するプロセス数")
+    parser.add_argument('-c', '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="1チャンクあたりの行数")
+    args = parser.parse_args()
+
+    count = run(args.input, args.output, args.format, args.workers, max(1, args.chunk_size))
+    print(json.dumps({"status": "success", "rows": count}, ensure_ascii=False), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
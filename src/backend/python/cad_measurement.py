@@ -0,0 +1,476 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pythoncom
+    import pywintypes
+    import win32com.client
+    import win32event
+except ImportError:
+    win32com = None
+
+# 計測用の LISP ファイル
+LISP_PATH = Path(__file__).parent.parent / "lisp" / "measure_distance.lsp"
+
+# 点の選択を待つ時間の上限 (秒)
+MEASURE_TIMEOUT = 120.0
+
+# LISP の読み込みを待つ時間の上限 (秒)
+LOAD_TIMEOUT = 10.0
+
+# LISP が結果を書き込むシステム変数 (USERI1 は結果ごとに増える番号、USERR1 は距離)
+SEQUENCE_VARIABLE = "USERI1"
+DISTANCE_VARIABLE = "USERR1"
+
+# 点列を書き出すファイルを LISP に伝えるシステム変数
+CHAIN_FILE_VARIABLE = "USERS1"
+
+# 計測の種類ごとの LISP 関数 (distance 以外は点列を返す)
+LISP_COMMANDS = {
+    'distance': '(c:measure_two_points)\n',
+    'points': '(c:measure_points)\n',
+    'polyline': '(c:measure_polyline)\n',
+    'selection': '(c:measure_selection)\n',
+}
+
+# 偽の CAD が1回の計測で返す点の数
+FAKE_CHAIN_POINTS = 200
+
+TIMEOUT_ERROR = "計測がタイムアウトしました"
+
+class CadError(Exception):
+    """CAD との通信や計測に失敗した"""
+
+class CadBackend:
+    """計測を行う CAD のインターフェース
+
+    connect() は接続済みなら何もしない。measure() は計測が終わるまで待ち、
+    結果の dict を返す (キャンセルされた場合は None)。
+    measure_chains() は点列 [(閉じているか, [(x, y, z), ...]), ...] を返す。
+    """
+
+    name = 'base'
+
+    def connect(self):
+        pass
+
+    def measure(self, timeout=MEASURE_TIMEOUT):
+        raise NotImplementedError
+
+    def measure_chains(self, mode, timeout=MEASURE_TIMEOUT):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class _DocumentEvents:
+    """AutoCAD のドキュメントのイベントを受け取る (win32com.client.WithEvents で使う)"""
+
+    def __init__(self):
+        self.finished = None
+
+    def OnEndLisp(self):
+        self.finished = 'end'
+
+    def OnLispCancelled(self):
+        self.finished = 'cancelled'
+
+class AutoCADBackend(CadBackend):
+    """COM で AutoCAD に接続したまま、LISP の終了イベントで計測の完了を知る
+
+    LISP はドキュメントごとに1回だけ読み込み、結果はシステム変数から読み取る。
+    番号 (USERI1) が増えていなければキャンセルとみなすため、前回の値を返すことはない。
+    """
+
+    name = 'autocad'
+
+    def __init__(self, lisp_path=LISP_PATH):
+        if win32com is None:
+            raise CadError("pywin32 がインストールされていません")
+        if not lisp_path.exists():
+            raise CadError(f"LISPファイルが見つかりません。パス: {lisp_path}")
+        # WindowsパスをAutoCAD用に変換（バックスラッシュをスラッシュに変換）
+        self.lisp_path = str(lisp_path.absolute()).replace("\\", "/")
+        self.app = None
+        self.doc = None
+        self._events = None
+        self._document_name = None
+
+    def connect(self):
+        if self.doc is not None:
+            try:
+                if self.app.ActiveDocument.Name == self._document_name:
+                    return
+            except pywintypes.com_error:
+                # AutoCAD が終了した、または図面が閉じられた
+                self.app = None
+        if self.app is None:
+            try:
+                self.app = win32com.client.GetActiveObject("AutoCAD.Application")
+            except pywintypes.com_error:
+                raise CadError("AutoCADが起動していません。")
+        try:
+            self.doc = self.app.ActiveDocument
+        except pywintypes.com_error:
+            self.doc = None
+        if self.doc is None:
+            raise CadError("AutoCADで図面が開かれていません。")
+        self._document_name = self.doc.Name
+        self._events = win32com.client.WithEvents(self.doc, _DocumentEvents)
+        # LISP の名前空間は図面ごとなので、図面が変わったら読み込み直す
+        self._run(f'(load "{self.lisp_path}")\n', LOAD_TIMEOUT)
+
+    def _run(self, expression, timeout):
+        """LISP の式を送り、終了 (またはキャンセル) のイベントまで待つ"""
+        self._events.finished = None
+        self.doc.SendCommand(expression)
+        deadline = time.monotonic() + timeout
+        while self._events.finished is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CadError(TIMEOUT_ERROR)
+            # ウィンドウメッセージ (COM のイベント) が届くまで待ち、届いたら処理する
+            win32event.MsgWaitForMultipleObjects([], False, int(remaining * 1000), win32event.QS_ALLINPUT)
+            pythoncom.PumpWaitingMessages()
+        return self._events.finished
+
+    def measure(self, timeout=MEASURE_TIMEOUT):
+        self.connect()
+        sequence = self.doc.GetVariable(SEQUENCE_VARIABLE)
+        self._run(LISP_COMMANDS['distance'], timeout)
+        if self.doc.GetVariable(SEQUENCE_VARIABLE) == sequence:
+            return None
+        return {"distance": float(self.doc.GetVariable(DISTANCE_VARIABLE))}
+
+    def measure_chains(self, mode, timeout=MEASURE_TIMEOUT):
+        self.connect()
+        fd, path = tempfile.mkstemp(prefix='cad-points-', suffix='.txt')
+        os.close(fd)
+        try:
+            # 座標はすべて LISP 側で集めてファイルに書き出す (点ごとの往復をしない)
+            self.doc.SetVariable(CHAIN_FILE_VARIABLE, path.replace("\\", "/"))
+            sequence = self.doc.GetVariable(SEQUENCE_VARIABLE)
+            self._run(LISP_COMMANDS[mode], timeout)
+            if self.doc.GetVariable(SEQUENCE_VARIABLE) == sequence:
+                return None
+            with open(path, encoding='utf-8', errors='replace') as f:
+                return parse_chains(f)
+        finally:
+            os.remove(path)
+
+    def close(self):
+        self._events = None
+        self.doc = None
+        self.app = None
+
+class FakeCadBackend(CadBackend):
+    """テスト・ベンチマーク用の CAD (AutoCAD なしで動く)
+
+    points に2点の組のリストを渡すと順に使い (None はキャンセル)、省略すると乱数で作る。
+    delay は点の選択にかかる時間 (秒) で、別スレッドから完了を通知する。
+    """
+
+    name = 'fake'
+
+    def __init__(self, points=None, delay=0.0, seed=0):
+        self._points = iter(points) if points is not None else self._random_points(random.Random(seed))
+        self.delay = delay
+        self.connections = 0
+        self._connected = False
+
+    @staticmethod
+    def _random_points(generator):
+        while True:
+            yield tuple(tuple(round(generator.uniform(-1000, 1000), 3) for _ in range(3)) for _ in range(2))
+
+    def connect(self):
+        if not self._connected:
+            self._connected = True
+            self.connections += 1
+
+    def measure(self, timeout=MEASURE_TIMEOUT):
+        self.connect()
+        done = threading.Event()
+        result = {}
+
+        def pick():
+            pair = next(self._points, None)
+            if pair is not None:
+                start, end = pair
+                result["distance"] = round(sum((b - a) ** 2 for a, b in zip(start, end)) ** 0.5, 3)
+            done.set()
+
+        if self.delay > 0:
+            threading.Timer(self.delay, pick).start()
+        else:
+            pick()
+        if not done.wait(timeout):
+            raise CadError(TIMEOUT_ERROR)
+        return result or None
+
+    def measure_chains(self, mode, timeout=MEASURE_TIMEOUT):
+        self.connect()
+        generator = random.Random(len(mode) + self.connections)
+        count = {'points': 1, 'polyline': 1, 'selection': 3}[mode]
+        chains = []
+        for _ in range(count):
+            x, y = generator.uniform(-1000, 1000), generator.uniform(-1000, 1000)
+            points = []
+            for _ in range(FAKE_CHAIN_POINTS):
+                x += generator.uniform(-50, 50)
+                y += generator.uniform(-50, 50)
+                points.append((x, y, 0.0))
+            chains.append((mode != 'points', points))
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return chains
+
+    def close(self):
+        self._connected = False
+
+def parse_chains(lines):
+    """LISP が書き出した点列を読み込む ("M 0/1" の行で点列が始まり、以降は1行1点)"""
+    chains = []
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'M':
+            chains.append((fields[1:] == ['1'], []))
+        elif chains:
+            point = tuple(float(value) for value in fields[:3])
+            chains[-1][1].append(point + (0.0,) * (3 - len(point)))
+    return [chain for chain in chains if chain[1]]
+
+def _chain_geometry(closed, points):
+    # 区間の長さと (閉じた点列なら) XY平面上の面積
+    if np is not None:
+        coords = np.asarray(points, dtype=float)
+        if closed:
+            coords = np.vstack((coords, coords[:1]))
+        lengths = np.sqrt(np.square(np.diff(coords, axis=0)).sum(axis=1))
+        area = None
+        if closed and len(points) >= 3:
+            x, y = coords[:-1, 0], coords[:-1, 1]
+            # 靴紐公式
+            area = 0.5 * abs(float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))))
+        return lengths.tolist(), area
+    ring = list(points) + list(points[:1]) if closed else list(points)
+    lengths = [math.dist(start, end) for start, end in zip(ring, ring[1:])]
+    area = None
+    if closed and len(points) >= 3:
+        area = 0.5 * abs(sum(x1 * y2 - x2 * y1 for (x1, y1, _), (x2, y2, _) in zip(ring, ring[1:])))
+    return lengths, area
+
+def _format_length(length):
+    # 計算機の字句解析は指数表記 (1e-07) を読めないため、固定小数点で末尾の0を除く
+    return f"{length:.10f}".rstrip('0').rstrip('.')
+
+def summarize_chains(chains):
+    """点列から区間の長さ、累計、合計、面積をまとめて計算し、計算機に渡す式も作る"""
+    segments = []
+    areas = []
+    for closed, points in chains:
+        lengths, area = _chain_geometry(closed, points)
+        segments.extend(lengths)
+        if area is not None:
+            areas.append(area)
+    if np is not None:
+        cumulative = np.cumsum(segments).tolist()
+    else:
+        cumulative = list(itertools.accumulate(segments))
+    total = cumulative[-1] if cumulative else 0.0
+    return {
+        "chains": len(chains),
+        "points": sum(len(points) for _, points in chains),
+        "segments": segments,
+        "cumulative": cumulative,
+        "total": total,
+        "areas": areas,
+        "area": sum(areas) if areas else None,
+        # 計算機にそのまま渡せる式 (区間の長さの和)
+        "expression": '+'.join(_format_length(length) for length in segments)
+    }
+
+def create_backend(name='autocad', **options):
+    if name == 'autocad':
+        return AutoCADBackend()
+    if name == 'fake':
+        return FakeCadBackend(**options)
+    raise ValueError(f"未対応のCADです: {name}")
+
+class MeasurementService:
+    """CAD への接続と読み込み済みの LISP を保持し、標準入力のコマンドで計測する
+
+    COM のオブジェクトは作成したスレッドでしか使えないため、コマンドはメインスレッドで順に処理する。
+    結果は計測が終わるごとに JSON 行で出力する。
+    """
+
+    def __init__(self, backend, output=None):
+        self.backend = backend
+        self.output = output or sys.stdout
+        self.commands = queue.Queue()
+        self.output_lock = threading.Lock()
+        self.measurements = 0
+
+    def write_response(self, request, result):
+        if 'id' in request:
+            result = {**result, "id": request["id"]}
+        with self.output_lock:
+            self.output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            self.output.flush()
+
+    def _read_commands(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                request = None
+            if not isinstance(request, dict):
+                self.write_response({}, {"status": "error", "message": "不正なリクエストです"})
+                continue
+            self.commands.put(request)
+        # 標準入力が閉じられたら終了
+        self.commands.put({"command": "shutdown"})
+
+    def handle(self, request):
+        """コマンドを処理する (終了する場合は False)"""
+        command = request.get('command')
+        try:
+            if command == 'measure':
+                self.measure(request)
+            elif command == 'connect':
+                self.backend.connect()
+                self.write_response(request, {"status": "success"})
+            elif command == 'hello':
+                self.write_response(request, {
+                    "status": "success", "backend": self.backend.name, "measurements": self.measurements
+                })
+            elif command == 'shutdown':
+                return False
+            else:
+                self.write_response(request, {"status": "error", "message": "未対応のコマンドです"})
+        except Exception as e:
+            self.write_response(request, {"status": "error", "message": str(e)})
+        return True
+
+    def measure(self, request):
+        """count 回計測して応答を1件返す (キャンセルされたらそこで終える)
+
+        mode は distance (2点間)、points (点を続けて選択)、polyline、selection (複数の図形)。
+        count が2以上のときは、1回ごとの結果を results にまとめる
+        (呼び出し元は id ごとに最初の応答しか受け取らないため、同じ id の応答を複数書かない)。
+        """
+        count = max(1, int(request.get('count', 1)))
+        timeout = float(request.get('timeout', MEASURE_TIMEOUT))
+        mode = request.get('mode', 'distance')
+        if mode not in LISP_COMMANDS:
+            raise ValueError("未対応の計測方法です")
+        results = []
+        for index in range(count):
+            start = time.perf_counter()
+            if mode == 'distance':
+                result = self.backend.measure(timeout)
+            else:
+                chains = self.backend.measure_chains(mode, timeout)
+                result = {"mode": mode, **summarize_chains(chains)} if chains else None
+            elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+            if result is None:
+                results.append({"status": "cancelled", "index": index, "elapsed_ms": elapsed_ms})
+                break
+            self.measurements += 1
+            results.append({"status": "success", **result, "index": index, "elapsed_ms": elapsed_ms})
+        if count == 1:
+            self.write_response(request, results[0])
+            return
+        completed = [result for result in results if result["status"] == "success"]
+        self.write_response(request, {
+            "status": "success" if completed else "cancelled",
+            "results": completed,
+            "cancelled": len(completed) < count
+        })
+
+    def run(self):
+        threading.Thread(target=self._read_commands, name='cad-stdin', daemon=True).start()
+        try:
+            # 起動時に接続と LISP の読み込みを済ませておく (失敗しても計測時に再試行する)
+            self.backend.connect()
+            self.write_response({}, {"status": "ready", "backend": self.backend.name})
+        except CadError as e:
+            self.write_response({}, {"status": "ready", "backend": self.backend.name, "message": str(e)})
+        try:
+            while self.handle(self.commands.get()):
+                pass
+        finally:
+            self.backend.close()
+
+def bench(count=1000, delay=0.0, mode='distance'):
+    """偽の CAD で計測を繰り返し、1回あたりの処理時間を測る"""
+    class _Discard:
+        def write(self, text):
+            pass
+
+        def flush(self):
+            pass
+
+    backend = FakeCadBackend(delay=delay)
+    service = MeasurementService(backend, _Discard())
+    service.handle({"command": "connect"})
+    latencies = []
+    for index in range(count):
+        start = time.perf_counter()
+        service.handle({"command": "measure", "id": index, "mode": mode})
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        "backend": backend.name,
+        "mode": mode,
+        "measurements": service.measurements,
+        "connections": backend.connections,
+        "user_delay_ms": delay * 1000,
+        "mean_ms": round(sum(latencies) / count, 4),
+        "p50_ms": round(latencies[count // 2], 4),
+        "p99_ms": round(latencies[min(count - 1, count * 99 // 100)], 4),
+        # 以前の実装は接続と LISP の読み込みを毎回行い、固定で 0.5 秒 × 2 回待っていた
+        "previous_fixed_wait_ms": 1000.0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="CAD の計測サービス (標準入力のコマンドで計測し、結果をJSON行で出力)")
+    parser.add_argument('--backend', choices=['autocad', 'fake'], default='autocad', help="接続する CAD")
+    parser.add_argument('--fake-delay', type=float, default=0.0, help="偽の CAD で点の選択にかかる時間 (秒)")
+    parser.add_argument('--benchmark', type=int, metavar='N', help="偽の CAD で N 回計測して処理時間を表示する")
+    parser.add_argument('--mode', choices=sorted(LISP_COMMANDS), default='distance', help="ベンチマークで計測する方法")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(json.dumps(bench(args.benchmark, args.fake_delay, args.mode), ensure_ascii=False, indent=2))
+        return
+    options = {"delay": args.fake_delay} if args.backend == 'fake' else {}
+    try:
+        backend = create_backend(args.backend, **options)
+    except CadError as e:
+        print(json.dumps({"status": "error", "message": str(e)}, ensure_ascii=False))
+        sys.exit(1)
+    MeasurementService(backend).run()
+
+if __name__ == "__main__":
+    main()
@@ -1,121 +1,914 @@
+import argparse
+import asyncio
+import itertools
 import math
 import json
+import os
+import tempfile
 import sys
 import codecs
 import re
+import signal
+import functools
+import operator
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fractions import Fraction
+from time import perf_counter_ns
 
-def calculate_trig(expression):
-    """三角関数部分を計算"""
-    try:
-        if not expression:
-            return {
-                "result": "",
-                "intermediate": "",
-                "error": None
-            }
+import framing
+import history_store
+import perf_stats
+import units
 
-        expression = expression.strip()
+try:
+    import numpy as np
+except ImportError:
+    # 配列の一括評価 (evaluate_array) 以外は NumPy なしで動作する
+    np = None
 
-        # πを含む場合、表示用の式を保持
-        display_expression = expression
-        
-        # 三角関数のチェック
-        trig_functions = ['sin', 'cos', 'tan']
-        for func in trig_functions:
-            if func in expression:
-                # 三角関数の後に数字または(が続いているかチェック
-                pattern = f"{func}(?![0-9\(])"
-                if re.search(pattern, expression):
-                    return {
-                        "result": expression,
-                        "intermediate": f"{func}の後に数値または括弧が必要です",
-                        "error": None
-                    }
+try:
+    import resource
+except ImportError:
+    # Windows では CPU時間の上限を設定しない
+    resource = None
 
-        # バリデーションチェック
-        validation_error = validate_expression(expression)
-        if validation_error:
-            return {
-                "result": expression,
-                "intermediate": validation_error,
-                "error": True
-            }
+# stdin/stdoutプロトコルのバージョン (idつきリクエストの応答に "v" として付与)
+PROTOCOL_VERSION = 1
 
-        func_name = expression[:3]
-        number_part = ""
-        i = 3
-        while i < len(expression) and (expression[i].isdigit() or expression[i] == '.'):
-            number_part += expression[i]
-            i += 1
-        
-        if number_part:
-            number = float(number_part)
-            radian = math.radians(number)
-            if func_name == 'sin':
-                result = math.sin(radian)
-            elif func_name == 'cos':
-                result = math.cos(radian)
-            else:  # tan
-                result = math.tan(radian)
-            return format_number(result), i
-    except Exception as e:
-        return {
-            "result": expression,
-            "intermediate": str(e),
-            "error": None
-        }
-    return None, 3
+# idつきリクエストを並行処理するスレッド数
+REQUEST_WORKERS = 4
+
+# 1リクエストあたりのCPU時間の上限 (秒)。worker_pool から起動されたときだけ設定される
+CPU_LIMIT = float(os.environ.get('CALCULATOR_CPU_LIMIT') or 0)
+
+# サーバーモードで一括処理 (batch など) を実行するプロセス数
+SERVER_BATCH_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+# サーバーモードで受け付ける1行の最大長 (一括処理のリクエストは大きくなる)
+SERVER_LINE_LIMIT = 64 * 1024 * 1024
+
+# サーバーモードのTCP既定ポート (Unixドメインソケットが使えない環境用)
+DEFAULT_SERVER_PORT = 47653
+
+# 処理段階ごとの時間計測 (CALCULATOR_STATS=1 のときだけ記録する)
+_STATS = perf_stats.ENABLED
+
+# 構文解析済みの式を保持するキャッシュの最大件数
+COMPILE_CACHE_SIZE = 4096
+
+# 括弧・単項演算子・べき乗の入れ子の深さの上限 (構文解析の再帰の深さになる)
+MAX_NESTING_DEPTH = 100
+
+# 構文木の深さの上限 (評価の再帰の深さになる。1+2+3... のような左結合の連なりは1段と数える)
+MAX_AST_DEPTH = 500
+
+# 整数のまま計算する値の大きさの上限 (ビット数)。超える式は浮動小数点で計算する
+MAX_INTEGER_BITS = 1 << 16
+
+# 厳密計算で扱う有理数の大きさの上限 (ビット数)。10進に変換できる既定の4300桁に収まる大きさ
+MAX_EXACT_BITS = 14000
+
+# 厳密計算で扱うπの次数の上限 ((1+π)^n を展開する回数を抑える)
+MAX_EXACT_PI_DEGREE = 64
+
+# analyze_cost() の結果: そのまま評価できる / 浮動小数点で評価する
+COST_OK = 'ok'
+COST_FLOAT = 'float'
+
+TRIG_FUNCTIONS = ('sin', 'cos', 'tan')
+
+# 全角・表示用の記号を標準形式に変換するテーブル
+_OPERATOR_TABLE = str.maketrans({
+    '×': '*',
+    '÷': '/',
+    '－': '-',
+    '＋': '+',
+    '（': '(',
+    '）': ')',
+    ' ': None,
+    '\t': None,
+})
+
+_NUMBER_CHARS = frozenset('0123456789.')
+
+_NAME_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+
+_SINGLE_CHAR_TOKENS = {
+    '+': 'op',
+    '-': 'op',
+    '*': 'op',
+    '/': 'op',
+    '^': 'pow',
+    '(': 'lparen',
+    ')': 'rparen',
+    'π': 'pi',
+}
+
+# 暗黙の掛け算の右辺になり得るトークン
+_PRIMARY_START = frozenset(('num', 'pi', 'var', 'lparen', 'func'))
+
+_BINARY_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '^': operator.pow,
+}
+
+_TRIG_OPS = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+}
+
+_NUMPY_TRIG_OPS = {
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+} if np is not None else {}
 
 def normalize_operators(expression):
     """演算子を標準形式に変換"""
-    # 数字の後のπを掛け算として処理
-    result = ""
+    return expression.translate(_OPERATOR_TABLE)
+
+# 1文字ずつの正規化 (None は削除する文字)
+_CHAR_NORMALIZATION = {chr(code): value for code, value in _OPERATOR_TABLE.items()}
+
+# 連続していると validate_expression() がエラーにする演算子 (正規化前の半角のみ)
+_RAW_OPERATORS = frozenset('+-*/')
+
+# 三角関数の直後にあれば引数ありとみなす文字
+_TRIG_ARGUMENT_START = frozenset('0123456789(')
+
+class LexedExpression:
+    """式を1回走査して得たトークン列と診断情報
+
+    トークンは正規化後の式に対する (種類, 値, 位置)。診断は正規化前の文字で判定する。
+    """
+
+    __slots__ = (
+        'expression', 'tokens', 'token_error', 'balanced', 'open_count', 'close_count',
+        'consecutive_operators', 'trig', '_ast', '_ast_error', '_costs'
+    )
+
+    def compile(self):
+        """構文木を返す (結果は式ごとに保持する)"""
+        if self._ast is None:
+            if self._ast_error is None:
+                try:
+                    if self.token_error is not None:
+                        raise ValueError(self.token_error)
+                    self._ast = _Parser(self.tokens).parse()
+                    return self._ast
+                except ValueError as e:
+                    self._ast_error = e
+            # ComplexityError などの種類はそのまま伝える
+            raise type(self._ast_error)(str(self._ast_error))
+        return self._ast
+
+    def cost(self, exact=False):
+        """構文木に対する analyze_cost() の結果 (計算モードごとに保持する)"""
+        costs = self._costs
+        if costs is None:
+            costs = self._costs = {}
+        if exact not in costs:
+            costs[exact] = analyze_cost(self.compile(), exact)
+        return costs[exact]
+
+    def trig_without_argument(self):
+        """引数 (数字または括弧) が1つも続かない三角関数があるか"""
+        return any(not has_argument for has_argument, _ in self.trig.values())
+
+    def validation_error(self):
+        """validate_expression() のエラー (なければ None)"""
+        if not self.expression:
+            return "式が入力されていません"
+        if not self.balanced:
+            return "Error"
+        if self.consecutive_operators:
+            return "演算子が連続しています"
+        if any(missing_argument for _, missing_argument in self.trig.values()):
+            return self.expression
+        return None
+
+def _append_name_tokens(tokens, name, position):
+    # 英字の並びを三角関数と変数名に分ける (xsin30 → x, sin, 30)
     i = 0
-    while i < len(expression):
-        if i + 3 <= len(expression) and expression[i:i+3] in ['sin', 'cos', 'tan']:
-            # sin, cos, tanの直前が数字または')'なら掛け算記号を挿入
-            if i > 0 and (expression[i-1].isdigit() or expression[i-1] == ')'):
-                result += '*'
-
-            trig_result, next_pos = calculate_trig(expression[i:])
-            if trig_result is not None:
-                result += trig_result
-                i += next_pos
+    length = len(name)
+    while i < length:
+        if name.startswith(TRIG_FUNCTIONS, i):
+            tokens.append(('func', name[i:i+3], position + i))
+            i += 3
+            continue
+        start = i
+        while i < length and not name.startswith(TRIG_FUNCTIONS, i):
+            i += 1
+        tokens.append(('var', name[start:i], position + start))
+
+# 字句解析のパターン (数値の並び | 英字の並び | その他の1文字)
+# 並びの途中の空白・タブは正規化で削除されるため並びに含める
+_LEX_PATTERN = re.compile(r'([0-9.][0-9. \t]*)|([A-Za-z_][A-Za-z_ \t]*)|(.)', re.DOTALL)
+
+def _lex(expression):
+    lexed = LexedExpression()
+    tokens = []
+    append = tokens.append
+    error = None
+    depth = 0
+    balanced = True
+    open_count = 0
+    close_count = 0
+    consecutive = False
+    previous_operator = False
+    # 三角関数名: [引数が続く箇所がある, 引数が続かない箇所がある]
+    trig = {}
+    # 正規化前と正規化後の位置
+    index = 0
+    position = 0
+
+    for number, name, char in _LEX_PATTERN.findall(expression):
+        if not char:
+            text = number or name
+            start = index
+            index += len(text)
+            previous_operator = False
+            if ' ' in text or '\t' in text:
+                text = text.translate(_OPERATOR_TABLE)
+            if name:
+                for trig_name in TRIG_FUNCTIONS:
+                    found = name.find(trig_name)
+                    while found >= 0:
+                        # 三角関数の直後の文字 (正規化前) で引数の有無を判定
+                        following = expression[start+found+3:start+found+4]
+                        flags = trig.setdefault(trig_name, [False, False])
+                        if following and following in _TRIG_ARGUMENT_START:
+                            flags[0] = True
+                        else:
+                            flags[1] = True
+                        found = name.find(trig_name, found + 1)
+                if error is None:
+                    if text in _TRIG_OPS:
+                        append(('func', text, position))
+                    else:
+                        _append_name_tokens(tokens, text, position)
+            elif error is None:
+                if text == '.' or text.count('.') > 1:
+                    error = f"数値の形式が不正です: {text}"
+                else:
+                    append(('num', float(text) if '.' in text else int(text), position))
+            position += len(text)
+            continue
+        index += 1
+
+        # 診断 (正規化前の文字で判定)
+        is_operator = char in _RAW_OPERATORS
+        if is_operator:
+            if previous_operator:
+                consecutive = True
+        elif char == '(' or char == '（':
+            depth += 1
+            # 半角・全角の括弧は同じものとして数える (逐次評価と同じ)
+            open_count += 1
+        elif char == ')' or char == '）':
+            if depth:
+                depth -= 1
+            else:
+                balanced = False
+            close_count += 1
+        previous_operator = is_operator
+
+        # トークン (正規化後の文字、最初のエラー以降は作らない)
+        normalized = _CHAR_NORMALIZATION.get(char, char)
+        if normalized is None or error is not None:
+            continue
+        if normalized == '*' and tokens and tokens[-1][1] == '*' and tokens[-1][2] == position - 1:
+            # Python形式のべき乗 ** も ^ として扱う
+            tokens[-1] = ('pow', '^', position - 1)
+        else:
+            token_kind = _SINGLE_CHAR_TOKENS.get(normalized)
+            if token_kind is None:
+                error = "不正な文字が含まれています"
                 continue
-        
-        # 2乗の処理
-        if expression[i] == '^' and i + 1 < len(expression) and expression[i+1] == '2':
-            # 直前の数値を2乗に変換
-            result += '**2'
-            i += 2
+            append((token_kind, normalized, position))
+        position += 1
+
+    lexed.expression = expression
+    lexed.tokens = tokens
+    lexed.token_error = error
+    lexed.balanced = balanced and depth == 0
+    lexed.open_count = open_count
+    lexed.close_count = close_count
+    lexed.consecutive_operators = consecutive
+    lexed.trig = trig
+    lexed._ast = None
+    lexed._ast_error = None
+    lexed._costs = None
+    return lexed
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def lex_expression(expression):
+    """式を1回の走査でトークン列と診断情報に変換 (式の文字列をキーにキャッシュ)"""
+    return _lex(expression)
+
+def tokenize(expression):
+    """式をトークン列 (種類, 値, 位置) に分解"""
+    lexed = _lex(expression)
+    if lexed.token_error is not None:
+        raise ValueError(lexed.token_error)
+    return lexed.tokens
+
+class _Parser:
+    """トークン列を再帰下降で構文木 (タプル) に変換する
+
+    構文木のノード:
+        ('num', 値) / ('pi',) / ('var', 名前) / ('neg', 式) / ('func', 名前, 式) /
+        ('binop', 演算子, 左辺, 右辺)
+    """
+
+    def __init__(self, tokens):
+        # 末尾の None を番兵にして範囲チェックを省く
+        self.tokens = tokens + [None]
+        self.pos = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def parse(self):
+        if len(self.tokens) == 1:
+            raise ValueError("式が入力されていません")
+        node = self.parse_sum()
+        token = self.peek()
+        if token is not None:
+            raise ValueError(f"構文エラー: 位置{token[2]}の'{token[1]}'")
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while True:
+            token = self.peek()
+            if token is None or token[0] != 'op' or token[1] not in '+-':
+                return node
+            self.pos += 1
+            node = ('binop', token[1], node, self.parse_product())
+
+    def parse_product(self):
+        node = self.parse_unary()
+        while True:
+            token = self.peek()
+            if token is None:
+                return node
+            if token[0] == 'op' and token[1] in '*/':
+                self.pos += 1
+                node = ('binop', token[1], node, self.parse_unary())
+            elif token[0] in _PRIMARY_START:
+                # 2π, 3(4+5), 2sin30 などの暗黙の掛け算
+                node = ('binop', '*', node, self.parse_power())
+            else:
+                return node
+
+    def parse_unary(self):
+        # 括弧・単項演算子・べき乗の入れ子はすべてここを通るため、ここで再帰の深さを制限する
+        self.depth += 1
+        if self.depth > MAX_NESTING_DEPTH:
+            raise ComplexityError("式の入れ子が深すぎます")
+        token = self.peek()
+        if token is not None and token[0] == 'op' and token[1] in '+-':
+            self.pos += 1
+            operand = self.parse_unary()
+            node = ('neg', operand) if token[1] == '-' else operand
+        else:
+            node = self.parse_power()
+        self.depth -= 1
+        return node
+
+    def parse_power(self):
+        base = self.parse_primary()
+        token = self.peek()
+        if token is not None and token[0] == 'pow':
+            self.pos += 1
+            # べき乗は右結合で、指数には単項演算子を許可する (2^-1)
+            return ('binop', '^', base, self.parse_unary())
+        return base
+
+    def parse_primary(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("式が不完全です")
+        kind = token[0]
+        if kind == 'num':
+            self.pos += 1
+            return ('num', token[1])
+        if kind == 'pi':
+            self.pos += 1
+            return ('pi',)
+        if kind == 'var':
+            self.pos += 1
+            return ('var', token[1])
+        if kind == 'lparen':
+            return self.parse_group()
+        if kind == 'func':
+            self.pos += 1
+            argument = self.peek()
+            # 三角関数の引数は直後の数値・変数または括弧のみ (sin30×2 = (sin30)×2)
+            if argument is not None and argument[0] in ('num', 'var'):
+                self.pos += 1
+                return ('func', token[1], (argument[0], argument[1]))
+            if argument is not None and argument[0] == 'lparen':
+                return ('func', token[1], self.parse_group())
+            raise ValueError(f"{token[1]}の後に数値または括弧が必要です")
+        raise ValueError(f"構文エラー: 位置{token[2]}の'{token[1]}'")
+
+    def parse_group(self):
+        self.pos += 1
+        node = self.parse_sum()
+        token = self.peek()
+        if token is None or token[0] != 'rparen':
+            raise ValueError("括弧が閉じられていません")
+        self.pos += 1
+        return node
+
+def compile_expression(expression):
+    """式を構文木に変換 (字句解析の結果とともにキャッシュ)"""
+    return lex_expression(expression).compile()
+
+def _left_chain(node):
+    """左結合の二項演算の連なり (1+2+3...) を、先頭の項と (演算子, 右辺) の列に分ける
+
+    連なりを再帰せずに評価するため、評価の再帰の深さは括弧などの入れ子の深さだけになる。
+    """
+    operations = []
+    while node[0] == 'binop' and node[1] != '^':
+        operations.append((node[1], node[3]))
+        node = node[2]
+    operations.reverse()
+    return node, operations
+
+class ComplexityError(ValueError):
+    """評価する前に、計算量が大きすぎると判定した式"""
+
+def _literal_bits(value, exact):
+    # 値の大きさ (log2)。厳密計算では小数リテラルを分数にしたときの分子と分母の大きさ
+    if isinstance(value, int):
+        return math.log2(abs(value)) if value else 0.0
+    if not exact:
+        return 0.0
+    fraction = Fraction(repr(value))
+    return float(fraction.numerator.bit_length() + fraction.denominator.bit_length())
+
+def analyze_cost(node, exact=False):
+    """構文木を評価せずに、整数・有理数のまま計算した場合の大きさを見積もる
+
+    各ノードの値の大きさ (ビット数) の上限を葉から順に求め、べき乗の結果を
+    底の大きさ × 指数の値の上限 で見積もる (9^9^9 は指数の 9^9 の段階で分かる)。
+    大きさは二項演算ごとに上限と比べる (上限内のべき乗どうしを掛け合わせる式も見積もりで分かる)。
+    再帰を使わない1回の走査 (O(n)) で、上限を超える演算があれば COST_FLOAT、
+    なければ COST_OK を返す。構文木が深すぎる場合は ComplexityError。
+    """
+    limit = MAX_EXACT_BITS if exact else MAX_INTEGER_BITS
+    too_large = False
+    # 値: (整数か, 大きさの上限 (log2), πの次数の上限)
+    values = []
+    stack = [(node, 1, False)]
+    while stack:
+        current, depth, expanded = stack.pop()
+        kind = current[0]
+        if not expanded and kind in ('binop', 'neg', 'func'):
+            if depth > MAX_AST_DEPTH:
+                raise ComplexityError("式が長すぎるか、入れ子が深すぎます")
+            stack.append((current, depth, True))
+            # 左辺を先に処理するため右辺から積む
+            if kind == 'binop':
+                stack.append((current[3], depth + 1, False))
+                left = current[2]
+                # 左結合の連なりの左辺は評価で再帰しないため、深さを増やさない
+                chained = current[1] != '^' and left[0] == 'binop' and left[1] != '^'
+                stack.append((left, depth if chained else depth + 1, False))
+            else:
+                stack.append((current[-1], depth + 1, False))
+            continue
+
+        if kind == 'num':
+            value = (isinstance(current[1], int), _literal_bits(current[1], exact), 0)
+        elif kind == 'pi':
+            value = (False, 2.0, 1)
+        elif kind == 'var':
+            value = (False, 0.0, 0)
+        elif kind == 'neg':
+            value = values.pop()
+        elif kind == 'func':
+            values.pop()
+            # 厳密に表せる値は 0, ±1/2, ±1 のみ (それ以外は浮動小数点になる)
+            value = (False, 2.0, 0)
+        else:
+            right = values.pop()
+            left = values.pop()
+            integer = left[0] and right[0]
+            op = current[1]
+            if op in '+-':
+                # 整数は1ビット増えるだけ、分数は分母どうしの積になる
+                bits = max(left[1], right[1]) + 1 if integer else left[1] + right[1] + 1
+                value = (integer, bits, max(left[2], right[2]))
+            elif op in '*/':
+                value = (integer and op == '*', left[1] + right[1], left[2] + right[2])
+            elif exact or integer:
+                # 指数の値は 2^(指数の大きさ) 以下。厳密計算では 4/2 のような分数の指数も整数乗になり得る
+                exponent = 2.0 ** right[1] if right[1] < 1024 else math.inf
+                value = (
+                    integer,
+                    left[1] * exponent if left[1] else 0.0,
+                    left[2] * exponent if left[2] else 0
+                )
+            else:
+                # 浮動小数点のべき乗は大きさによらず一定時間 (桁あふれはすぐにエラーになる)
+                value = (False, 0.0, 0)
+            # 浮動小数点の演算は大きさによらず一定時間のため、整数・有理数のまま計算する場合だけ比べる
+            if (exact or integer) and (value[1] > limit or (exact and value[2] > MAX_EXACT_PI_DEGREE)):
+                too_large = True
+        values.append(value)
+    return COST_FLOAT if too_large else COST_OK
+
+def _float_literals(node):
+    # 整数のリテラルを浮動小数点にした構文木
+    kind = node[0]
+    if kind == 'num':
+        return ('num', float(node[1]))
+    if kind == 'binop' and node[1] != '^':
+        first, operations = _left_chain(node)
+        result = _float_literals(first)
+        for op, operand in operations:
+            result = ('binop', op, result, _float_literals(operand))
+        return result
+    if kind == 'binop':
+        return ('binop', node[1], _float_literals(node[2]), _float_literals(node[3]))
+    if kind == 'neg':
+        return ('neg', _float_literals(node[1]))
+    if kind == 'func':
+        return ('func', node[1], _float_literals(node[2]))
+    return node
+
+def evaluate_ast_float(node, variables=None):
+    """構文木を浮動小数点だけで評価 (整数のままでは大きくなりすぎる式用)"""
+    try:
+        result = evaluate_ast(_float_literals(node), variables)
+    except OverflowError:
+        raise ComplexityError("計算結果が大きすぎます")
+    if isinstance(result, float) and math.isinf(result):
+        raise ComplexityError("計算結果が大きすぎます")
+    return result
+
+def evaluate_ast(node, variables=None):
+    """構文木を評価 (variables は変数名から値への辞書)"""
+    kind = node[0]
+    if kind == 'num':
+        return node[1]
+    if kind == 'binop' and node[1] != '^':
+        first, operations = _left_chain(node)
+        value = evaluate_ast(first, variables)
+        for op, operand in operations:
+            value = _BINARY_OPS[op](value, evaluate_ast(operand, variables))
+        return value
+    if kind == 'binop':
+        return _BINARY_OPS[node[1]](evaluate_ast(node[2], variables), evaluate_ast(node[3], variables))
+    if kind == 'pi':
+        return math.pi
+    if kind == 'var':
+        if variables is None or node[1] not in variables:
+            raise ValueError(f"未定義の変数です: {node[1]}")
+        return variables[node[1]]
+    if kind == 'neg':
+        return -evaluate_ast(node[1], variables)
+    if kind == 'func':
+        return _evaluate_trig(node[1], evaluate_ast(node[2], variables))
+    raise ValueError(f"不明なノードです: {kind}")
+
+def _evaluate_trig(name, degrees):
+    value = _TRIG_OPS[name](math.radians(degrees))
+    # 表示と同じ13桁に丸めてから後続の計算に使う (tan45 = 1)
+    return round(value, 13)
+
+def evaluate_ast_array(node, arrays):
+    """構文木を NumPy 配列に対して要素ごとに評価"""
+    kind = node[0]
+    if kind == 'num':
+        return node[1]
+    if kind == 'binop' and node[1] != '^':
+        first, operations = _left_chain(node)
+        value = evaluate_ast_array(first, arrays)
+        for op, operand in operations:
+            right = evaluate_ast_array(operand, arrays)
+            value = np.true_divide(value, right) if op == '/' else _BINARY_OPS[op](value, right)
+        return value
+    if kind == 'binop':
+        # 整数のべき乗で桁あふれしないよう浮動小数点で計算
+        return np.power(np.asarray(evaluate_ast_array(node[2], arrays), dtype=np.float64),
+                        evaluate_ast_array(node[3], arrays))
+    if kind == 'pi':
+        return math.pi
+    if kind == 'var':
+        if node[1] not in arrays:
+            raise ValueError(f"未定義の変数です: {node[1]}")
+        return arrays[node[1]]
+    if kind == 'neg':
+        return np.negative(evaluate_ast_array(node[1], arrays))
+    if kind == 'func':
+        value = _NUMPY_TRIG_OPS[node[1]](np.radians(evaluate_ast_array(node[2], arrays)))
+        # np.round は10進の正確な丸めではないため、スカラー計算と最下位桁が異なることがある
+        return np.round(value, 13)
+    raise ValueError(f"不明なノードです: {kind}")
+
+def evaluate_array(expression, variables):
+    """1つの式を変数の配列 (列) に対してまとめて評価し、float64配列を返す"""
+    if np is None:
+        raise ValueError("NumPyがインストールされていません")
+    lexed = lex_expression(expression)
+    node = lexed.compile()
+    # 配列は常に浮動小数点で計算するため、ここでは構文木の深さだけを確かめる
+    lexed.cost()
+    arrays = {name: np.asarray(values, dtype=np.float64) for name, values in variables.items()}
+    with np.errstate(all='ignore'):
+        values = evaluate_ast_array(node, arrays)
+    shape = np.broadcast_shapes(*(array.shape for array in arrays.values()))
+    return np.broadcast_to(np.asarray(values, dtype=np.float64), shape)
+
+def format_calculation_array(values):
+    """format_calculation() と同じ表示形式を配列全体に適用 (result と intermediate のリストを返す)"""
+    # -0.0 を 0.0 にそろえる (符号付きのゼロは '-0.0000000000000' と表示されてしまう)
+    values = np.asarray(values, dtype=np.float64).ravel() + 0.0
+    with np.errstate(all='ignore'):
+        valid = np.isfinite(values)
+        # πの倍数かどうかは配列演算でまとめて判定
+        pi_multiple = values / math.pi
+        rounded = np.round(pi_multiple) + 0.0
+        is_pi_multiple = valid & (np.abs(pi_multiple - rounded) < 1e-10)
+        is_pi = is_pi_multiple & (np.abs(pi_multiple - 1) < 1e-10)
+
+    # 文字列化だけは要素ごとに行う
+    fixed = ['%.13f' % value for value in values.tolist()]
+    results = [text.rstrip('0').rstrip('.') for text in fixed]
+    intermediates = list(results)
+
+    for index in np.flatnonzero(is_pi_multiple).tolist():
+        if is_pi[index]:
+            results[index] = "π"
+            intermediates[index] = f"{math.pi:.13f}"
+        else:
+            results[index] = f"{rounded[index]:.0f}π"
+            intermediates[index] = fixed[index]
+    for index in np.flatnonzero(~valid).tolist():
+        results[index] = "Error"
+        intermediates[index] = "Error"
+    return results, intermediates
+
+def evaluate_array_command(data):
+    """evaluate_array コマンド: 変数の配列に対する一括評価"""
+    try:
+        values = evaluate_array(data.get('expression', ''), data.get('variables') or {})
+    except ZeroDivisionError:
+        return {"error": "0での除算はできません"}
+    except Exception as e:
+        return {"error": f"計算エラー: {str(e)}"}
+    if data.get('format', True):
+        results, intermediates = format_calculation_array(values)
+        return {"results": results, "intermediates": intermediates}
+    # 数値のまま返す (NaN / inf は null)
+    return {"values": np.where(np.isfinite(values), values, None).tolist()}
+
+# 厳密計算モードで有理数になる三角関数の値 (角度は0〜360度)
+_EXACT_TRIG_VALUES = {
+    'sin': {0: 0, 30: Fraction(1, 2), 90: 1, 150: Fraction(1, 2),
+            180: 0, 210: Fraction(-1, 2), 270: -1, 330: Fraction(-1, 2)},
+    'cos': {0: 1, 60: Fraction(1, 2), 90: 0, 120: Fraction(-1, 2),
+            180: -1, 240: Fraction(-1, 2), 270: 0, 300: Fraction(1, 2)},
+    'tan': {0: 0, 45: 1, 135: -1, 180: 0, 225: 1, 315: -1},
+}
+
+class _InexactResult(Exception):
+    """厳密に表せない計算 (float計算に切り替える)"""
+
+def _exact_add(left, right, sign=1):
+    result = dict(left)
+    for power, coefficient in right.items():
+        value = result.get(power, 0) + sign * coefficient
+        if value:
+            result[power] = value
+        else:
+            result.pop(power, None)
+    return result
+
+def _exact_mul(left, right):
+    result = {}
+    for left_power, left_coefficient in left.items():
+        for right_power, right_coefficient in right.items():
+            power = left_power + right_power
+            value = result.get(power, 0) + left_coefficient * right_coefficient
+            if value:
+                result[power] = value
+            else:
+                result.pop(power, None)
+    return result
+
+def _exact_div(left, right):
+    if not right:
+        raise ZeroDivisionError
+    if len(right) != 1:
+        # π を含む多項式での除算は厳密に表せない
+        raise _InexactResult
+    (right_power, right_coefficient), = right.items()
+    return {power - right_power: coefficient / right_coefficient for power, coefficient in left.items()}
+
+def _exact_rational(value):
+    """πを含まない値なら有理数として返す"""
+    if not value:
+        return Fraction(0)
+    if len(value) == 1 and 0 in value:
+        return value[0]
+    raise _InexactResult
+
+def _exact_pow(base, exponent):
+    exponent = _exact_rational(exponent)
+    if exponent.denominator != 1:
+        raise _InexactResult
+    exponent = exponent.numerator
+    if not base:
+        if exponent < 0:
+            raise ZeroDivisionError
+        return {} if exponent > 0 else {0: Fraction(1)}
+    if len(base) == 1:
+        (power, coefficient), = base.items()
+        return {power * exponent: coefficient ** exponent}
+    if exponent < 0:
+        raise _InexactResult
+    result = {0: Fraction(1)}
+    for _ in range(exponent):
+        result = _exact_mul(result, base)
+    return result
+
+def evaluate_ast_exact(node):
+    """構文木を厳密に評価 (値は {πの次数: 有理数係数} の辞書)"""
+    kind = node[0]
+    if kind == 'num':
+        value = node[1]
+        # 小数リテラルは入力どおりの10進数として扱う (0.1 = 1/10)
+        coefficient = Fraction(value) if isinstance(value, int) else Fraction(repr(value))
+        return {0: coefficient} if coefficient else {}
+    if kind == 'binop' and node[1] != '^':
+        first, operations = _left_chain(node)
+        value = evaluate_ast_exact(first)
+        for op, operand in operations:
+            right = evaluate_ast_exact(operand)
+            if op == '+':
+                value = _exact_add(value, right)
+            elif op == '-':
+                value = _exact_add(value, right, -1)
+            elif op == '*':
+                value = _exact_mul(value, right)
+            else:
+                value = _exact_div(value, right)
+        return value
+    if kind == 'binop':
+        return _exact_pow(evaluate_ast_exact(node[2]), evaluate_ast_exact(node[3]))
+    if kind == 'pi':
+        return {1: Fraction(1)}
+    if kind == 'neg':
+        return {power: -coefficient for power, coefficient in evaluate_ast_exact(node[1]).items()}
+    if kind == 'func':
+        degrees = _exact_rational(evaluate_ast_exact(node[2])) % 360
+        if degrees.denominator != 1 or degrees.numerator not in _EXACT_TRIG_VALUES[node[1]]:
+            raise _InexactResult
+        value = Fraction(_EXACT_TRIG_VALUES[node[1]][degrees.numerator])
+        return {0: value} if value else {}
+    if kind == 'var':
+        raise ValueError(f"未定義の変数です: {node[1]}")
+    raise ValueError(f"不明なノードです: {kind}")
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _is_integer_ast(node):
+    """整数の加減乗算と非負整数のべき乗だけで構成されているか"""
+    kind = node[0]
+    if kind == 'num':
+        return isinstance(node[1], int)
+    if kind == 'neg':
+        return _is_integer_ast(node[1])
+    if kind == 'binop' and node[1] != '^':
+        first, operations = _left_chain(node)
+        return all(op != '/' and _is_integer_ast(operand) for op, operand in operations) and _is_integer_ast(first)
+    if kind == 'binop':
+        exponent = node[3]
+        return _is_integer_ast(node[2]) and exponent[0] == 'num' and isinstance(exponent[1], int)
+    return False
+
+def eval_expression_exact(expression):
+    """式を厳密に評価 (厳密に表せない場合は float を返す)"""
+    lexed = lex_expression(expression)
+    node = lexed.compile()
+    if lexed.cost(exact=True) == COST_FLOAT:
+        # 有理数のままでは大きくなりすぎるため浮動小数点で計算
+        return eval_expression(expression)
+    try:
+        if _is_integer_ast(node):
+            # 整数だけの式は Python の整数演算がそのまま厳密
+            value = evaluate_ast(node)
+            return {0: Fraction(value)} if value else {}
+        return evaluate_ast_exact(node)
+    except ZeroDivisionError:
+        raise ValueError("0での除算はできません")
+    except _InexactResult:
+        return eval_expression(expression)
+
+def _exact_to_float(value):
+    return _checked_float(sum(float(coefficient) * math.pi ** power for power, coefficient in value.items()))
+
+def _format_fraction(value):
+    if value.denominator == 1:
+        return str(value.numerator)
+    return f"{value.numerator}/{value.denominator}"
+
+def _format_decimal(value, digits=13):
+    """有理数を小数点以下 digits 桁に丸めて表示"""
+    scaled = round(value * 10 ** digits)
+    sign = '-' if scaled < 0 else ''
+    integer_part, fraction_part = divmod(abs(scaled), 10 ** digits)
+    text = f"{sign}{integer_part}.{fraction_part:0{digits}d}".rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+def _format_symbolic(value):
+    terms = []
+    for power in sorted(value, reverse=True):
+        coefficient = value[power]
+        if power == 0:
+            terms.append(_format_fraction(coefficient))
             continue
-        
-        if i > 0 and expression[i] == 'π' and (expression[i-1].isdigit() or expression[i-1] == ')'):
-            result += '*' + str(math.pi)
-        elif expression[i] == 'π':
-            result += str(math.pi)
-        # 数字の後に括弧が来た場合、掛け算を挿入
-        elif i > 0 and expression[i] == '(' and (expression[i-1].isdigit() or expression[i-1] == ')'):
-            result += '*('
-        elif expression[i] == '×':
-            result += '*'
-        elif expression[i] == '÷':
-            result += '/'
-        elif expression[i] == '－':
-            result += '-'
-        elif expression[i] == '＋':
-            result += '+'
-        elif expression[i] == '（':
-            result += '('
-        elif expression[i] == '）':
-            result += ')'
+        pi_text = 'π' if power == 1 else f"π^{power}"
+        if coefficient == 1:
+            terms.append(pi_text)
+        elif coefficient == -1:
+            terms.append('-' + pi_text)
+        elif coefficient.denominator == 1:
+            terms.append(f"{coefficient.numerator}{pi_text}")
         else:
-            result += expression[i]
-        i += 1
+            terms.append(f"({_format_fraction(coefficient)}){pi_text}")
+    return '+'.join(terms).replace('+-', '-')
+
+def format_exact(value):
+    """厳密計算の結果を表示用の result / intermediate に変換"""
+    if isinstance(value, float):
+        return format_calculation(value)
+    if not value:
+        return {"result": "0", "intermediate": "0"}
+    if len(value) == 1 and 0 in value:
+        rational = value[0]
+        formatted = _format_decimal(rational)
+        denominator = rational.denominator
+        while denominator % 2 == 0:
+            denominator //= 2
+        while denominator % 5 == 0:
+            denominator //= 5
+        # 割り切れない場合は途中式に分数を表示
+        return {
+            "result": formatted,
+            "intermediate": formatted if denominator == 1 else _format_fraction(rational)
+        }
+    approximate = _exact_to_float(value)
+    if len(value) == 1 and 1 in value and value[1].denominator == 1:
+        multiple = value[1].numerator
+        return {
+            "result": "π" if multiple == 1 else f"{multiple}π",
+            "intermediate": f"{approximate:.13f}"
+        }
+    return {
+        "result": format_calculation(approximate)["result"],
+        "intermediate": _format_symbolic(value)
+    }
+
+def _is_incomplete(expression):
+    """構文の途中で終わっている式か (不正な文字や計算のエラーではない)"""
+    lexed = lex_expression(expression)
+    if lexed.token_error is not None:
+        return False
+    try:
+        lexed.compile()
+    except ComplexityError:
+        return False
+    except ValueError:
+        return True
+    return False
+
+def complexity_error(error):
+    """評価する前に打ち切った式の応答 (通常のエラー表示に理由を添える)"""
+    return {"error": "Error", "reason": "complexity", "message": str(error)}
+
+def calculate(expression, mode='float'):
+    """数式を計算する関数 (mode='exact' で有理数による厳密計算)"""
+    if not _STATS:
+        return _calculate(expression, mode)
+    start = perf_counter_ns()
+    result = _calculate(expression, mode)
+    perf_stats.record('calculate', start)
     return result
 
-def calculate(expression):
-    """数式を計算する関数"""
+def _calculate(expression, mode):
     try:
         if not expression:
             return {
@@ -129,19 +922,23 @@ def calculate(expression):
 
         # 空白を削除
         expression = expression.strip()
+        if _STATS:
+            start = perf_counter_ns()
+
+        # 1回の走査で得た診断情報で検証 (トークン列は計算でもそのまま使う)
+        lexed = lex_expression(expression)
 
         # 三角関数のチェック
-        for func in ['sin', 'cos', 'tan']:
-            if func in expression and not re.search(f"{func}[0-9\(]", expression):
-                return {
-                    "result": expression,
-                    "intermediate": "Error"
-                }
+        if lexed.trig_without_argument():
+            return {
+                "result": expression,
+                "intermediate": "Error"
+            }
 
         # バリデーションチェック
-        validation_error = validate_expression(expression)
+        validation_error = lexed.validation_error()
         if validation_error:
-            if any(func in expression for func in ['sin', 'cos', 'tan']):
+            if lexed.trig:
                 return {
                     "result": validation_error,
                     "intermediate": "Error"
@@ -152,83 +949,86 @@ def calculate(expression):
             }
 
         # 括弧の対応をチェック
-        open_count = expression.count('(')
-        close_count = expression.count(')')
-        if open_count > close_count:
+        if lexed.open_count > lexed.close_count:
             # 括弧が不完全な場合、式をresultに、"Error"をintermediateに返す
-            try:
-                normalized = normalize_operators(expression)
-                calc_result = eval_expression(normalized)
-                if isinstance(calc_result, str):
-                    return {
-                        "result": expression,
-                        "intermediate": "Error"
-                    }
-                return {
-                    "result": expression,
-                    "intermediate": "Error"
-                }
-            except:
-                return {
-                    "result": expression,
-                    "intermediate": "Error"
-                }
+            return {
+                "result": expression,
+                "intermediate": "Error"
+            }
+        if _STATS:
+            perf_stats.record('validate', start)
 
         # 式が演算子で終わっている場合は、の演算子を無視して計算
         if expression and expression[-1] in '+-×÷*/.(':
             expression = expression[:-1]
-            normalized = normalize_operators(expression)
             try:
-                result = eval_expression(normalized)
-                if isinstance(result, str):
-                    return {
-                        "result": result,
-                        "intermediate": result
-                    }
+                if mode == 'exact':
+                    return format_exact(eval_expression_exact(expression))
+                result = eval_expression(expression)
                 formatted = format_number(result)
                 return {
                     "result": formatted,
                     "intermediate": formatted
                 }
+            except ComplexityError as e:
+                return complexity_error(e)
             except:
+                if _is_incomplete(expression):
+                    # 「-」「×」「.」だけの入力など、式の途中なのでエラーは表示しない
+                    normalized = normalize_operators(expression)
+                    return {
+                        "result": normalized,
+                        "intermediate": normalized
+                    }
                 return {
                     "result": expression,
                     "intermediate": "Error"
                 }
 
-        # 式を標準形式に変換して計算
-        normalized = normalize_operators(expression)
+        # 式を構文木に変換して計算
         try:
-            result = eval_expression(normalized)
-            if isinstance(result, str):
-                return {"result": display_expression, "intermediate": expression}
-            
-            # πの倍数かどうかをチェック
-            pi_multiple = result / math.pi
-            if abs(pi_multiple - round(pi_multiple)) < 1e-10:
-                if abs(pi_multiple - 1) < 1e-10:
-                    return {
-                        "result": "π",
-                        "intermediate": f"{math.pi:.13f}"
-                    }
-                else:
-                    return {
-                        "result": f"{round(pi_multiple)}π",
-                        "intermediate": f"{result:.13f}"
-                    }
-            
-            # その他の数値の場合
-            formatted = f"{result:.13f}".rstrip('0').rstrip('.')
-            return {
-                "result": formatted,
-                "intermediate": formatted
-            }
+            if mode == 'exact':
+                return format_exact(eval_expression_exact(expression))
+            result = eval_expression(expression)
+            if not _STATS:
+                return format_calculation(result)
+            start = perf_counter_ns()
+            formatted = format_calculation(result)
+            perf_stats.record('format', start)
+            return formatted
+        except ComplexityError as e:
+            return complexity_error(e)
         except:
-            return {"result": display_expression, "intermediate": expression}
+            return {"error": "Error"}
 
     except Exception as e:
         return {"error": "Error"}
 
+def format_calculation(result):
+    """計算結果を表示用の result / intermediate に変換"""
+    # -0.0 を 0.0 にそろえる (format_calculation_array と同じ表示にする)
+    result = result + 0.0
+    # πの倍数かどうかをチェック
+    pi_multiple = result / math.pi
+    if abs(pi_multiple - round(pi_multiple)) < 1e-10:
+        if abs(pi_multiple - 1) < 1e-10:
+            return {
+                "result": "π",
+                "intermediate": f"{math.pi:.13f}"
+            }
+        else:
+            return {
+                "result": f"{round(pi_multiple)}π",
+                "intermediate": f"{result:.13f}"
+            }
+
+    # その他の数値の場合
+    formatted = f"{result:.13f}".rstrip('0').rstrip('.')
+    return {
+        "result": formatted,
+        "intermediate": formatted
+    }
+
 def get_last_complete_calculation(expression):
     """最後の完全な計算部分を取得して計算"""
     try:
@@ -236,13 +1036,8 @@ def get_last_complete_calculation(expression):
         if expression and expression[-1] in '+-×÷*/.(':
             expression = expression[:-1]
 
-        # 式を標準形式に変換して計算
-        normalized = normalize_operators(expression)
         try:
-            result = eval_expression(normalized)
-            if isinstance(result, str):
-                return expression
-            return format_number(result)
+            return format_number(eval_expression(expression))
         except:
             return expression
 
@@ -251,31 +1046,30 @@ def get_last_complete_calculation(expression):
 
 def eval_expression(expression):
     try:
-        # 使用可能な文字をチェック
-        allowed = set('0123456789.+-*/() π^')  # ^を追加
-        if not all(c in allowed for c in expression):
-            raise ValueError("不正な文字が含まれています")
+        if _STATS:
+            start = perf_counter_ns()
+        lexed = lex_expression(expression)
+        node = lexed.compile()
+        # 整数のままでは大きくなりすぎるべき乗を含む式は浮動小数点で計算する
+        evaluate = evaluate_ast_float if lexed.cost() == COST_FLOAT else evaluate_ast
+        if _STATS:
+            perf_stats.record('compile', start)
+            start = perf_counter_ns()
+            result = float(evaluate(node))
+            perf_stats.record('evaluate', start)
+        else:
+            result = float(evaluate(node))
 
-        # πをmath.piに置換
-        expression = expression.replace('π', str(math.pi))
+        # 結果の検証
+        if math.isnan(result) or math.isinf(result):
+            raise ValueError("無効な計算結果です")
 
-        try:
-            # 式を価（組み込み関数へのアクセスを制限）
-            result = float(eval(expression, {"__builtins__": {}}, {}))
-            
-            # 結果の検証
-            if math.isnan(result) or math.isinf(result):
-                raise ValueError("無効な計算結果です")
-                
-            return result
-            
-        except SyntaxError:
-            return expression
-        except ZeroDivisionError:
-            raise ValueError("0での除算はできません")
-        except Exception as e:
-            raise ValueError(f"計算エラー: {str(e)}")
+        return result
 
+    except ZeroDivisionError:
+        raise ValueError("0での除算はできません")
+    except ComplexityError:
+        raise
     except Exception as e:
         raise ValueError(f"計算エラー: {str(e)}")
 
@@ -317,82 +1111,678 @@ def convert_operators(expression):
 
 def check_parentheses(expression):
     """括弧の対応をチェックする関数"""
-    stack = []
-    for char in expression:
-        if char in '（(':
-            stack.append(char)
-        elif char in '）)':
-            if not stack:
-                return False
-            stack.pop()
-    return len(stack) == 0
+    return lex_expression(expression).balanced
 
 def validate_expression(expression):
-    # 既存のバリデーションコード
-    if not expression:
-        return "式が入力されていません"
-    
-    # 括弧のチェック
-    if not check_parentheses(expression):
-        return "Error"
-    
-    # 演算子の連続チェック
-    if re.search(r'[\+\-\*\/]{2,}', expression):
-        return "演算子が連続しています"
-        
-    # sin, cos, tanの後に数字がないケースをチェック
-    trig_functions = ['sin', 'cos', 'tan']
-    for func in trig_functions:
-        if func in expression:
-            # 三角関数の後に数字または(が続いているかチェック
-            pattern = f"{func}(?![0-9\(])"
-            if re.search(pattern, expression):
-                return expression
-    
-    return None
+    """式の検証 (括弧の対応、演算子の連続、三角関数の引数)。エラーがなければ None"""
+    return lex_expression(expression).validation_error()
 
-def convert_unit(value, from_unit, to_unit):
-    """単位変換を行う関数"""
-    try:
-        value = float(value)
-        # 不要な小数点以下の0を削除する関数
-        def format_value(num):
-            return f"{num:.10f}".rstrip('0').rstrip('.')
+# 逐次評価で使う二項演算子の優先順位 (^ のみ右結合、単項マイナスは3)
+_PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, '^': 4}
+_NEG_PRECEDENCE = 3
+
+# 末尾にあるとき calculate() が取り除いて計算する演算子
+_TRAILING_OPERATORS = frozenset('+-×÷*/')
+
+# stack は (下の要素, 種類, 値, 演算子) の連結リストで、スナップショット間で共有される
+_SessionState = namedtuple(
+    '_SessionState',
+    ['stack', 'mode', 'value', 'number', 'word', 'depth', 'dirty', 'has_trig']
+)
+_INITIAL_SESSION_STATE = _SessionState(None, 'start', None, '', '', 0, False, False)
+
+def _parse_number(text):
+    if text == '.' or text.count('.') > 1:
+        raise ValueError(f"数値の形式が不正です: {text}")
+    return float(text) if '.' in text else int(text)
+
+def _checked_power(base, exponent):
+    # 整数のべき乗は値の大きさを見積もってから計算する (大きすぎれば calculate() に任せる)
+    if (isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and base not in (-1, 0, 1)
+            and math.log2(abs(base)) * exponent > MAX_INTEGER_BITS):
+        raise ComplexityError("べき乗の結果が大きすぎます")
+    return base ** exponent
+
+def _apply_stack_node(node, value):
+    if node[1] == 'bin':
+        if node[3] == '^':
+            return _checked_power(node[2], value)
+        return _BINARY_OPS[node[3]](node[2], value)
+    return -value
+
+def _fold_stack(stack, value):
+    """未確定の演算子をすべて適用して式全体の値を求める"""
+    while stack is not None:
+        value = _apply_stack_node(stack, value)
+        stack = stack[0]
+    return value
+
+def _take_operand(state):
+    """入力中の数値または確定済みの値を取り出す (三角関数の引数なら適用する)"""
+    if state.mode == 'value':
+        return state.value, state.stack
+    value = _parse_number(state.number)
+    stack = state.stack
+    if stack is not None and stack[1] == 'func':
+        return _evaluate_trig(stack[3], value), stack[0]
+    return value, stack
+
+def _push_operator(state, op):
+    value, stack = _take_operand(state)
+    precedence = _PRECEDENCE[op]
+    while stack is not None:
+        kind = stack[1]
+        if kind == 'bin':
+            top_precedence = _PRECEDENCE[stack[3]]
+        elif kind == 'neg':
+            top_precedence = _NEG_PRECEDENCE
+        else:
+            break
+        if top_precedence < precedence or (top_precedence == precedence and op == '^'):
+            break
+        value = _apply_stack_node(stack, value)
+        stack = stack[0]
+    return state._replace(stack=(stack, 'bin', value, op), mode='start', value=None, number='')
+
+def _advance_session(state, char):
+    """1文字分だけ解析状態を進める"""
+    mode = state.mode
+    if mode == 'word':
+        word = state.word + char
+        if word in TRIG_FUNCTIONS:
+            return state._replace(stack=(state.stack, 'func', None, word), mode='func', word='', has_trig=True)
+        if not any(func.startswith(word) for func in TRIG_FUNCTIONS):
+            raise ValueError("不正な文字が含まれています")
+        return state._replace(word=word)
+
+    operand_ready = mode in ('number', 'value')
+    if mode == 'func' and char not in '0123456789(':
+        raise ValueError("三角関数の後に数値または括弧が必要です")
+    if char in _NUMBER_CHARS:
+        if mode == 'number':
+            return state._replace(number=state.number + char)
+        if operand_ready:
+            state = _push_operator(state, '*')
+        return state._replace(mode='number', number=char)
+    if char == 'π':
+        if operand_ready:
+            state = _push_operator(state, '*')
+        return state._replace(mode='value', value=math.pi)
+    if char == '(':
+        if operand_ready:
+            state = _push_operator(state, '*')
+        return state._replace(stack=(state.stack, 'lparen', None, None), mode='start', depth=state.depth + 1)
+    if char == ')':
+        if not operand_ready or state.depth == 0:
+            raise ValueError("括弧の対応が不正です")
+        value, stack = _take_operand(state)
+        while stack[1] != 'lparen':
+            value = _apply_stack_node(stack, value)
+            stack = stack[0]
+        stack = stack[0]
+        if stack is not None and stack[1] == 'func':
+            value = _evaluate_trig(stack[3], value)
+            stack = stack[0]
+        return state._replace(stack=stack, mode='value', value=value, number='', depth=state.depth - 1)
+    if char in _PRECEDENCE:
+        if operand_ready:
+            return _push_operator(state, char)
+        # 先頭または括弧直後のマイナスのみ単項演算子として扱う
+        if char == '-' and mode == 'start' and (state.stack is None or state.stack[1] == 'lparen'):
+            return state._replace(stack=(state.stack, 'neg', None, None))
+        raise ValueError("演算子が連続しています")
+    if char.isalpha():
+        if operand_ready:
+            state = _push_operator(state, '*')
+        return _advance_session(state._replace(mode='word', word=''), char)
+    raise ValueError("不正な文字が含まれています")
+
+def _checked_float(value):
+    result = float(value)
+    if math.isnan(result) or math.isinf(result):
+        raise ValueError("無効な計算結果です")
+    return result
+
+class CalculationSession:
+    """キー入力の差分を受け取り、確定済み部分の解析状態を保持して式を逐次評価する
+
+    1文字ごとに解析状態のスナップショットを残すため、追加・削除のどちらも
+    式全体の長さではなく変更した文字数に比例する時間で処理できる。
+    エラー表示など逐次処理で扱わない状態では calculate() にフォールバックする。
+    """
 
-        # 長さの変換
-        if (from_unit == 'm' and to_unit == 'mm'):
-            result = value * 1000
+    def __init__(self):
+        self.clear()
+
+    @property
+    def text(self):
+        return ''.join(self._chars)
+
+    def clear(self):
+        self._chars = []
+        self._states = [_INITIAL_SESSION_STATE]
+
+    def append(self, text):
+        for char in text:
+            state = self._states[-1]
+            if not state.dirty:
+                normalized = char.translate(_OPERATOR_TABLE)
+                try:
+                    if len(normalized) != 1:
+                        raise ValueError("空白は逐次評価できません")
+                    if state.mode == 'func' and normalized != char:
+                        # 全角括弧は三角関数の引数として扱わない
+                        raise ValueError("三角関数の後に数値または括弧が必要です")
+                    state = _advance_session(state, normalized)
+                except Exception:
+                    state = state._replace(dirty=True)
+            self._chars.append(char)
+            self._states.append(state)
+
+    def backspace(self, count=1):
+        count = min(count, len(self._chars))
+        if count > 0:
+            del self._chars[-count:]
+            del self._states[-count:]
+
+    def set(self, text):
+        self.clear()
+        self.append(text)
+
+    def result(self):
+        """現在の式に対する calculate() と同じ形式の結果を返す"""
+        state = self._states[-1]
+        if self._chars and not state.dirty:
+            try:
+                fast_result = self._fast_result(state)
+            except Exception:
+                fast_result = None
+            if fast_result is not None:
+                return fast_result
+        return calculate(self.text)
+
+    def _fast_result(self, state):
+        mode = state.mode
+        if mode == 'func':
+            if state.depth > 0:
+                return None
+            # 三角関数の後に引数がない
             return {
-                "result": format_value(result),
-                "intermediate": f"{format_value(value)}×1000={format_value(result)}"
+                "result": self.text,
+                "intermediate": "Error"
             }
-        elif (from_unit == 'mm' and to_unit == 'm'):
-            result = value / 1000
+        if state.depth > 0:
+            # 括弧が閉じられていない場合は calculate() と同じくエラー表示
             return {
-                "result": format_value(result),
-                "intermediate": f"{format_value(value)}÷1000={format_value(result)}"
+                "result": "Error" if state.has_trig else self.text,
+                "intermediate": "Error"
             }
-        # 面積の変換
-        elif (from_unit == 'm2' and to_unit == 'mm2'):
-            result = value * 1000000
+        if mode == 'word':
+            # 入力途中の関数名は不正な文字として扱う
+            return {"error": "Error"}
+        if mode == 'number' and state.number.endswith('.'):
+            # 末尾の小数点は取り除いて計算
+            state = state._replace(number=state.number[:-1])
+            if not state.number:
+                return None
+            value, stack = _take_operand(state)
+            formatted = format_number(_checked_float(_fold_stack(stack, value)))
             return {
-                "result": format_value(result),
-                "intermediate": f"{format_value(value)}×1000000={format_value(result)}"
+                "result": formatted,
+                "intermediate": formatted
             }
-        elif (from_unit == 'mm2' and to_unit == 'm2'):
-            result = value / 1000000
+        if mode == 'number' or mode == 'value':
+            value, stack = _take_operand(state)
+            return format_calculation(_checked_float(_fold_stack(stack, value)))
+        top = state.stack
+        if mode == 'start' and self._chars[-1] in _TRAILING_OPERATORS and top is not None and top[1] == 'bin':
+            # 末尾の演算子を無視して計算
+            formatted = format_number(_checked_float(_fold_stack(top[0], top[2])))
             return {
-                "result": format_value(result),
-                "intermediate": f"{format_value(value)}÷1000000={format_value(result)}"
+                "result": formatted,
+                "intermediate": formatted
             }
-        else:
-            return {"error": "未対応の単位変換です"}
+        return None
+
+# セッション名ごとの逐次評価セッション
+_sessions = {}
+
+def handle_session_command(data):
+    """逐次評価セッションへの差分 (append / backspace / clear / set) を処理"""
+    session = _sessions.setdefault(data.get('session', 'default'), CalculationSession())
+    action = data.get('action')
+    if action == 'append':
+        session.append(str(data.get('text', '')))
+    elif action == 'backspace':
+        session.backspace(int(data.get('count', 1)))
+    elif action == 'clear':
+        session.clear()
+        return {"result": "", "intermediate": ""}
+    elif action == 'set':
+        session.set(str(data.get('text', '')))
+    else:
+        return {"error": "未対応のセッション操作です"}
+    return session.result()
+
+def convert_unit(value, from_unit, to_unit):
+    """単位変換を行う関数"""
+    try:
+        value = float(value)
+        # 換算係数は units.py の表から1回の参照で取得
+        result, intermediate = units.convert(value, from_unit, to_unit)
+        return {
+            "result": units.format_unit_value(result),
+            "intermediate": intermediate
+        }
+    except units.UnitError as e:
+        return {"error": str(e)}
     except ValueError:
         return {"error": "無効な数値です"}
     except Exception as e:
         return {"error": str(e)}
 
+def convert_unit_array(values, from_unit, to_unit, format_values=True):
+    """値の配列をまとめて単位変換する"""
+    try:
+        results = units.convert_array(values, from_unit, to_unit)
+    except units.UnitError as e:
+        return {"error": str(e)}
+    except (TypeError, ValueError):
+        return {"error": "無効な数値です"}
+    results = results.tolist() if hasattr(results, 'tolist') else results
+    if format_values:
+        return {"results": [units.format_unit_value(result) for result in results]}
+    return {"values": results}
+
+# 計算履歴ストア (None: 未作成, False: 無効)
+_history = None
+
+def get_history_store():
+    """計算履歴ストアを返す (環境変数 CALCULATOR_HISTORY=0 で無効)"""
+    global _history
+    if _history is None:
+        if os.environ.get('CALCULATOR_HISTORY', '1') == '0':
+            _history = False
+        else:
+            try:
+                _history = history_store.HistoryStore()
+            except Exception as e:
+                print(f"履歴を開けませんでした: {e}", file=sys.stderr)
+                _history = False
+    return _history
+
+def record_history(expression, result, mode='float'):
+    """計算結果を履歴に追加 (書き込みはバックグラウンドで行われる)"""
+    store = get_history_store()
+    if store and 'error' not in result:
+        store.append(str(expression).strip(), result, mode)
+
+def handle_history_command(data):
+    """履歴の参照・検索・再計算"""
+    store = get_history_store()
+    if not store:
+        return {"error": "履歴が無効です"}
+    command = data.get('command')
+    limit = int(data.get('limit', history_store.DEFAULT_PAGE_SIZE))
+    offset = int(data.get('offset', 0))
+    if command == 'history_page':
+        return {"entries": store.page(limit, data.get('before_id'), offset)}
+    if command == 'history_search':
+        text = str(data.get('text', ''))
+        if data.get('prefix'):
+            return {"entries": store.search_prefix(text, limit, offset)}
+        return {"entries": store.search(text, limit, offset)}
+    if command == 'history_recompute':
+        entry = store.get(data.get('history_id'))
+        if entry is None:
+            return {"error": "履歴が見つかりません"}
+        result = calculate(entry['expression'], entry['mode'])
+        record_history(entry['expression'], result, entry['mode'])
+        return {**result, "expression": entry['expression']}
+    return None
+
+def dispatch_command(data):
+    """JSONリクエストをコマンドごとの処理に振り分ける (対象外ならNone)"""
+    command = data.get('command')
+    if command == 'convert_unit':
+        # 単位変換の処理
+        return convert_unit(
+            data.get('value'),
+            data.get('from_unit'),
+            data.get('to_unit')
+        )
+    if command == 'convert_unit_array':
+        # 値の配列の一括単位変換
+        return convert_unit_array(
+            data.get('values') or [],
+            data.get('from_unit'),
+            data.get('to_unit'),
+            data.get('format', True)
+        )
+    if command == 'session':
+        # キー入力ごとの差分による逐次計算
+        return handle_session_command(data)
+    if command == 'evaluate_array':
+        # 変数の配列に対する一括評価
+        return evaluate_array_command(data)
+    if command == 'batch':
+        # 複数の式・単位変換をまとめて処理
+        return {"results": calculate_batch(data.get('items') or [], data.get('mode', 'float'))}
+    if command == 'hello':
+        # プロトコルのバージョン確認
+        return {"protocol": PROTOCOL_VERSION}
+    if command == 'stats':
+        stats = collect_stats()
+        if data.get('reset'):
+            perf_stats.reset()
+        return stats
+    if command in ('history_page', 'history_search', 'history_recompute'):
+        return handle_history_command(data)
+    if command is None and 'expression' in data:
+        mode = data.get('mode', 'float')
+        result = calculate(data['expression'], mode)
+        # 入力途中の評価は記録せず、確定 (=) のときに付く record だけを履歴に残す
+        if data.get('record'):
+            record_history(data['expression'], result, mode)
+        return result
+    return None
+
+def calculate_batch(items, mode='float'):
+    """式 (文字列) やコマンド (dict) のリストを順に処理し、結果を同じ順で返す"""
+    results = []
+    for item in items:
+        try:
+            if isinstance(item, dict):
+                result = dispatch_command(item)
+                if result is None:
+                    result = {"error": "未対応のコマンドです"}
+            else:
+                result = calculate(item, mode)
+        except Exception as e:
+            # 1件のエラーで全体を止めない
+            result = {"error": str(e)}
+        results.append(result)
+    return results
+
+def handle_tagged_request(data):
+    """idつきのリクエストを処理し、idとバージョンを付けた応答を返す"""
+    try:
+        result = dispatch_command(data)
+        if result is None:
+            result = {"error": "未対応のコマンドです"}
+    except Exception as e:
+        result = {"error": str(e)}
+    return {**result, "id": data["id"], "v": PROTOCOL_VERSION}
+
+def _cache_stats(cached_function):
+    info = cached_function.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "hit_rate": round(info.hits / lookups, 4) if lookups else None
+    }
+
+def collect_stats():
+    """処理段階ごとの遅延、キャッシュのヒット率、処理待ちの件数をまとめる"""
+    return {
+        "enabled": _STATS,
+        "stages": perf_stats.snapshot(),
+        "caches": {
+            "compile": _cache_stats(lex_expression),
+            "exact_integer": _cache_stats(_is_integer_ast),
+            "unit_parse": _cache_stats(units.parse_unit),
+            "unit_compound": _cache_stats(units._compound_conversion)
+        },
+        "queue_depth": perf_stats.queue_depth.summary(),
+        "sessions": len(_sessions),
+        "profile": perf_stats.profile_summary()
+    }
+
+def handle_untagged_request(line, data):
+    """idなしのリクエスト (従来形式) を処理"""
+    result = dispatch_command(data) if isinstance(data, dict) else None
+    if result is None:
+        # JSON以外や対象外のリクエストは通常の計算として処理
+        result = calculate(line)
+    return result
+
+# 別プロセスで実行するコマンド (CPU負荷が高く、イベントループを止めないようにする)
+# 別プロセスでは親の構文解析のキャッシュ・クライアントのセッション・履歴を使わないため、
+# これらのコマンド (batch の各項目を含む) は状態を持たない処理として扱い、record も履歴に残らない
+_SERVER_BATCH_COMMANDS = ('batch', 'evaluate_array', 'convert_unit_array')
+
+def _init_batch_process():
+    # 一括処理のプロセスからは履歴を開かない (書き込みは親プロセスだけが行う)
+    global _history
+    _history = False
+
+def default_socket_path():
+    """サーバーモードの既定のUnixドメインソケット"""
+    user = os.environ.get('USER') or os.environ.get('USERNAME') or 'user'
+    return os.path.join(tempfile.gettempdir(), f'calculator-{user}.sock')
+
+class CalculatorServer:
+    """JSON行プロトコルを複数のクライアントに提供する常駐サーバー
+
+    構文解析のキャッシュはすべてのクライアントで共有する。
+    """
+
+    def __init__(self):
+        self._clients = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS)
+        self._batch_executor = None
+        # 接続中のクライアントの処理と、その読み込み側 (終了時に新しいリクエストの受け付けを止める)
+        self._handlers = set()
+        self._readers = {}
+
+    def _get_batch_executor(self):
+        if self._batch_executor is None:
+            self._batch_executor = ProcessPoolExecutor(max_workers=SERVER_BATCH_WORKERS, initializer=_init_batch_process)
+        return self._batch_executor
+
+    async def handle_client(self, reader, writer):
+        client = next(self._clients)
+        loop = asyncio.get_running_loop()
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        self._readers[handler] = (reader, writer)
+        session_keys = set()
+        tasks = set()
+        # hello で長さ付きフレームに切り替えた後の形式 (None はJSON行)
+        codec = None
+
+        def write_response(result):
+            if codec is None:
+                writer.write((json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8'))
+            else:
+                writer.write(framing.encode_frame(codec, result))
+
+        async def process_tagged_request(data):
+            executor = self._get_batch_executor() if data.get('command') in _SERVER_BATCH_COMMANDS else self._executor
+            perf_stats.queue_depth.enter()
+            try:
+                result = await loop.run_in_executor(executor, perf_stats.profile_call, handle_tagged_request, data)
+            except Exception as e:
+                result = {"error": str(e), "id": data["id"], "v": PROTOCOL_VERSION}
+            finally:
+                perf_stats.queue_depth.leave()
+            write_response(result)
+            await writer.drain()
+
+        try:
+            while True:
+                if codec is not None:
+                    try:
+                        header = await reader.readexactly(framing.FRAME_HEADER.size)
+                        data = codec.decode(await reader.readexactly(framing.frame_size(header)))
+                    except asyncio.IncompleteReadError:
+                        break
+                    except framing.FramingError as e:
+                        write_response({"error": str(e)})
+                        break
+                    except Exception as e:
+                        write_response({"error": str(e)})
+                        await writer.drain()
+                        continue
+                    line = data.get('expression', '') if isinstance(data, dict) else str(data)
+                else:
+                    try:
+                        raw_line = await reader.readline()
+                    except ValueError:
+                        write_response({"error": "リクエストが大きすぎます"})
+                        break
+                    if not raw_line:
+                        break
+                    line = raw_line.decode('utf-8', errors='replace').strip()
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        data = None
+
+                if isinstance(data, dict) and data.get('command') == 'hello' and 'framing' in data:
+                    # 応答の行までがJSON行で、以降は双方向ともフレーム
+                    result = handle_tagged_request(data) if 'id' in data else handle_untagged_request(line, data)
+                    selected = framing.negotiate(data['framing'])
+                    write_response({**result, **framing.hello_fields(selected)})
+                    codec = selected
+                    await writer.drain()
+                    continue
+
+                if isinstance(data, dict) and data.get('command') == 'session':
+                    # セッション名はクライアントごとに分ける
+                    key = f"{client}:{data.get('session', 'default')}"
+                    session_keys.add(key)
+                    data = {**data, 'session': key}
+
+                if isinstance(data, dict) and 'id' in data:
+                    if data.get('command') == 'session':
+                        # セッションは入力順に適用する (1回の処理は短いのでイベントループ上で実行)
+                        write_response(handle_tagged_request(data))
+                    else:
+                        task = asyncio.create_task(process_tagged_request(data))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                        continue
+                else:
+                    # idなしのリクエストは従来どおり順番に応答する
+                    write_response(await loop.run_in_executor(self._executor, handle_untagged_request, line, data))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for key in session_keys:
+                _sessions.pop(key, None)
+            writer.close()
+            self._handlers.discard(handler)
+            self._readers.pop(handler, None)
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        """Unixドメインソケット (既定) またはlocalhostのTCPで待ち受ける"""
+        if port is None and hasattr(asyncio, 'start_unix_server'):
+            socket_path = socket_path or default_socket_path()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = await asyncio.start_unix_server(self.handle_client, socket_path, limit=SERVER_LINE_LIMIT)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(
+                self.handle_client, host, DEFAULT_SERVER_PORT if port is None else port, limit=SERVER_LINE_LIMIT
+            )
+            address = "%s:%d" % server.sockets[0].getsockname()[:2]
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows のイベントループにはシグナルのハンドラーを登録できない
+                signal.signal(signum, lambda signum, frame: loop.call_soon_threadsafe(stop.set))
+        # 起動したことを呼び出し元に知らせる
+        print(json.dumps({"status": "listening", "address": address, "v": PROTOCOL_VERSION}, ensure_ascii=False))
+        sys.stdout.flush()
+        try:
+            await stop.wait()
+            await self.shutdown(server)
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+    async def shutdown(self, server):
+        """待ち受けを閉じ、処理中のリクエストに応答してからクライアントとの接続を閉じる"""
+        server.close()
+        for reader, writer in list(self._readers.values()):
+            # 以降のリクエストは読まず、読み込み済みの分を処理したら終了させる
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        if self._handlers:
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+        await server.wait_closed()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._batch_executor is not None:
+            self._batch_executor.shutdown(wait=False)
+
+def run_server(socket_path=None, port=None):
+    """サーバーモードで起動"""
+    server = CalculatorServer()
+    # 終了シグナル (SIGTERM / SIGINT) は serve() が受け取り、ソケットファイルを削除して終了する
+    try:
+        asyncio.run(server.serve(socket_path, port=port))
+    finally:
+        server.close()
+        perf_stats.dump_profile()
+        if _history:
+            _history.close()
+
+def arm_cpu_limit():
+    """これまでのCPU使用時間に CPU_LIMIT を足した値を上限にする (超えるとカーネルが SIGXCPU で終了させる)
+
+    上限はプロセス全体にかかるため、上限を設定したプロセスではリクエストを1件ずつ処理し、
+    処理を始めるたびに呼ぶ。
+    """
+    if resource is None or CPU_LIMIT <= 0:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime + CPU_LIMIT)
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    except (ValueError, OSError):
+        pass
+
+def _disable_core_dump():
+    # CPU時間の上限で終了したときにコアファイルを残さない
+    soft, hard = resource.getrlimit(resource.RLIMIT_CORE)
+    try:
+        resource.setrlimit(resource.RLIMIT_CORE, (0, hard))
+    except (ValueError, OSError):
+        pass
+
 def main():
+    parser = argparse.ArgumentParser(description="計算エンジン (標準入出力またはサーバーモード)")
+    parser.add_argument('--serve', action='store_true', help="ソケットで待ち受けるサーバーモードで起動")
+    parser.add_argument('--socket', help="Unixドメインソケットのパス")
+    parser.add_argument('--port', type=int, help="localhostのTCPポート (指定時はTCPで待ち受け)")
+    args = parser.parse_args()
+    if args.serve:
+        run_server(args.socket, args.port)
+        return
+
+    if resource is not None and CPU_LIMIT > 0:
+        _disable_core_dump()
+
+    # 応答はバイト列で書き込む (hello で長さ付きフレームに切り替えられる)
+    channel = framing.Channel(sys.stdin.buffer, sys.stdout.buffer)
+
     # 標準出力と標準エラー出力をUTF-8に設定
     if sys.platform == 'win32':
         sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
@@ -401,37 +1791,88 @@ def main():
         sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer)
         sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer)
 
+    def write_response(result):
+        if _STATS:
+            start = perf_counter_ns()
+        # 複数のスレッドから応答が書き込まれるため、Channel が1件ずつ排他的に出力する
+        channel.write(result)
+        if _STATS:
+            perf_stats.record('write', start)
+
+    def process_tagged_request(data):
+        try:
+            arm_cpu_limit()
+            if _STATS:
+                start = perf_counter_ns()
+            write_response(perf_stats.profile_call(handle_tagged_request, data))
+            if _STATS:
+                perf_stats.record('request', start)
+        finally:
+            perf_stats.queue_depth.leave()
+
+    # idつきのリクエストは終わった順に応答する
+    executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS)
+    # CPU時間の上限があるプロセス (worker_pool の計算プロセス) は1件ずつ処理する。負荷はプールが複数のプロセスに分散する
+    serial = resource is not None and CPU_LIMIT > 0
+
     while True:
         try:
-            # 標準入力から式を読み込む（UTF-8として）
-            line = sys.stdin.buffer.readline().decode('utf-8').strip()
-            if not line:
+            # 標準入力から式を読み込む（UTF-8の行、またはフレーム）
+            message = channel.read()
+            if message is None:
+                # 標準入力が閉じられたら終了
+                break
+            if _STATS:
+                start = perf_counter_ns()
+            if channel.framed:
+                data = message
+                line = data.get('expression', '') if isinstance(data, dict) else str(data)
+            else:
+                line = message
+                if not line:
+                    continue
+                try:
+                    # JSONとしてパースを試みる
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    data = None
+            if _STATS:
+                perf_stats.record('read', start)
+
+            if isinstance(data, dict) and data.get('command') == 'hello' and 'framing' in data:
+                # 形式の切り替えは応答の直後に行うため読み込みスレッドで処理
+                result = handle_tagged_request(data) if 'id' in data else handle_untagged_request(line, data)
+                channel.reply_hello(result, framing.negotiate(data['framing']))
                 continue
 
-            try:
-                # JSONとしてパースを試みる
-                data = json.loads(line)
-                if isinstance(data, dict) and data.get('command') == 'convert_unit':
-                    # 単位変換の処理
-                    result = convert_unit(
-                        data.get('value'),
-                        data.get('from_unit'),
-                        data.get('to_unit')
-                    )
+            if isinstance(data, dict) and 'id' in data:
+                perf_stats.queue_depth.enter()
+                if serial or data.get('command') == 'session':
+                    # セッションは入力順に適用する必要があるため読み込みスレッドで処理
+                    process_tagged_request(data)
                 else:
-                    # 通常の計算処理
-                    result = calculate(line)
-            except json.JSONDecodeError:
-                # JSON解析に失敗した場合は通常の計算として処理
-                result = calculate(line)
-            
+                    executor.submit(process_tagged_request, data)
+                continue
+
             # 結果を出力
-            print(json.dumps(result, ensure_ascii=False))
-            sys.stdout.flush()
+            arm_cpu_limit()
+            if _STATS:
+                start = perf_counter_ns()
+            write_response(perf_stats.profile_call(handle_untagged_request, line, data))
+            if _STATS:
+                perf_stats.record('request', start)
 
+        except framing.FramingError as e:
+            # フレームの境界が分からなくなるため続けられない
+            write_response({"error": str(e)})
+            break
         except Exception as e:
-            print(json.dumps({"error": str(e)}, ensure_ascii=False))
-            sys.stdout.flush()
+            write_response({"error": str(e)})
+
+    executor.shutdown(wait=True)
+    perf_stats.dump_profile()
+    if _history:
+        _history.close()
 
 if __name__ == "__main__":
     main()
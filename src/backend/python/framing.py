@@ -0,0 +1,341 @@
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# フレームの先頭に置くペイロードの長さ (ビッグエンディアンの符号なし32bit)
+FRAME_HEADER = struct.Struct('>I')
+
+# 1フレームの上限 (これを超える長さは壊れたストリームとして扱う)
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+# 既定の形式 (改行区切りのJSON)
+JSON_LINES = 'json'
+
+class FramingError(ValueError):
+    """フレームが壊れている、または途中で切れている"""
+
+def _json_default(value):
+    # JSON行ではバイト列を従来どおりBase64の文字列にする
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"JSONに変換できない値です: {type(value).__name__}")
+
+class JsonCodec:
+    """従来のJSON (比較用。フレームの中身としても使える)"""
+    name = JSON_LINES
+
+    def encode(self, message):
+        return json.dumps(message, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class CborCodec:
+    name = 'cbor'
+
+    def encode(self, message):
+        return cbor2.dumps(message)
+
+    def decode(self, data):
+        return cbor2.loads(bytes(data))
+
+# struct 形式の型タグ
+_NONE, _TRUE, _FALSE, _INT, _BIGINT, _FLOAT, _STR, _BYTES, _LIST, _DICT = b'NTFiIdsblm'
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+_LENGTH = struct.Struct('>I')
+
+class StructCodec:
+    """追加のパッケージなしで使う型タグ付きのバイナリ形式 (msgpack / CBOR がない環境向け)"""
+    name = 'struct'
+
+    def encode(self, message):
+        out = bytearray()
+        self._encode(message, out)
+        return bytes(out)
+
+    def _encode(self, value, out):
+        if value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif isinstance(value, int):
+            if -2 ** 63 <= value < 2 ** 63:
+                out.append(_INT)
+                out += _INT64.pack(value)
+            else:
+                # 厳密計算の大きな整数は10進の文字列で送る
+                self._encode_sized(_BIGINT, str(value).encode('ascii'), out)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _FLOAT64.pack(value)
+        elif isinstance(value, str):
+            self._encode_sized(_STR, value.encode('utf-8'), out)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._encode_sized(_BYTES, value, out)
+        elif isinstance(value, (list, tuple)):
+            out.append(_LIST)
+            out += _LENGTH.pack(len(value))
+            for item in value:
+                self._encode(item, out)
+        elif isinstance(value, dict):
+            out.append(_DICT)
+            out += _LENGTH.pack(len(value))
+            for key, item in value.items():
+                self._encode(key, out)
+                self._encode(item, out)
+        else:
+            raise TypeError(f"変換できない値です: {type(value).__name__}")
+
+    @staticmethod
+    def _encode_sized(tag, data, out):
+        out.append(tag)
+        out += _LENGTH.pack(len(data))
+        out += data
+
+    def decode(self, data):
+        view = memoryview(data)
+        try:
+            value, offset = self._decode(view, 0)
+        except (IndexError, struct.error) as e:
+            raise ValueError("struct 形式のデータが途中で切れています") from e
+        if offset != len(view):
+            raise ValueError("struct 形式のデータの後に余分なバイトがあります")
+        return value
+
+    def _decode(self, view, offset):
+        tag = view[offset]
+        offset += 1
+        if tag == _NONE:
+            return None, offset
+        if tag == _TRUE:
+            return True, offset
+        if tag == _FALSE:
+            return False, offset
+        if tag == _INT:
+            return _INT64.unpack_from(view, offset)[0], offset + _INT64.size
+        if tag == _FLOAT:
+            return _FLOAT64.unpack_from(view, offset)[0], offset + _FLOAT64.size
+        if tag in (_STR, _BYTES, _BIGINT):
+            size = _LENGTH.unpack_from(view, offset)[0]
+            offset += _LENGTH.size
+            if offset + size > len(view):
+                raise ValueError("struct 形式のデータが途中で切れています")
+            chunk = view[offset:offset + size]
+            if tag == _STR:
+                value = str(chunk, 'utf-8')
+            elif tag == _BYTES:
+                value = chunk.tobytes()
+            else:
+                value = int(str(chunk, 'ascii'))
+            return value, offset + size
+        if tag in (_LIST, _DICT):
+            count = _LENGTH.unpack_from(view, offset)[0]
+            offset += _LENGTH.size
+            if tag == _LIST:
+                items = []
+                for _ in range(count):
+                    item, offset = self._decode(view, offset)
+                    items.append(item)
+                return items, offset
+            mapping = {}
+            for _ in range(count):
+                key, offset = self._decode(view, offset)
+                mapping[key], offset = self._decode(view, offset)
+            return mapping, offset
+        raise ValueError(f"不明な型タグです: {tag}")
+
+# 優先順 (クライアントが順序を指定しなかった場合もこの順に選ぶ)
+CODECS = [codec for codec, available in (
+    (MsgpackCodec, msgpack is not None),
+    (CborCodec, cbor2 is not None),
+    (StructCodec, True),
+) if available]
+
+def available_formats():
+    """この環境で使えるフレーム形式の名前 (優先順)"""
+    return [codec.name for codec in CODECS]
+
+def negotiate(requested):
+    """hello の framing (形式名またはその配列) から使う形式を選ぶ。使えるものがなければ None (JSON行のまま)"""
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, (list, tuple)):
+        return None
+    codecs = {codec.name: codec for codec in CODECS}
+    for name in requested:
+        if name in codecs:
+            return codecs[name]()
+    return None
+
+def hello_fields(codec):
+    """hello の応答に加える項目"""
+    return {"framing": codec.name if codec else JSON_LINES, "formats": available_formats()}
+
+def encode_frame(codec, message):
+    """長さ付きのフレーム (ヘッダーとペイロード) にする"""
+    payload = codec.encode(message)
+    if len(payload) > MAX_FRAME_BYTES:
+        # ストリームは壊れていないため FramingError にはしない
+        raise ValueError("フレームが大きすぎます")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def frame_size(header):
+    """フレームのヘッダーからペイロードの長さを取り出す"""
+    size = FRAME_HEADER.unpack(header)[0]
+    if size > MAX_FRAME_BYTES:
+        raise FramingError("フレームが大きすぎます")
+    return size
+
+def _read_exactly(reader, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = reader.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class Channel:
+    """バイト列の入出力の上で、JSON行 (既定) と長さ付きフレームを切り替えて読み書きする
+
+    hello で形式が決まったら、その応答の行を最後に双方向ともフレームになる。
+    応答待ちのリクエストがあるとその応答もフレームで届くため、hello は最初に送る。
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = None
+        self.lock = threading.Lock()
+
+    @property
+    def framed(self):
+        return self.codec is not None
+
+    def read(self):
+        """次のメッセージ。JSON行では改行を除いた文字列、フレームでは復号した値。終端なら None"""
+        if self.codec is None:
+            line = self.reader.readline()
+            if not line:
+                return None
+            return line.decode('utf-8').strip()
+        header = _read_exactly(self.reader, FRAME_HEADER.size)
+        if not header:
+            return None
+        if len(header) < FRAME_HEADER.size:
+            raise FramingError("フレームのヘッダーが途中で切れています")
+        size = frame_size(header)
+        payload = _read_exactly(self.reader, size)
+        if len(payload) < size:
+            raise FramingError("フレームが途中で切れています")
+        return self.codec.decode(payload)
+
+    def encode(self, message):
+        if self.codec is None:
+            return (json.dumps(message, ensure_ascii=False, default=_json_default) + '\n').encode('utf-8')
+        return encode_frame(self.codec, message)
+
+    def write(self, message):
+        with self.lock:
+            self._write(self.encode(message))
+
+    def reply_hello(self, message, codec):
+        """hello の応答をJSON行で書き、以降をフレームに切り替える (途中で他の応答が割り込まない)"""
+        with self.lock:
+            self._write(self.encode({**message, **hello_fields(codec)}))
+            self.codec = codec
+
+    def _write(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+
+# ベンチマークの対象 (JSONは従来の経路)
+BENCH_CODECS = [JsonCodec] + CODECS
+
+def sample_messages(results=1000, image_bytes=1024 * 1024):
+    """一括計算の応答と、エンコード済み画像をそのまま載せたスクリーンショットの応答"""
+    rng = random.Random(0)
+    batch = {
+        "results": [
+            {"result": str(index * 7 / 3), "intermediate": f"{index}×7÷3", "mode": "float"}
+            for index in range(results)
+        ],
+        "id": 1,
+        "v": 1,
+    }
+    screenshot = {
+        "status": "success",
+        "type": "image/png",
+        "width": 1920,
+        "height": 1080,
+        # PNGは圧縮済みなので乱数のバイト列で代用する
+        "data": rng.randbytes(image_bytes),
+        "id": 2,
+    }
+    return {"batch": batch, "screenshot": screenshot}
+
+def _best_us(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1e6, 1)
+
+def bench(repeat=20, results=1000, image_bytes=1024 * 1024):
+    """形式ごとの大きさと、フレーム化込みのエンコード・デコード時間"""
+    report = {}
+    for name, message in sample_messages(results, image_bytes).items():
+        rows = {}
+        for codec_class in BENCH_CODECS:
+            codec = codec_class()
+            frame = encode_frame(codec, message)
+            rows[codec.name] = {
+                "bytes": len(frame),
+                "encode_us": _best_us(lambda: encode_frame(codec, message), repeat),
+                "decode_us": _best_us(lambda: codec.decode(memoryview(frame)[FRAME_HEADER.size:]), repeat),
+            }
+        report[name] = rows
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="バックエンドのプロトコルの形式 (JSON行と長さ付きフレーム) の比較")
+    parser.add_argument('--repeat', type=int, default=20, help="計測の繰り返し回数 (最短時間を採用)")
+    parser.add_argument('--results', type=int, default=1000, help="一括計算の応答に含める結果の数")
+    parser.add_argument('--image-bytes', type=int, default=1024 * 1024, help="画像データの大きさ (バイト)")
+    args = parser.parse_args()
+    print(json.dumps({
+        "formats": available_formats(),
+        "report": bench(args.repeat, args.results, args.image_bytes),
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# 1回のトランザクションでまとめて書き込む最大件数
+WRITE_BATCH_SIZE = 512
+
+# 1ページあたりの既定件数
+DEFAULT_PAGE_SIZE = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    expression TEXT NOT NULL,
+    result TEXT,
+    intermediate TEXT,
+    mode TEXT NOT NULL DEFAULT 'float'
+);
+CREATE INDEX IF NOT EXISTS history_expression ON history(expression);
+"""
+
+# 部分一致検索用の全文検索インデックス (trigramで式の途中の文字列にも一致させる)
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    expression, result, content='history', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts(rowid, expression, result) VALUES (new.id, new.expression, new.result);
+END;
+"""
+
+_COLUMNS = "id, created_at, expression, result, intermediate, mode"
+_JOINED_COLUMNS = ", ".join(f"history.{column}" for column in _COLUMNS.split(", "))
+
+def default_history_path():
+    """履歴ファイルの既定の保存先"""
+    if os.environ.get('CALCULATOR_HISTORY_PATH'):
+        return Path(os.environ['CALCULATOR_HISTORY_PATH'])
+    base = os.environ.get('APPDATA') or Path.home() / '.config'
+    return Path(base) / 'calculator' / 'history.db'
+
+def _row_to_entry(row):
+    return {
+        "id": row[0],
+        "created_at": row[1],
+        "expression": row[2],
+        "result": row[3],
+        "intermediate": row[4],
+        "mode": row[5]
+    }
+
+class HistoryStore:
+    """計算履歴をSQLite (WALモード) に保存する
+
+    append() はキューに積むだけで、書き込みは専用スレッドがまとめて行う。
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else default_history_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._queue = queue.Queue()
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self.full_text = self._create_schema(self._reader)
+        self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _create_schema(self, connection):
+        connection.executescript(_SCHEMA)
+        try:
+            connection.executescript(_FTS_SCHEMA)
+            return True
+        except sqlite3.OperationalError:
+            # FTS5 (trigram) が使えない環境では LIKE 検索で代用
+            return False
+
+    def _write_loop(self):
+        connection = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch = [item]
+            # 溜まっている分をまとめて1トランザクションで書き込む
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO history (created_at, expression, result, intermediate, mode) VALUES (?, ?, ?, ?, ?)",
+                        batch
+                    )
+            except sqlite3.Error:
+                # 履歴の書き込み失敗で計算を止めない
+                pass
+            for _ in batch:
+                self._queue.task_done()
+        connection.close()
+
+    def append(self, expression, result, mode='float'):
+        """計算結果を履歴に追加 (書き込みはバックグラウンドで行う)"""
+        self._queue.put((
+            time.time(),
+            expression,
+            result.get('result'),
+            result.get('intermediate'),
+            mode
+        ))
+
+    def flush(self):
+        """キューに残っている履歴をすべて書き込むまで待つ"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._reader.close()
+
+    def _fetch(self, sql, parameters):
+        # 読み込み前に未書き込みの履歴を反映させる
+        self.flush()
+        with self._read_lock:
+            return [_row_to_entry(row) for row in self._reader.execute(sql, parameters)]
+
+    def count(self):
+        self.flush()
+        with self._read_lock:
+            return self._reader.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def get(self, entry_id):
+        entries = self._fetch(f"SELECT {_COLUMNS} FROM history WHERE id = ?", (entry_id,))
+        return entries[0] if entries else None
+
+    def page(self, limit=DEFAULT_PAGE_SIZE, before_id=None, offset=0):
+        """新しい順に1ページ分の履歴を返す (before_id 指定時はその id より古いもの)"""
+        if before_id is not None:
+            return self._fetch(
+                f"SELECT {_COLUMNS} FROM history WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit)
+            )
+        return self._fetch(
+            f"SELECT {_COLUMNS} FROM history ORDER BY id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        )
+
+    def search_prefix(self, prefix, limit=DEFAULT_PAGE_SIZE, offset=0):
+        """式の前方一致検索 (expression のインデックスを範囲検索で使う)"""
+        return self._fetch(
+            f"SELECT {_COLUMNS} FROM history WHERE expression >= ? AND expression < ? "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (prefix, prefix + '\U0010ffff', limit, offset)
+        )
+
+    def search(self, text, limit=DEFAULT_PAGE_SIZE, offset=0):
+        """式または結果の部分一致検索"""
+        if self.full_text and len(text) >= 3:
+            quoted = '"' + text.replace('"', '""') + '"'
+            return self._fetch(
+                f"SELECT {_JOINED_COLUMNS} FROM history_fts "
+                "JOIN history ON history.id = history_fts.rowid "
+                "WHERE history_fts MATCH ? ORDER BY history.id DESC LIMIT ? OFFSET ?",
+                (quoted, limit, offset)
+            )
+        # trigramは3文字未満に一致しないため LIKE で検索
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return self._fetch(
+            f"SELECT {_COLUMNS} FROM history WHERE expression LIKE ? ESCAPE '\\' OR result LIKE ? ESCAPE '\\' "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (pattern, pattern, limit, offset)
+        )
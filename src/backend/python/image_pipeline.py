@@ -0,0 +1,153 @@
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+# 長辺の既定の上限 (チャットのAPIは長辺2048pxを超える画像を縮小して扱う)
+DEFAULT_MAX_DIMENSION = 2048
+
+# エンコード結果を保持する件数
+CACHE_SIZE = 16
+
+# palette 指定時の色数
+PALETTE_COLORS = 64
+
+# 形式: (PILの形式名, MIMEタイプ)
+FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+COLOR_MODES = ('rgb', 'grayscale', 'palette')
+
+EncodeOptions = namedtuple(
+    'EncodeOptions',
+    ['format', 'max_dimension', 'color', 'compress_level', 'quality'],
+    defaults=('png', DEFAULT_MAX_DIMENSION, 'rgb', 1, 85)
+)
+
+EncodedImage = namedtuple(
+    'EncodedImage',
+    ['data', 'mime_type', 'width', 'height', 'digest', 'encode_ms', 'hash_ms', 'cached']
+)
+
+def parse_options(request):
+    """リクエストの dict からエンコード設定を作る (不正な値は ValueError)"""
+    # max_dimension に 0 / null を指定すると縮小しない
+    max_dimension = request.get('max_dimension', DEFAULT_MAX_DIMENSION)
+    options = EncodeOptions(
+        format=str(request.get('format') or 'png').lower(),
+        max_dimension=int(max_dimension or 0) or None,
+        color=str(request.get('color') or 'rgb').lower(),
+        compress_level=int(request.get('compress_level', 1)),
+        quality=int(request.get('quality', 85)),
+    )
+    if options.format not in FORMATS:
+        raise ValueError("未対応の画像形式です")
+    if options.color not in COLOR_MODES:
+        raise ValueError("未対応の色指定です")
+    if not 0 <= options.compress_level <= 9:
+        raise ValueError("PNGの圧縮レベルは0から9で指定してください")
+    if not 1 <= options.quality <= 100:
+        raise ValueError("画質は1から100で指定してください")
+    return options
+
+def prepare_image(image, options):
+    """縮小と減色を行う"""
+    if options.max_dimension and max(image.size) > options.max_dimension:
+        scale = options.max_dimension / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # reducing_gap で整数倍の縮小を先に行い、大きな画像でも高速に縮小する
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    if options.color == 'grayscale':
+        image = image.convert('L')
+    elif options.color == 'palette':
+        # 図面など色数の少ない画像向け
+        image = image.quantize(PALETTE_COLORS, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    return image
+
+def encode_image(image, options):
+    """縮小・減色した画像を指定形式のバイト列にする"""
+    pil_format, _ = FORMATS[options.format]
+    image = prepare_image(image, options)
+    buffer = io.BytesIO()
+    if options.format == 'png':
+        image.save(buffer, format=pil_format, compress_level=options.compress_level)
+    elif options.format == 'jpeg':
+        if image.mode == 'P':
+            image = image.convert('RGB')
+        image.save(buffer, format=pil_format, quality=options.quality)
+    else:
+        image.save(buffer, format=pil_format, quality=options.quality, method=0)
+    return buffer.getvalue(), image.size
+
+class ImagePipeline:
+    """画像の縮小・減色・エンコードを行い、内容のハッシュで結果をキャッシュする"""
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.encoded = 0
+        self.cache_hits = 0
+        self.total_encode_ms = 0.0
+        self.total_bytes = 0
+
+    def encode_raw(self, raw, width, height, options, raw_mode='BGRX', stride=0):
+        """生の画素データ (共有メモリなど) をエンコード"""
+        start = time.perf_counter()
+        # 大きなバッファでも hashlib はGILを解放して計算する (SHA-256 はCPU命令で高速に計算される)
+        digest = hashlib.sha256(raw)
+        digest.update(f"{width}x{height}:{raw_mode}:{stride}".encode())
+        hash_ms = (time.perf_counter() - start) * 1000
+        return self._encode(digest.hexdigest()[:32], hash_ms, options, lambda: Image.frombuffer(
+            'RGB', (width, height), raw, 'raw', raw_mode, stride, 1
+        ))
+
+    def encode(self, image, options):
+        """PILの画像をエンコード"""
+        start = time.perf_counter()
+        digest = hashlib.sha256(image.tobytes())
+        digest.update(f"{image.width}x{image.height}:{image.mode}".encode())
+        hash_ms = (time.perf_counter() - start) * 1000
+        return self._encode(digest.hexdigest()[:32], hash_ms, options, lambda: image)
+
+    def _encode(self, digest, hash_ms, options, load_image):
+        key = (digest, options)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached._replace(encode_ms=0.0, hash_ms=round(hash_ms, 2), cached=True)
+
+        start = time.perf_counter()
+        data, (width, height) = encode_image(load_image(), options)
+        encode_ms = (time.perf_counter() - start) * 1000
+        result = EncodedImage(
+            data, FORMATS[options.format][1], width, height, digest,
+            round(encode_ms, 2), round(hash_ms, 2), False
+        )
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self.encoded += 1
+            self.total_encode_ms += encode_ms
+            self.total_bytes += len(data)
+        return result
+
+    def stats(self):
+        """エンコード件数、キャッシュのヒット数、平均のエンコード時間と出力サイズ"""
+        with self._lock:
+            return {
+                "encoded": self.encoded,
+                "cache_hits": self.cache_hits,
+                "cached_entries": len(self._cache),
+                "mean_encode_ms": round(self.total_encode_ms / self.encoded, 2) if self.encoded else 0,
+                "mean_bytes": round(self.total_bytes / self.encoded) if self.encoded else 0
+            }
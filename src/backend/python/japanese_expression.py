@@ -0,0 +1,200 @@
+import unicodedata
+
+# 読み (ひらがな・漢字・記号) → トークン
+# ('digit', 値) / ('unit', 十・百・千) / ('big', 万・億・兆) / ('point',) / ('op', 演算子) /
+# ('lparen',) / ('rparen',) / ('func', 名前) / ('pi',) / ('pow',) / ('power', 指数) /
+# ('fraction',) / ('skip',)
+VOCABULARY = {
+    ('digit', 0): ['ぜろ', 'れい', '零', '〇'],
+    ('digit', 1): ['いち', 'いっ', '一'],
+    ('digit', 2): ['に', '二'],
+    ('digit', 3): ['さん', '三'],
+    ('digit', 4): ['よん', 'し', '四'],
+    ('digit', 5): ['ご', '五'],
+    ('digit', 6): ['ろく', 'ろっ', '六'],
+    ('digit', 7): ['なな', 'しち', '七'],
+    ('digit', 8): ['はち', 'はっ', '八'],
+    ('digit', 9): ['きゅう', 'く', '九'],
+    ('unit', 10): ['じゅう', 'じゅっ', '十'],
+    ('unit', 100): ['ひゃく', 'びゃく', 'ぴゃく', '百'],
+    ('unit', 1000): ['せん', 'ぜん', '千'],
+    ('big', 10 ** 4): ['まん', '万'],
+    ('big', 10 ** 8): ['おく', '億'],
+    ('big', 10 ** 12): ['ちょう', '兆'],
+    ('point',): ['てん', '点', '.'],
+    ('op', '+'): ['たす', '足す', 'ぷらす', '+'],
+    ('op', '-'): ['ひく', '引く', 'まいなす', '-'],
+    ('op', '*'): ['かける', '掛ける', '×', '*'],
+    ('op', '/'): ['わる', '割る', '÷', '/'],
+    ('lparen',): ['かっこ', '括弧', '('],
+    ('rparen',): ['かっことじ', 'かっこ閉じ', '括弧閉じ', 'とじかっこ', ')'],
+    ('func', 'sin'): ['さいん', 'sin'],
+    ('func', 'cos'): ['こさいん', 'cos'],
+    ('func', 'tan'): ['たんじぇんと', 'tan'],
+    ('pi',): ['ぱい', 'π'],
+    # 「3の2乗」の「の」(累乗)、「2乗」「3乗」は単独でも使う
+    ('pow',): ['の', '^'],
+    ('power', 2): ['にじょう', '二乗', 'じじょう', '自乗'],
+    ('power', 3): ['さんじょう', '三乗'],
+    # 「3分の1」(1/3)
+    ('fraction',): ['ぶんの', '分の'],
+    # 読み飛ばす語 (「乗」は「の」の後の数の終わり、「度」は角度の単位)
+    ('skip',): [
+        'じょう', '乗', 'ど', '度', 'は', 'いくつ', 'なに', 'なん', 'ですか', 'です',
+        'いこーる', '=', '？', '?', '、', '。', ' ', '　',
+    ],
+}
+
+for _digit in range(10):
+    VOCABULARY[('digit', _digit)].append(str(_digit))
+
+# カタカナ → ひらがな
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+def _build_trie(vocabulary):
+    # 1文字ごとの dict を入れ子にした木。None のキーに読みのトークンを置く
+    root = {}
+    for token, words in vocabulary.items():
+        for word in words:
+            node = root
+            for char in word:
+                node = node.setdefault(char, {})
+            if None in node and node[None] != token:
+                raise ValueError(f"読みが重複しています: {word}")
+            node[None] = token
+    return root
+
+# 起動時に1回だけ構築する (1文字あたり dict の参照1回で照合する)
+_TRIE = _build_trie(VOCABULARY)
+
+def normalize(text):
+    """全角英数字を半角に、カタカナをひらがなにする"""
+    return unicodedata.normalize('NFKC', text).translate(_KATAKANA_TO_HIRAGANA).lower()
+
+def tokenize(text):
+    """最長一致で読みをトークンに分割する (変換できない文字があれば ValueError)"""
+    text = normalize(text)
+    tokens = []
+    position = 0
+    while position < len(text):
+        node = _TRIE
+        match = None
+        index = position
+        while index < len(text):
+            node = node.get(text[index])
+            if node is None:
+                break
+            index += 1
+            if None in node:
+                match = (node[None], index)
+        if match is None:
+            raise ValueError(f"式に変換できない語があります: {text[position:]}")
+        token, position = match
+        if token[0] != 'skip':
+            tokens.append(token)
+    return tokens
+
+class _Number:
+    """数詞を位取りに従って組み立てる (にじゅうさん → 23、いちにさん → 123)"""
+
+    def __init__(self):
+        self.total = 0
+        self.section = 0
+        self.current = None
+        self.decimals = None
+        self.empty = True
+
+    def digit(self, value):
+        self.empty = False
+        if self.decimals is not None:
+            self.decimals += str(value)
+        elif self.current is None:
+            self.current = value
+        else:
+            self.current = self.current * 10 + value
+
+    def unit(self, value):
+        if self.decimals is not None:
+            raise ValueError("小数点の後に位の語は使えません")
+        self.empty = False
+        self.section += (1 if self.current is None else self.current) * value
+        self.current = None
+
+    def big(self, value):
+        if self.decimals is not None:
+            raise ValueError("小数点の後に位の語は使えません")
+        self.empty = False
+        section = self.section + (self.current or 0)
+        self.total += (section or 1) * value
+        self.section = 0
+        self.current = None
+
+    def point(self):
+        if self.decimals is not None:
+            raise ValueError("小数点が重複しています")
+        self.decimals = ''
+
+    def text(self):
+        integer = self.total + self.section + (self.current or 0)
+        if self.decimals is None:
+            return str(integer)
+        if not self.decimals:
+            raise ValueError("小数点の後に数字がありません")
+        return f"{integer}.{self.decimals}"
+
+def convert(text):
+    """日本語の読み上げを計算式にする (例: さんかけるよんじゅうご → 3*45、サイン三十 → sin30)"""
+    output = []
+    number = None
+    denominator = None
+
+    def flush():
+        nonlocal number, denominator
+        if number is None:
+            return
+        value = number.text()
+        number = None
+        if denominator is not None:
+            # 「3分の1」は分母が先に来る
+            value = f"({value}/{denominator})"
+            denominator = None
+        output.append(value)
+
+    for token in tokenize(text):
+        kind = token[0]
+        if kind in ('digit', 'unit', 'big', 'point'):
+            if number is None:
+                number = _Number()
+            if kind == 'point':
+                if number.empty:
+                    raise ValueError("小数点の前に数字がありません")
+                number.point()
+            else:
+                getattr(number, kind)(token[1])
+            continue
+        flush()
+        if kind == 'fraction':
+            if not output or not output[-1][0].isdigit():
+                raise ValueError("「分の」の前に数字がありません")
+            denominator = output.pop()
+        elif kind == 'power':
+            # 「3の2乗」の「2乗」は指数だけ、「3 2乗」は ^2 を付ける
+            output.append(str(token[1]) if output and output[-1] == '^' else f"^{token[1]}")
+        elif kind == 'op':
+            output.append(token[1])
+        elif kind == 'pow':
+            output.append('^')
+        elif kind == 'lparen':
+            output.append('(')
+        elif kind == 'rparen':
+            output.append(')')
+        elif kind == 'func':
+            output.append(token[1])
+        elif kind == 'pi':
+            output.append('π')
+    flush()
+    if denominator is not None:
+        raise ValueError("「分の」の後に数字がありません")
+    if not output:
+        raise ValueError("式が空です")
+    return ''.join(output)
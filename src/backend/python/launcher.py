@@ -0,0 +1,358 @@
+import argparse
+import importlib
+import io
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 起動時に読み込んでおくモジュール (未インストールのものは読み飛ばす)
+PRELOAD_MODULES = [
+    'numpy', 'PIL.Image', 'tkinter', 'mss', 'speech_recognition', 'pyaudio',
+    'calculator', 'worker_pool', 'image_pipeline', 'screenshot',
+    'voice_pipeline', 'japanese_expression', 'cad_measurement',
+]
+
+# 起動できるヘルパー (名前 → スクリプト)
+HELPERS = {
+    'calculator': 'calculator.py',
+    'worker_pool': 'worker_pool.py',
+    'screenshot': 'screenshot.py',
+    'voice': 'voice_recognition.py',
+    'cad': 'cad_measurement.py',
+    'autocad_extension': 'autocad_extension.py',
+}
+
+# localhost の TCP で待ち受ける場合の既定のポート (Unixドメインソケットが使えない環境)
+DEFAULT_LAUNCHER_PORT = 47654
+
+# 制御用の接続で受け付ける1行の最大長
+REQUEST_LINE_LIMIT = 64 * 1024
+
+# fork できない環境で、要求に備えて起動しておく待機プロセスの数
+STANDBY_PROCESSES = 1
+
+def default_socket_path():
+    user = os.getuid() if hasattr(os, 'getuid') else os.getpid()
+    return os.path.join(tempfile.gettempdir(), f'calculator-launcher-{user}.sock')
+
+def preload(modules=PRELOAD_MODULES):
+    """モジュールを読み込み、それぞれの所要時間 (ミリ秒、読み込めなければ None) を返す"""
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    timings = {}
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception:
+            # 未インストールや、この環境で使えないモジュール (pywin32 など)
+            timings[name] = None
+            continue
+        timings[name] = round((time.perf_counter() - start) * 1000, 3)
+    return timings
+
+def run_helper(helper, args):
+    """読み込み済みのモジュールを使って、ヘルパーをスクリプトとして実行する"""
+    script = os.path.join(SCRIPT_DIR, HELPERS[helper])
+    sys.argv = [script] + [str(arg) for arg in args]
+    runpy.run_path(script, run_name='__main__')
+
+def _reopen_stdio():
+    # 標準入出力を差し替えた記述子 (0 / 1) に結び付け直す
+    # (ヘルパーが sys.stdout を置き換えても閉じられないよう、sys.__stdout__ などからも参照しておく)
+    sys.stdin = sys.__stdin__ = io.TextIOWrapper(io.FileIO(0, 'r', closefd=False), encoding='utf-8')
+    sys.stdout = sys.__stdout__ = io.TextIOWrapper(
+        io.FileIO(1, 'w', closefd=False), encoding='utf-8', line_buffering=True
+    )
+
+class _HelperStats:
+    __slots__ = ('launches', 'total_ms', 'last_ms')
+
+    def __init__(self):
+        self.launches = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    def record(self, elapsed_ms):
+        self.launches += 1
+        self.total_ms += elapsed_ms
+        self.last_ms = elapsed_ms
+
+    def summary(self):
+        return {
+            "launches": self.launches,
+            "mean_launch_ms": round(self.total_ms / self.launches, 3) if self.launches else 0,
+            "last_launch_ms": round(self.last_ms, 3)
+        }
+
+class Launcher:
+    """よく使うモジュールを読み込んだ状態で待機し、制御用の接続からヘルパーを起動する
+
+    接続に {"command": "spawn", "helper": 名前, "args": [...]} の1行を送ると
+    {"status": "started", "pid": ...} が返り、以降その接続がヘルパーの標準入出力になる。
+    fork が使える環境では読み込み済みのプロセスを複製し、使えない環境 (Windows) では
+    起動済みの待機プロセスにヘルパーを実行させて入出力を中継する。
+    """
+
+    def __init__(self, preload_timings, strategy=None):
+        self.preload_timings = preload_timings
+        self.strategy = strategy or ('fork' if hasattr(os, 'fork') else 'standby')
+        self.stats = {name: _HelperStats() for name in HELPERS}
+        self.children = {}
+        self._standby = []
+        self._running = True
+        self._server = None
+        if self.strategy == 'standby':
+            for _ in range(STANDBY_PROCESSES):
+                self._standby.append(_start_standby())
+
+    def handle(self, connection):
+        """制御用の接続を処理する (接続をヘルパーに渡した場合は True)"""
+        request = _read_request(connection)
+        if request is None:
+            _send(connection, {"status": "error", "message": "不正なリクエストです"})
+            return False
+        command = request.get('command')
+        if command == 'spawn':
+            helper = request.get('helper')
+            if helper not in HELPERS:
+                _send(connection, {"status": "error", "message": "未対応のヘルパーです"})
+                return False
+            args = request.get('args') or []
+            if self.strategy == 'fork':
+                self._fork(connection, helper, args)
+            else:
+                self._relay(connection, helper, args)
+            return True
+        if command == 'stats':
+            _send(connection, {
+                "status": "success",
+                "strategy": self.strategy,
+                "preload_ms": self.preload_timings,
+                "helpers": {name: stats.summary() for name, stats in self.stats.items() if stats.launches},
+                "children": len(self.children)
+            })
+        elif command == 'hello':
+            _send(connection, {"status": "success", "strategy": self.strategy})
+        elif command == 'shutdown':
+            self._running = False
+            _send(connection, {"status": "success"})
+        else:
+            _send(connection, {"status": "error", "message": "未対応のコマンドです"})
+        return False
+
+    def _fork(self, connection, helper, args):
+        start = time.perf_counter()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # 子プロセス: 接続を標準入出力にしてヘルパーを実行する
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._server.close()
+                connection.setblocking(True)
+                os.dup2(connection.fileno(), 0)
+                os.dup2(connection.fileno(), 1)
+                connection.close()
+                _reopen_stdio()
+                run_helper(helper, args)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                try:
+                    sys.stdout.flush()
+                except Exception:
+                    pass
+                os._exit(code)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.children[pid] = helper
+        self.stats[helper].record(elapsed_ms)
+        _send(connection, {"status": "started", "helper": helper, "pid": pid, "launch_ms": round(elapsed_ms, 3)})
+        connection.close()
+
+    def _relay(self, connection, helper, args):
+        start = time.perf_counter()
+        process = self._standby.pop(0) if self._standby else _start_standby()
+        # 次の要求に備えて、待機プロセスを補充しておく
+        threading.Thread(target=lambda: self._standby.append(_start_standby()), daemon=True).start()
+        process.stdin.write((json.dumps({"helper": helper, "args": args}) + '\n').encode('utf-8'))
+        process.stdin.flush()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.children[process.pid] = helper
+        self.stats[helper].record(elapsed_ms)
+        connection.setblocking(True)
+        _send(connection, {"status": "started", "helper": helper, "pid": process.pid, "launch_ms": round(elapsed_ms, 3)})
+        _start_relay(connection, process, lambda: self.children.pop(process.pid, None))
+
+    def reap(self):
+        """終了した子プロセスを回収する"""
+        while self.children and self.strategy == 'fork':
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            self.children.pop(pid, None)
+
+    def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        """Unixドメインソケット (既定) またはlocalhostのTCPで待ち受ける"""
+        if port is None and hasattr(socket, 'AF_UNIX'):
+            socket_path = socket_path or default_socket_path()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(socket_path)
+            address = socket_path
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, DEFAULT_LAUNCHER_PORT if port is None else port))
+            address = "%s:%d" % server.getsockname()[:2]
+        server.listen()
+        self._server = server
+        # 起動したことを呼び出し元に知らせる
+        print(json.dumps({
+            "status": "listening",
+            "address": address,
+            "strategy": self.strategy,
+            "preload_ms": round(sum(value for value in self.preload_timings.values() if value), 3)
+        }, ensure_ascii=False))
+        sys.stdout.flush()
+        # fork するため、待ち受けは単一のスレッドで行う
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        try:
+            while self._running:
+                for _ in selector.select(timeout=1.0):
+                    connection, _ = server.accept()
+                    connection.settimeout(5.0)
+                    try:
+                        self.handle(connection)
+                    except OSError:
+                        connection.close()
+                self.reap()
+        finally:
+            selector.close()
+            server.close()
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
+            for process in self._standby:
+                process.kill()
+
+def _read_request(connection):
+    # 続けて届いたヘルパー宛ての入力は子プロセスが接続から直接読むため、
+    # 先読み (MSG_PEEK) で改行の位置を確かめ、制御用の1行だけを受け取る
+    while True:
+        data = connection.recv(REQUEST_LINE_LIMIT, socket.MSG_PEEK)
+        end = data.find(b'\n')
+        if end >= 0:
+            line = connection.recv(end + 1)[:-1]
+            break
+        if not data or len(data) >= REQUEST_LINE_LIMIT:
+            return None
+        # 1行が揃うまで待つ
+        time.sleep(0.001)
+    try:
+        request = json.loads(line.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    return request if isinstance(request, dict) else None
+
+def _send(connection, message):
+    connection.sendall((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+
+def _start_standby():
+    """モジュールを読み込んでヘルパーの指定を待つプロセスを起動する (fork できない環境用)"""
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--standby'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        bufsize=0
+    )
+
+def _start_relay(connection, process, on_exit):
+    # 接続 ⇔ 待機プロセスの標準入出力を中継する
+    def upstream():
+        try:
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                process.stdin.write(data)
+                process.stdin.flush()
+        except OSError:
+            pass
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+    def downstream():
+        try:
+            while True:
+                data = process.stdout.read1(65536) if hasattr(process.stdout, 'read1') else process.stdout.read(65536)
+                if not data:
+                    break
+                connection.sendall(data)
+        except OSError:
+            pass
+        process.wait()
+        on_exit()
+        connection.close()
+
+    threading.Thread(target=upstream, daemon=True).start()
+    threading.Thread(target=downstream, daemon=True).start()
+
+def run_standby():
+    """待機プロセス: 読み込みを済ませて、標準入力の1行で指定されたヘルパーを実行する"""
+    preload()
+    # 続けて届くヘルパー宛ての入力を先読みしないよう、1バイトずつ読む
+    line = b''
+    while not line.endswith(b'\n'):
+        data = os.read(0, 1)
+        if not data:
+            return
+        line += data
+    request = json.loads(line.decode('utf-8'))
+    _reopen_stdio()
+    run_helper(request['helper'], request.get('args') or [])
+
+def main():
+    parser = argparse.ArgumentParser(description="モジュールを読み込み済みの状態からヘルパーを起動するランチャー")
+    parser.add_argument('--socket', help="Unixドメインソケットのパス")
+    parser.add_argument('--port', type=int, help="localhostのTCPで待ち受けるポート")
+    parser.add_argument('--strategy', choices=['fork', 'standby'],
+                        help="ヘルパーの起動方法 (既定は fork が使えれば fork)")
+    parser.add_argument('--standby', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.standby:
+        run_standby()
+        return
+    launcher = Launcher(preload(), args.strategy)
+    # 終了シグナルでもソケットファイルを削除して終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        launcher.serve(args.socket, port=args.port)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import json
+import time
+
+from screenshot import REDRAW_INTERVAL_MS, SelectionOverlay
+
+# 横に並べた 4K モニター3台
+MONITORS = [
+    {"left": 3840 * index, "top": 0, "width": 3840, "height": 2160}
+    for index in range(3)
+]
+
+# マウスの報告間隔 (ミリ秒、1000Hz のマウスを想定)
+MOTION_INTERVAL_MS = 1
+
+class _Clock:
+    """after() の予約を模擬時刻で実行する"""
+
+    def __init__(self):
+        self.now = 0
+        self._timers = {}
+        self._ids = 0
+
+    def after(self, delay, callback):
+        self._ids += 1
+        self._timers[self._ids] = (self.now + delay, callback)
+        return self._ids
+
+    def after_cancel(self, timer_id):
+        self._timers.pop(timer_id, None)
+
+    def advance(self, now):
+        self.now = now
+        for timer_id, (due, callback) in sorted(self._timers.items(), key=lambda item: item[1][0]):
+            if due <= now and self._timers.pop(timer_id, None):
+                callback()
+
+class FakeCanvas:
+    """Tk の Canvas の代わりに操作の回数だけを数える"""
+
+    def __init__(self, monitor, clock):
+        self.monitor = monitor
+        self.clock = clock
+        self.operations = 0
+        self._items = 0
+
+    def create_rectangle(self, *args, **kwargs):
+        self.operations += 1
+        self._items += 1
+        return self._items
+
+    def delete(self, tag):
+        self.operations += 1
+
+    def coords(self, item, *coords):
+        self.operations += 1
+
+    def itemconfigure(self, item, **options):
+        self.operations += 1
+
+    def after(self, delay, callback):
+        return self.clock.after(delay, callback)
+
+    def after_cancel(self, timer_id):
+        self.clock.after_cancel(timer_id)
+
+def synthetic_drag(events):
+    """1台目の左上から3台目の右下までを斜めにドラッグする座標列"""
+    width = sum(monitor['width'] for monitor in MONITORS)
+    height = MONITORS[0]['height']
+    start = (100, 100)
+    return start, [
+        (start[0] + (width - 200) * step // events, start[1] + (height - 200) * step // events)
+        for step in range(1, events + 1)
+    ]
+
+def legacy_move(canvases, start, current):
+    """以前の実装: 移動のたびに全キャンバスの矩形を削除して作り直す"""
+    for c in canvases:
+        c.delete('selection')
+    for c in canvases:
+        mon = c.monitor
+        local_start_x = start[0] - mon['left']
+        local_start_y = start[1] - mon['top']
+        local_current_x = current[0] - mon['left']
+        local_current_y = current[1] - mon['top']
+        if (local_start_x < mon['width'] and local_current_x >= 0 and
+            local_start_y < mon['height'] and local_current_y >= 0):
+            c.create_rectangle(
+                max(0, min(local_start_x, mon['width'])),
+                max(0, min(local_start_y, mon['height'])),
+                max(0, min(local_current_x, mon['width'])),
+                max(0, min(local_current_y, mon['height'])),
+                outline='red',
+                tags='selection'
+            )
+
+def bench_legacy(events):
+    clock = _Clock()
+    canvases = [FakeCanvas(monitor, clock) for monitor in MONITORS]
+    start, moves = synthetic_drag(events)
+    begin = time.perf_counter()
+    for position in moves:
+        legacy_move(canvases, start, position)
+    elapsed = time.perf_counter() - begin
+    return _summary(events, elapsed, canvases, events)
+
+def bench_overlay(events):
+    clock = _Clock()
+    canvases = [FakeCanvas(monitor, clock) for monitor in MONITORS]
+    start, moves = synthetic_drag(events)
+    begin = time.perf_counter()
+    overlay = SelectionOverlay(canvases)
+    overlay.begin(*start)
+    for index, position in enumerate(moves):
+        clock.advance(index * MOTION_INTERVAL_MS)
+        overlay.move(*position)
+    clock.advance(len(moves) * MOTION_INTERVAL_MS + REDRAW_INTERVAL_MS)
+    elapsed = time.perf_counter() - begin
+    return _summary(events, elapsed, canvases, overlay.redraws)
+
+def _summary(events, elapsed, canvases, redraws):
+    operations = sum(canvas.operations for canvas in canvases)
+    return {
+        "events": events,
+        "redraws": redraws,
+        "canvas_operations": operations,
+        "operations_per_event": round(operations / events, 3),
+        "us_per_event": round(elapsed / events * 1e6, 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="選択範囲オーバーレイの描画処理のベンチマーク (画面不要)")
+    parser.add_argument('--events', type=int, default=5000, help="再生するマウス移動イベントの数")
+    args = parser.parse_args()
+    print(json.dumps({
+        "monitors": len(MONITORS),
+        "motion_interval_ms": MOTION_INTERVAL_MS,
+        "redraw_interval_ms": REDRAW_INTERVAL_MS,
+        "legacy": bench_legacy(args.events),
+        "overlay": bench_overlay(args.events),
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import cProfile
+import os
+import threading
+from time import perf_counter_ns
+
+# CALCULATOR_STATS=1 で処理段階ごとの時間を記録する (無効時は記録処理を呼ばない)
+ENABLED = os.environ.get('CALCULATOR_STATS', '0') == '1'
+
+# CALCULATOR_PROFILE にディレクトリを指定すると、一部のリクエストを cProfile で計測して書き出す
+PROFILE_DIR = os.environ.get('CALCULATOR_PROFILE') or None
+
+# 何件に1件を cProfile で計測するか
+PROFILE_EVERY = max(1, int(os.environ.get('CALCULATOR_PROFILE_EVERY', '100')))
+
+# 計測した件数がこの数に達するごとにファイルへ書き出す
+PROFILE_DUMP_EVERY = 50
+
+# ヒストグラムのバケット数 (2倍ごとの区間をさらに4分割、約18分までを記録)
+HISTOGRAM_BUCKETS = 160
+
+def _bucket(elapsed_ns):
+    if elapsed_ns < 4:
+        return max(0, elapsed_ns)
+    shift = elapsed_ns.bit_length() - 3
+    return min((shift << 2) + (elapsed_ns >> shift), HISTOGRAM_BUCKETS - 1)
+
+def _bucket_upper_ns(index):
+    if index < 4:
+        return index + 1
+    shift = (index >> 2) - 1
+    return ((index & 3) + 5) << shift
+
+class Histogram:
+    """固定長の対数ヒストグラム (百分位数の誤差は最大25%)"""
+
+    __slots__ = ('counts', 'count', 'total_ns', 'max_ns')
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, elapsed_ns):
+        self.counts[_bucket(elapsed_ns)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def percentile(self, percent):
+        """百分位数 (ナノ秒、該当するバケットの上限)"""
+        if not self.count:
+            return 0
+        target = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(_bucket_upper_ns(index), self.max_ns)
+        return self.max_ns
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total_ns / self.count / 1000, 3) if self.count else 0,
+            "p50_us": round(self.percentile(50) / 1000, 3),
+            "p90_us": round(self.percentile(90) / 1000, 3),
+            "p99_us": round(self.percentile(99) / 1000, 3),
+            "max_us": round(self.max_ns / 1000, 3)
+        }
+
+# 段階名ごとのヒストグラム (複数スレッドからの更新は厳密には数えない)
+_histograms = {}
+
+def record(stage, start_ns):
+    """start_ns (perf_counter_ns の値) からの経過時間を記録"""
+    elapsed = perf_counter_ns() - start_ns
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        histogram = _histograms.setdefault(stage, Histogram())
+    histogram.record(elapsed)
+
+def snapshot():
+    """段階ごとの件数と遅延の百分位数"""
+    return {stage: histogram.summary() for stage, histogram in sorted(_histograms.items())}
+
+def reset():
+    _histograms.clear()
+
+class QueueDepth:
+    """処理待ち・処理中のリクエスト数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def enter(self):
+        with self._lock:
+            self.current += 1
+            if self.current > self.peak:
+                self.peak = self.current
+
+    def leave(self):
+        with self._lock:
+            self.current -= 1
+
+    def summary(self):
+        return {"current": self.current, "peak": self.peak}
+
+queue_depth = QueueDepth()
+
+class _Sampler:
+    """一定間隔でリクエストを cProfile で計測し、結果を蓄積して書き出す"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, f'calculator-{os.getpid()}.prof')
+        self.profile = cProfile.Profile()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self.samples = 0
+
+    def call(self, func, *args):
+        self._requests += 1
+        # 計測対象外、または他のスレッドで計測中ならそのまま実行
+        if self._requests % PROFILE_EVERY or not self._lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            self.profile.enable()
+            try:
+                return func(*args)
+            finally:
+                self.profile.disable()
+                self.samples += 1
+                if self.samples % PROFILE_DUMP_EVERY == 0:
+                    self.dump()
+        finally:
+            self._lock.release()
+
+    def dump(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.profile.dump_stats(self.path)
+
+_sampler = _Sampler(PROFILE_DIR) if PROFILE_DIR else None
+
+def profile_call(func, *args):
+    """CALCULATOR_PROFILE 指定時は一部の呼び出しを cProfile で計測する"""
+    if _sampler is None:
+        return func(*args)
+    return _sampler.call(func, *args)
+
+def dump_profile():
+    """蓄積した cProfile の結果を書き出す (計測していなければ何もしない)"""
+    if _sampler is not None and _sampler.samples:
+        with _sampler._lock:
+            _sampler.dump()
+
+def profile_summary():
+    if _sampler is None:
+        return None
+    return {"path": _sampler.path, "samples": _sampler.samples, "every": PROFILE_EVERY}
@@ -1,11 +1,195 @@
 import sys
+import os
 import json
+import itertools
+import queue
+import tempfile
+import threading
 import tkinter as tk
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 from PIL import Image
 import mss
 import base64
 from io import BytesIO
 
+import framing
+import image_pipeline
+
+# 同時に保持するキャプチャの数 (超えたら古いものから共有メモリを解放)
+MAX_CAPTURES = 4
+
+# エンコードを行うスレッド数 (PILはエンコード中にGILを解放する)
+ENCODER_THREADS = 2
+
+# 標準入力からのコマンドを確認する間隔 (ミリ秒)
+POLL_INTERVAL_MS = 15
+
+# エンコード済み画像の出力先
+OUTPUT_DIR = os.path.join(tempfile.gettempdir(), 'calculator-screenshots')
+
+# 縮小・減色・エンコードと、同じ内容の再エンコードを避けるキャッシュ
+PIPELINE = image_pipeline.ImagePipeline()
+
+_output_numbers = itertools.count(1)
+
+# 選択範囲の再描画の間隔 (ミリ秒、約60Hz)。この間のマウス移動はまとめて1回で描画する
+REDRAW_INTERVAL_MS = 16
+
+class SelectionOverlay:
+    """各キャンバスに選択範囲の矩形を1つずつ置き、座標の変更だけで再描画する
+
+    canvases は monitor 属性 (left / top / width / height) を持つキャンバス。
+    マウス移動のたびには描画せず、REDRAW_INTERVAL_MS ごとに最新の位置だけを反映する。
+    """
+
+    def __init__(self, canvases, outline='red'):
+        self.canvases = list(canvases)
+        self.start = None
+        self.current = None
+        self._pending = None
+        # キャンバスごとの矩形と、最後に反映した座標 (非表示なら None)
+        self._items = [
+            canvas.create_rectangle(0, 0, 0, 0, outline=outline, state='hidden')
+            for canvas in self.canvases
+        ]
+        self._drawn = [None] * len(self.canvases)
+        self.redraws = 0
+
+    def begin(self, x, y):
+        """グローバル座標 (x, y) から選択を始める"""
+        self.start = self.current = (x, y)
+        self.flush()
+
+    def move(self, x, y):
+        """選択範囲の端を (x, y) に移動する (描画は次の再描画の時点)"""
+        if self.start is None:
+            return
+        self.current = (x, y)
+        if self._pending is None:
+            self._pending = self.canvases[0].after(REDRAW_INTERVAL_MS, self.flush)
+
+    def flush(self):
+        """最新の選択範囲を描画する (変化のあるキャンバスのみ更新)"""
+        self._pending = None
+        if self.start is None:
+            return
+        self.redraws += 1
+        left = min(self.start[0], self.current[0])
+        top = min(self.start[1], self.current[1])
+        right = max(self.start[0], self.current[0])
+        bottom = max(self.start[1], self.current[1])
+        for index, canvas in enumerate(self.canvases):
+            monitor = canvas.monitor
+            # モニターローカル座標に変換して、モニター内に制限
+            local_left = left - monitor['left']
+            local_top = top - monitor['top']
+            local_right = right - monitor['left']
+            local_bottom = bottom - monitor['top']
+            if (local_left < monitor['width'] and local_right >= 0 and
+                local_top < monitor['height'] and local_bottom >= 0):
+                coords = (
+                    max(0, local_left),
+                    max(0, local_top),
+                    min(local_right, monitor['width']),
+                    min(local_bottom, monitor['height'])
+                )
+            else:
+                coords = None
+            previous = self._drawn[index]
+            if coords == previous:
+                continue
+            self._drawn[index] = coords
+            item = self._items[index]
+            if coords is None:
+                canvas.itemconfigure(item, state='hidden')
+                continue
+            canvas.coords(item, *coords)
+            if previous is None:
+                canvas.itemconfigure(item, state='normal')
+
+    def end(self, x, y):
+        """選択を終え、グローバル座標の (left, top, width, height) を返す"""
+        start_x, start_y = self.start
+        self.cancel()
+        return (min(start_x, x), min(start_y, y), abs(x - start_x), abs(y - start_y))
+
+    def cancel(self):
+        """予約した再描画を取り消す"""
+        if self._pending is not None:
+            self.canvases[0].after_cancel(self._pending)
+            self._pending = None
+        self.start = None
+
+def select_region(root, monitors, on_done):
+    """全モニターに半透明のオーバーレイを表示し、ドラッグで選んだ範囲を on_done に渡す
+
+    on_done にはグローバル座標の (left, top, width, height)、キャンセル時は None を渡す。
+    """
+    # 各モニターに対して半透明のウィンドウを作成
+    overlay_windows = []
+    for monitor in monitors:
+        overlay = tk.Toplevel(root)
+        overlay.attributes('-alpha', 0.3)  # 半透明に
+        overlay.attributes('-topmost', True)  # 最前面に
+
+        # ウィンドウをモニターの位置とサイズに合わせる
+        geometry = f"{monitor['width']}x{monitor['height']}+{monitor['left']}+{monitor['top']}"
+        overlay.geometry(geometry)
+
+        # ウィンドウの装飾を削除
+        overlay.overrideredirect(True)
+
+        # キャンバスを作成
+        canvas = tk.Canvas(
+            overlay,
+            width=monitor['width'],
+            height=monitor['height'],
+            cursor="cross",
+            highlightthickness=0
+        )
+        canvas.pack(fill=tk.BOTH, expand=True)
+
+        # モニター情報をキャンバスに関連付け
+        canvas.monitor = monitor
+
+        overlay_windows.append((overlay, canvas))
+
+    selection = SelectionOverlay(canvas for _, canvas in overlay_windows)
+
+    def finish(region):
+        # すべてのオーバーレイを閉じてから結果を渡す
+        selection.cancel()
+        for overlay, _ in overlay_windows:
+            overlay.destroy()
+        root.update_idletasks()
+        on_done(region)
+
+    def global_position(event):
+        # グローバル座標に変換
+        monitor = event.widget.monitor
+        return event.x + monitor['left'], event.y + monitor['top']
+
+    def on_mouse_down(event):
+        selection.begin(*global_position(event))
+
+    def on_mouse_move(event):
+        selection.move(*global_position(event))
+
+    def on_mouse_up(event):
+        if selection.start is None:
+            return
+        finish(selection.end(*global_position(event)))
+
+    # イベントをバインド
+    for _, canvas in overlay_windows:
+        canvas.bind('<Button-1>', on_mouse_down)
+        canvas.bind('<B1-Motion>', on_mouse_move)
+        canvas.bind('<ButtonRelease-1>', on_mouse_up)
+        # ESCキーでキャンセル
+        canvas.bind('<Escape>', lambda e: finish(None))
+
 def capture_screen():
     root = tk.Tk()
     root.withdraw()  # メインウィンドウを非表示
@@ -13,111 +197,13 @@ def capture_screen():
     # 全ディスプレイの情報を取得
     with mss.mss() as sct:
         monitors = sct.monitors[1:]  # 最初のモニターは全画面の合成なので除外
-        
-        # 各モニターに対して半透明のウィンドウを作成
-        overlay_windows = []
-        for monitor in monitors:
-            overlay = tk.Toplevel(root)
-            overlay.attributes('-alpha', 0.3)  # 半透明に
-            overlay.attributes('-topmost', True)  # 最前面に
-            
-            # ウィンドウをモニターの位置とサイズに合わせる
-            geometry = f"{monitor['width']}x{monitor['height']}+{monitor['left']}+{monitor['top']}"
-            overlay.geometry(geometry)
-            
-            # ウィンドウの装飾を削除
-            overlay.overrideredirect(True)
-            
-            # キャンバスを作成
-            canvas = tk.Canvas(
-                overlay,
-                width=monitor['width'],
-                height=monitor['height'],
-                cursor="cross",
-                highlightthickness=0
-            )
-            canvas.pack(fill=tk.BOTH, expand=True)
-            
-            # モニター情報をキャンバスに関連付け
-            canvas.monitor = monitor
-            
-            overlay_windows.append((overlay, canvas))
-        
-        selection = {}
-        
-        def on_mouse_down(event):
-            canvas = event.widget
-            monitor = canvas.monitor
-            
-            # グローバル座標に変換
-            selection['start_x'] = event.x + monitor['left']
-            selection['start_y'] = event.y + monitor['top']
-            selection['monitor'] = monitor
-            
-            # 他のウィンドウの選択範囲をクリア
-            for _, c in overlay_windows:
-                c.delete('selection')
-            
-        def on_mouse_move(event):
-            if 'start_x' not in selection:
-                return
-                
-            canvas = event.widget
-            monitor = canvas.monitor
-            
-            # グローバル座標に変換
-            current_x = event.x + monitor['left']
-            current_y = event.y + monitor['top']
-            
-            # 全てのキャンバスの選択範囲をクリア
-            for _, c in overlay_windows:
-                c.delete('selection')
-            
-            # 選択範囲を描画
-            for _, c in overlay_windows:
-                mon = c.monitor
-                # モニターローカル座標に変換
-                local_start_x = selection['start_x'] - mon['left']
-                local_start_y = selection['start_y'] - mon['top']
-                local_current_x = current_x - mon['left']
-                local_current_y = current_y - mon['top']
-                
-                # 選択範囲がこのモニターと交差するか確認
-                if (local_start_x < mon['width'] and local_current_x >= 0 and
-                    local_start_y < mon['height'] and local_current_y >= 0):
-                    # 範囲をモニター内に制限
-                    draw_x1 = max(0, min(local_start_x, mon['width']))
-                    draw_y1 = max(0, min(local_start_y, mon['height']))
-                    draw_x2 = max(0, min(local_current_x, mon['width']))
-                    draw_y2 = max(0, min(local_current_y, mon['height']))
-                    
-                    c.create_rectangle(
-                        draw_x1, draw_y1, draw_x2, draw_y2,
-                        outline='red',
-                        tags='selection'
-                    )
-            
-        def on_mouse_up(event):
-            if 'start_x' not in selection:
+
+        def on_done(region):
+            if region is None:
+                root.quit()
                 return
-                
-            canvas = event.widget
-            monitor = canvas.monitor
-            
-            # グローバル座標に変換
-            end_x = event.x + monitor['left']
-            end_y = event.y + monitor['top']
-            
-            # 選択範囲の座標を計算
-            left = min(selection['start_x'], end_x)
-            top = min(selection['start_y'], end_y)
-            width = abs(end_x - selection['start_x'])
-            height = abs(end_y - selection['start_y'])
-            
-            # すべてのオーバーレイを非表示
-            for overlay, _ in overlay_windows:
-                overlay.withdraw()
-            
+            left, top, width, height = region
+
             # スクリーンショットを撮影
             try:
                 screenshot = sct.grab({
@@ -126,15 +212,15 @@ def capture_screen():
                     "width": width,
                     "height": height
                 })
-                
+
                 # PILイメージに変換
                 img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
-                
+
                 # Base64エンコード
                 buffer = BytesIO()
                 img.save(buffer, format="PNG")
                 img_str = base64.b64encode(buffer.getvalue()).decode()
-                
+
                 # 結果を出力
                 result = {
                     "status": "success",
@@ -149,18 +235,278 @@ def capture_screen():
                     "message": str(e)
                 }
                 print(json.dumps(result))
-            
+
             root.quit()
-        
-        # イベントをバインド
-        for _, canvas in overlay_windows:
-            canvas.bind('<Button-1>', on_mouse_down)
-            canvas.bind('<B1-Motion>', on_mouse_move)
-            canvas.bind('<ButtonRelease-1>', on_mouse_up)
-            # ESCキーでキャンセル
-            canvas.bind('<Escape>', lambda e: root.quit())
-        
+
+        select_region(root, monitors, on_done)
         root.mainloop()
 
+class Capture:
+    """共有メモリに置いたキャプチャ画像 (BGRA、1行 = width * 4 バイト)"""
+
+    def __init__(self, width, height, raw):
+        self.width = width
+        self.height = height
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, len(raw)))
+        self.memory.buf[:len(raw)] = raw
+        self.lock = threading.Lock()
+        self.released = False
+
+    @property
+    def handle(self):
+        return self.memory.name
+
+    def describe(self):
+        return {
+            "handle": self.handle,
+            "width": self.width,
+            "height": self.height,
+            "format": "BGRA",
+            "stride": self.width * 4,
+            "size": self.width * self.height * 4
+        }
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+            self.memory.close()
+            self.memory.unlink()
+
+def encode_capture(capture, options, inline=False):
+    """キャプチャをエンコードしてファイルに書き出し、パスと処理時間・サイズを返す
+
+    inline のときはファイルに書かず、エンコード結果を data に入れて返す
+    (JSON行ではBase64、フレームではバイト列のまま送られる)。
+    """
+    with capture.lock:
+        if capture.released:
+            raise ValueError("キャプチャは解放済みです")
+        # 共有メモリから直接読み込む (中間のバイト列を作らない)
+        encoded = PIPELINE.encode_raw(capture.memory.buf, capture.width, capture.height, options, "BGRX", capture.width * 4)
+    return _encoded_output(encoded, options, inline, capture.width * capture.height * 4)
+
+def encode_screenshot(screenshot, options, inline=False):
+    """mss の撮影結果を共有メモリに置かずにそのままエンコードする (encode_capture と同じ形式で返す)"""
+    encoded = PIPELINE.encode_raw(screenshot.raw, screenshot.width, screenshot.height, options, "BGRX", screenshot.width * 4)
+    return _encoded_output(encoded, options, inline, len(screenshot.raw))
+
+def _encoded_output(encoded, options, inline, source_bytes):
+    if inline:
+        output = {"data": encoded.data}
+    else:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        path = os.path.join(OUTPUT_DIR, f"{encoded.digest}-{next(_output_numbers)}.{options.format}")
+        with open(path, 'wb') as f:
+            f.write(encoded.data)
+        output = {"path": path}
+    return {
+        **output,
+        "type": encoded.mime_type,
+        "width": encoded.width,
+        "height": encoded.height,
+        "bytes": len(encoded.data),
+        "source_bytes": source_bytes,
+        "encode_ms": encoded.encode_ms,
+        "hash_ms": encoded.hash_ms,
+        "cached": encoded.cached
+    }
+
+class ScreenshotDaemon:
+    """モジュールと mss のハンドルを保持し続け、標準入力のコマンドでキャプチャする
+
+    キャプチャ結果は共有メモリに置いてハンドルと寸法だけを返し、
+    エンコードは要求があったときにバックグラウンドのスレッドで行う。
+    capture / grab に encode を指定すると、キャプチャとエンコードの結果を1件の応答で返す
+    (shared: false なら共有メモリを使わずにエンコード結果だけを返す)。
+    root / sct / reader / writer はテストで差し替えるためのもの。
+    """
+
+    def __init__(self, root=None, sct=None, reader=None, writer=None):
+        if root is None:
+            root = tk.Tk()
+            root.withdraw()
+        self.root = root
+        self.sct = sct or mss.mss()
+        self.captures = OrderedDict()
+        self.commands = queue.Queue()
+        self.encoder = ThreadPoolExecutor(max_workers=ENCODER_THREADS)
+        # 応答はJSON行、hello で framing を指定されたら長さ付きフレーム
+        self.channel = framing.Channel(reader or sys.stdin.buffer, writer or sys.stdout.buffer)
+        self.selecting = False
+
+    def write_response(self, request, result):
+        if 'id' in request:
+            result = {**result, "id": request["id"]}
+        self.channel.write(result)
+
+    def _read_commands(self):
+        while True:
+            try:
+                message = self.channel.read()
+            except framing.FramingError as e:
+                # フレームの境界が分からなくなるため続けられない
+                self.write_response({}, {"status": "error", "message": str(e)})
+                break
+            except ValueError:
+                # 復号できないフレーム (次のフレームからは読める)
+                message = False
+            if message is None:
+                break
+            if isinstance(message, str):
+                if not message:
+                    continue
+                try:
+                    message = json.loads(message)
+                except json.JSONDecodeError:
+                    message = None
+            if not isinstance(message, dict):
+                self.write_response({}, {"status": "error", "message": "不正なリクエストです"})
+                continue
+            if message.get('command') == 'hello' and 'framing' in message:
+                # 形式の切り替えは応答の直後に行う必要があるため読み込みスレッドで応答する
+                response = {"status": "success", "captures": len(self.captures)}
+                if 'id' in message:
+                    response["id"] = message["id"]
+                self.channel.reply_hello(response, framing.negotiate(message['framing']))
+                continue
+            self.commands.put(message)
+        # 標準入力が閉じられたら終了
+        self.commands.put({"command": "shutdown"})
+
+    def _poll(self):
+        # tkinter と mss は同じスレッドで扱う必要があるため、コマンドはメインスレッドで処理
+        while True:
+            try:
+                request = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if not self.handle(request):
+                self.root.quit()
+                return
+        self.root.after(POLL_INTERVAL_MS, self._poll)
+
+    def handle(self, request):
+        """コマンドを処理する (終了する場合は False)"""
+        command = request.get('command')
+        try:
+            if command == 'capture':
+                self.start_selection(request)
+            elif command == 'grab':
+                self.respond_capture(request, (
+                    int(request['left']), int(request['top']), int(request['width']), int(request['height'])
+                ))
+            elif command == 'encode':
+                self.start_encode(request)
+            elif command == 'release':
+                capture = self.captures.pop(request.get('handle'), None)
+                if capture is not None:
+                    capture.release()
+                if not request.get('silent'):
+                    self.write_response(request, {"status": "success"})
+            elif command == 'stats':
+                self.write_response(request, {"status": "success", **PIPELINE.stats()})
+            elif command == 'hello':
+                self.write_response(request, {"status": "success", "captures": len(self.captures)})
+            elif command == 'shutdown':
+                return False
+            else:
+                self.write_response(request, {"status": "error", "message": "未対応のコマンドです"})
+        except Exception as e:
+            self.write_response(request, {"status": "error", "message": str(e)})
+        return True
+
+    def start_selection(self, request):
+        if self.selecting:
+            self.write_response(request, {"status": "error", "message": "範囲の選択中です"})
+            return
+        self.selecting = True
+
+        def on_done(region):
+            self.selecting = False
+            if region is None:
+                self.write_response(request, {"status": "cancelled"})
+                return
+            try:
+                self.respond_capture(request, region)
+            except Exception as e:
+                self.write_response(request, {"status": "error", "message": str(e)})
+
+        select_region(self.root, self.sct.monitors[1:], on_done)
+
+    def respond_capture(self, request, region):
+        left, top, width, height = region
+        if width <= 0 or height <= 0:
+            raise ValueError("選択範囲が空です")
+        screenshot = self.sct.grab({"left": left, "top": top, "width": width, "height": height})
+        if request.get('encode') and request.get('shared') is False:
+            # エンコード結果だけが必要な場合は共有メモリにコピーせず、応答もエンコード結果の1件だけにする
+            self.start_encode_screenshot(request, screenshot)
+            return
+        capture = Capture(screenshot.width, screenshot.height, screenshot.raw)
+        self.captures[capture.handle] = capture
+        while len(self.captures) > MAX_CAPTURES:
+            _, oldest = self.captures.popitem(last=False)
+            oldest.release()
+        if request.get('encode'):
+            # キャプチャと同時にエンコードも要求された場合は、エンコード後に両方をまとめて応答する
+            # (同じidの応答を2件書くと、呼び出し元は最初の1件しか受け取らない)
+            self.start_encode({**request, **request['encode'], "handle": capture.handle}, capture.describe())
+            return
+        self.write_response(request, {"status": "success", **capture.describe()})
+
+    def start_encode(self, request, capture_info=None):
+        capture = self.captures.get(request.get('handle'))
+        if capture is None:
+            raise ValueError("キャプチャが見つかりません")
+        options = image_pipeline.parse_options(request)
+        release = bool(request.get('release'))
+        inline = bool(request.get('inline'))
+
+        def encode():
+            try:
+                result = {"status": "success", "handle": capture.handle, **encode_capture(capture, options, inline)}
+                if capture_info is not None:
+                    # 元の画像の寸法などは capture に入れる (width / height はエンコード後の寸法)
+                    result["capture"] = capture_info
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            if release:
+                # 解放は共有メモリを管理するメインスレッドに任せる
+                self.commands.put({"command": "release", "handle": capture.handle, "silent": True})
+            self.write_response(request, result)
+
+        self.encoder.submit(encode)
+
+    def start_encode_screenshot(self, request, screenshot):
+        options = image_pipeline.parse_options(request['encode'])
+        inline = bool(request['encode'].get('inline'))
+
+        def encode():
+            try:
+                result = {"status": "success", **encode_screenshot(screenshot, options, inline)}
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            self.write_response(request, result)
+
+        self.encoder.submit(encode)
+
+    def run(self):
+        threading.Thread(target=self._read_commands, name='screenshot-stdin', daemon=True).start()
+        self.write_response({}, {"status": "ready"})
+        self.root.after(POLL_INTERVAL_MS, self._poll)
+        try:
+            self.root.mainloop()
+        finally:
+            self.encoder.shutdown(wait=True)
+            for capture in self.captures.values():
+                capture.release()
+            self.captures.clear()
+            self.sct.close()
+
 if __name__ == "__main__":
-    capture_screen() 
\ No newline at end of file
+    if '--daemon' in sys.argv[1:]:
+        ScreenshotDaemon().run()
+    else:
+        capture_screen()
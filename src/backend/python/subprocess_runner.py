@@ -2,6 +2,8 @@ import sys
 import subprocess
 import os
 
+from worker_pool import WorkerPool, DEFAULT_POOL_SIZE, REQUEST_TIMEOUT
+
 def start_calculator_process():
     script_path = os.path.join(os.path.dirname(__file__), "calculator.py")
     process = subprocess.Popen(
@@ -11,4 +13,8 @@ def start_calculator_process():
         stderr=subprocess.PIPE,
         text=True
     )
-    return process 
\ No newline at end of file
+    return process 
+
+def start_worker_pool(size=DEFAULT_POOL_SIZE, timeout=REQUEST_TIMEOUT):
+    """起動済みの計算プロセスを複数持つプールを開始 (重い式で他の計算が止まらない)"""
+    return WorkerPool(size, timeout)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# バックエンドのスクリプトはパッケージではないため、親ディレクトリから直接 import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
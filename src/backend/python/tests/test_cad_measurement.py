@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import cad_measurement
+import calculator
+
+def _calculated_total(summary):
+    result = calculator.calculate(summary["expression"])
+    assert "error" not in result, result
+    return float(result["result"])
+
+def test_expression_of_many_segments_evaluates_to_total():
+    # 3本 × 200点の閉じた点列 (600区間) をまとめて選択した場合
+    chains = cad_measurement.FakeCadBackend().measure_chains('selection')
+    summary = cad_measurement.summarize_chains(chains)
+    assert len(summary["segments"]) == 600
+    assert _calculated_total(summary) == pytest.approx(summary["total"], rel=1e-9)
+
+def test_expression_has_no_exponent_notation():
+    # 指数表記になる非常に短い区間・長い区間を含む
+    chains = [(False, [(0.0, 0.0, 0.0), (1e-7, 0.0, 0.0), (1e-7, 2.5e10, 0.0)])]
+    summary = cad_measurement.summarize_chains(chains)
+    assert 'e' not in summary["expression"]
+    assert _calculated_total(summary) == pytest.approx(summary["total"], rel=1e-9)
+
+class _Output:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.extend(json.loads(line) for line in text.splitlines())
+
+    def flush(self):
+        pass
+
+def _measure(points, **fields):
+    output = _Output()
+    service = cad_measurement.MeasurementService(cad_measurement.FakeCadBackend(points=points), output)
+    service.handle({"command": "measure", "id": 7, **fields})
+    return output.lines
+
+def test_repeated_measurement_replies_once():
+    pair = ((0.0, 0.0, 0.0), (3.0, 4.0, 0.0))
+    responses = _measure([pair] * 3, count=3)
+    assert len(responses) == 1
+    response = responses[0]
+    assert response["id"] == 7 and response["status"] == "success" and not response["cancelled"]
+    assert [result["distance"] for result in response["results"]] == [5.0] * 3
+    assert [result["index"] for result in response["results"]] == [0, 1, 2]
+
+def test_repeated_measurement_stops_at_cancel():
+    pair = ((0.0, 0.0, 0.0), (3.0, 4.0, 0.0))
+    responses = _measure([pair, None], count=3)
+    assert len(responses) == 1
+    assert responses[0]["cancelled"] and len(responses[0]["results"]) == 1
+    assert _measure([None], count=2)[0]["status"] == "cancelled"
+    # 1回だけの計測は従来どおりの形の応答
+    assert _measure([pair])[0]["distance"] == 5.0
@@ -0,0 +1,77 @@
+import itertools
+import time
+
+import pytest
+
+import calculator
+
+
+@pytest.mark.parametrize('expression', ['-', '×', '.'])
+def test_operator_only_input_is_not_an_error(expression):
+    # 負の数を入力し始めたときなどにエラーを表示しない
+    assert calculator.calculate(expression) == {"result": "", "intermediate": ""}
+
+
+def _mixed_width_inputs(max_length=4):
+    # 半角・全角の括弧を混ぜた短い式をすべて並べる
+    for length in range(1, max_length + 1):
+        for chars in itertools.product('(（)）2+×', repeat=length):
+            yield ''.join(chars)
+
+
+def test_session_matches_calculate_for_mixed_width_brackets():
+    for expression in list(_mixed_width_inputs()) + ['(5）', '2(3）+1', 'sin(30）', '（1+2)×3']:
+        session = calculator.CalculationSession()
+        session.set(expression)
+        assert session.result() == calculator.calculate(expression), expression
+
+class _FakeHistory:
+    def __init__(self):
+        self.entries = []
+
+    def append(self, expression, result, mode):
+        self.entries.append((expression, result["result"], mode))
+
+def test_history_records_only_committed_expressions(monkeypatch):
+    history = _FakeHistory()
+    monkeypatch.setattr(calculator, '_history', history)
+    # 入力途中の評価 (idつき・idなし・一括) は記録しない
+    calculator.handle_tagged_request({"id": 1, "expression": "1+2"})
+    calculator.handle_untagged_request('1+2', None)
+    calculator.handle_untagged_request('{"expression": "1+2"}', {"expression": "1+2"})
+    calculator.calculate_batch(["1+2", {"expression": "1+2"}])
+    assert history.entries == []
+    # = で確定したときだけ記録する
+    calculator.handle_tagged_request({"id": 2, "expression": "1+2", "record": True})
+    assert history.entries == [("1+2", "3", "float")]
+
+@pytest.mark.parametrize('mode', ['float', 'exact'])
+def test_long_flat_sum_is_not_too_complex(mode):
+    # 長い足し算の連なりは入れ子ではないため、深さの上限に掛からない
+    expression = '+'.join(['1.5'] * 2000)
+    assert calculator.calculate(expression, mode) == {"result": "3000", "intermediate": "3000"}
+    session = calculator.CalculationSession()
+    session.set(expression)
+    assert session.result() == calculator.calculate(expression)
+
+@pytest.mark.parametrize('mode', ['float', 'exact'])
+def test_product_of_large_powers_is_rejected_before_evaluation(mode):
+    # べき乗は1つずつなら上限内でも、掛け合わせると整数のままでは大きくなりすぎる
+    expression = '×'.join(['(2^65000)'] * 1000)
+    start = time.perf_counter()
+    result = calculator.calculate(expression, mode)
+    elapsed = time.perf_counter() - start
+    assert result["reason"] == "complexity"
+    assert elapsed < 0.5
+
+@pytest.mark.parametrize('expression', ['-x^2', 'x×-1', '2x+1', 'x÷4', 'πx', '0-x'])
+def test_array_rows_match_scalar_calculation(expression):
+    np = pytest.importorskip('numpy')
+    xs = [0, 1, -2, 0.5, 3]
+    response = calculator.evaluate_array_command({"expression": expression, "variables": {"x": xs}})
+    for x, result, intermediate in zip(xs, response["results"], response["intermediates"]):
+        scalar = calculator.calculate(expression.replace('x', f"({x})"))
+        assert {"result": result, "intermediate": intermediate} == scalar, (expression, x)
+        # 負のゼロを浮動小数点のまま表示しても同じになる
+        value = calculator.evaluate_ast(calculator.compile_expression(expression), {"x": float(x)})
+        assert calculator.format_calculation(value) == scalar, (expression, x)
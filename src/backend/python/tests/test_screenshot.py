@@ -0,0 +1,66 @@
+import io
+import json
+
+import pytest
+
+screenshot = pytest.importorskip('screenshot')
+
+class _Shot:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.raw = bytearray(b'\x10\x20\x30\xff' * (width * height))
+
+class _FakeScreen:
+    monitors = [{}, {}]
+
+    def grab(self, region):
+        return _Shot(region["width"], region["height"])
+
+def _daemon():
+    # 表示のない環境でも動くよう、画面と入出力を差し替える
+    output = io.BytesIO()
+    daemon = screenshot.ScreenshotDaemon(root=object(), sct=_FakeScreen(), reader=io.BytesIO(), writer=output)
+    return daemon, output
+
+def _finish(daemon, output):
+    # エンコードの完了を待ち、メインスレッドに任された解放も処理してから応答を読む
+    daemon.encoder.shutdown(wait=True)
+    while not daemon.commands.empty():
+        daemon.handle(daemon.commands.get())
+    return [json.loads(line) for line in output.getvalue().decode('utf-8').splitlines()]
+
+def _grab(request_id, **fields):
+    return {"command": "grab", "left": 0, "top": 0, "width": 40, "height": 30, "id": request_id, **fields}
+
+def test_grab_with_encode_replies_once_with_capture_and_image():
+    daemon, output = _daemon()
+    daemon.handle(_grab(1, encode={"format": "png", "inline": True, "release": True}))
+    responses = _finish(daemon, output)
+    assert len(responses) == 1
+    response = responses[0]
+    assert response["status"] == "success" and response["id"] == 1
+    assert response["capture"]["handle"] == response["handle"]
+    assert (response["capture"]["width"], response["capture"]["height"]) == (40, 30)
+    assert response["type"] == "image/png" and response["data"]
+    # release を指定したキャプチャは共有メモリが解放されている
+    assert not daemon.captures
+
+def test_shared_capture_is_encoded_by_handle():
+    daemon, output = _daemon()
+    daemon.handle(_grab(1))
+    capture = json.loads(output.getvalue().splitlines()[0])
+    assert capture["format"] == "BGRA" and capture["size"] == 40 * 30 * 4
+    daemon.handle({"command": "encode", "handle": capture["handle"], "format": "png", "inline": True,
+                   "release": True, "id": 2})
+    _, encoded = _finish(daemon, output)
+    assert encoded["id"] == 2 and encoded["handle"] == capture["handle"] and encoded["data"]
+    assert not daemon.captures
+
+def test_unshared_capture_replies_with_image_only():
+    daemon, output = _daemon()
+    daemon.handle(_grab(3, shared=False, encode={"format": "png", "inline": True}))
+    responses = _finish(daemon, output)
+    assert len(responses) == 1
+    assert responses[0]["id"] == 3 and "handle" not in responses[0] and responses[0]["data"]
+    assert not daemon.captures
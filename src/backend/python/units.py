@@ -0,0 +1,204 @@
+import functools
+import math
+import re
+from fractions import Fraction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class UnitError(ValueError):
+    """単位が不明、または次元が一致しない場合のエラー"""
+
+# 次元ベクトルの並び: (長さ, 質量, 時間, 角度)
+DIMENSIONLESS = (0, 0, 0, 0)
+LENGTH = (1, 0, 0, 0)
+AREA = (2, 0, 0, 0)
+VOLUME = (3, 0, 0, 0)
+MASS = (0, 1, 0, 0)
+TIME = (0, 0, 1, 0)
+ANGLE = (0, 0, 0, 1)
+FORCE = (1, 1, -2, 0)
+PRESSURE = (-1, 1, -2, 0)
+
+# 尺貫法の基準 (1尺 = 10/33 m, 1坪 = 400/121 m², 1升 = 2401/1331 L)
+_SHAKU = Fraction(10, 33)
+_TSUBO = Fraction(400, 121)
+_SHO = Fraction(2401, 1331000)
+_GRAVITY = Fraction('9.80665')
+
+# 単位名: (基本単位 m, kg, s, rad への換算係数, 次元)
+# 係数は可能な限り Fraction で持ち、×1000 / ÷1000 のような正確な表示に使う
+UNITS = {
+    # 長さ
+    'm': (Fraction(1), LENGTH),
+    'mm': (Fraction(1, 1000), LENGTH),
+    'cm': (Fraction(1, 100), LENGTH),
+    'km': (Fraction(1000), LENGTH),
+    'in': (Fraction('0.0254'), LENGTH),
+    'ft': (Fraction('0.3048'), LENGTH),
+    '寸': (_SHAKU / 10, LENGTH),
+    '尺': (_SHAKU, LENGTH),
+    '間': (_SHAKU * 6, LENGTH),
+    '丈': (_SHAKU * 10, LENGTH),
+    # 面積
+    'a': (Fraction(100), AREA),
+    'ha': (Fraction(10000), AREA),
+    '畳': (_TSUBO / 2, AREA),
+    '坪': (_TSUBO, AREA),
+    '畝': (_TSUBO * 30, AREA),
+    '反': (_TSUBO * 300, AREA),
+    '町': (_TSUBO * 3000, AREA),
+    # 体積
+    'mL': (Fraction(1, 1000000), VOLUME),
+    'L': (Fraction(1, 1000), VOLUME),
+    '合': (_SHO / 10, VOLUME),
+    '升': (_SHO, VOLUME),
+    '斗': (_SHO * 10, VOLUME),
+    '立坪': ((_SHAKU * 6) ** 3, VOLUME),
+    # 質量
+    'mg': (Fraction(1, 1000000), MASS),
+    'g': (Fraction(1, 1000), MASS),
+    'kg': (Fraction(1), MASS),
+    't': (Fraction(1000), MASS),
+    '匁': (Fraction('0.00375'), MASS),
+    '斤': (Fraction('0.6'), MASS),
+    '貫': (Fraction('3.75'), MASS),
+    # 時間 (複合単位用)
+    's': (Fraction(1), TIME),
+    'min': (Fraction(60), TIME),
+    'h': (Fraction(3600), TIME),
+    # 角度
+    'rad': (Fraction(1), ANGLE),
+    'deg': (math.pi / 180, ANGLE),
+    # 力
+    'N': (Fraction(1), FORCE),
+    'kN': (Fraction(1000), FORCE),
+    'kgf': (_GRAVITY, FORCE),
+    'tf': (_GRAVITY * 1000, FORCE),
+    # 圧力
+    'Pa': (Fraction(1), PRESSURE),
+    'kPa': (Fraction(1000), PRESSURE),
+    'MPa': (Fraction(1000000), PRESSURE),
+    'bar': (Fraction(100000), PRESSURE),
+    'atm': (Fraction(101325), PRESSURE),
+}
+
+# 長さの単位は m2 / mm3 のような累乗形も単独の単位として扱う
+_POWERED_LENGTH_UNITS = ('m', 'mm', 'cm', 'km', '尺', '寸', '間')
+
+# 表記ゆれの置き換え
+_UNIT_ALIASES = {
+    '㎡': 'm2',
+    '㎥': 'm3',
+    '㎜': 'mm',
+    '㎝': 'cm',
+    '㎞': 'km',
+    '㎏': 'kg',
+    'ℓ': 'L',
+    'l': 'L',
+    'ml': 'mL',
+    '°': 'deg',
+    'ton': 't',
+}
+_SUPERSCRIPTS = str.maketrans({'²': '2', '³': '3'})
+
+# 単位記号と指数 (例: mm2, m^3, s-2)
+_UNIT_TERM = re.compile(r'^(.+?)\^?(-?\d+)?$')
+
+def _normalize_unit(text):
+    text = str(text).strip().translate(_SUPERSCRIPTS)
+    return _UNIT_ALIASES.get(text, text)
+
+def _lookup_term(term):
+    term = _normalize_unit(term)
+    if term in UNITS:
+        return UNITS[term]
+    match = _UNIT_TERM.match(term)
+    if not match:
+        raise UnitError("未対応の単位変換です")
+    name = _normalize_unit(match.group(1))
+    if name not in UNITS:
+        raise UnitError("未対応の単位変換です")
+    exponent = int(match.group(2) or 1)
+    factor, dimension = UNITS[name]
+    return factor ** exponent, tuple(d * exponent for d in dimension)
+
+@functools.lru_cache(maxsize=256)
+def parse_unit(text):
+    """単位式 (例: m2, kN/m2, kg/m3) を (基本単位への係数, 次元) に変換"""
+    normalized = _normalize_unit(text)
+    if not normalized:
+        raise UnitError("未対応の単位変換です")
+    factor = Fraction(1)
+    dimension = DIMENSIONLESS
+    for index, part in enumerate(normalized.split('/')):
+        sign = 1 if index == 0 else -1
+        for term in re.split(r'[*·・]', part):
+            term_factor, term_dimension = _lookup_term(term)
+            factor = factor * term_factor if sign > 0 else factor / term_factor
+            dimension = tuple(d + sign * t for d, t in zip(dimension, term_dimension))
+    return factor, dimension
+
+def _conversion_step(ratio):
+    """換算比を (演算子, 数値) に変換 (1/n は ÷n として表示・計算する)"""
+    if isinstance(ratio, Fraction):
+        if ratio.denominator == 1:
+            return ('*', ratio.numerator)
+        if ratio.numerator == 1:
+            return ('/', ratio.denominator)
+    return ('*', float(ratio))
+
+def _build_conversion_table():
+    names = list(UNITS) + [f"{name}{power}" for name in _POWERED_LENGTH_UNITS for power in (2, 3)]
+    parsed = {name: parse_unit(name) for name in names}
+    table = {}
+    for from_name, (from_factor, from_dimension) in parsed.items():
+        for to_name, (to_factor, to_dimension) in parsed.items():
+            if from_dimension == to_dimension:
+                table[(from_name, to_name)] = _conversion_step(from_factor / to_factor)
+    return table
+
+# 登録済みの単位の全組み合わせについて、読み込み時に換算方法を求めておく
+CONVERSION_TABLE = _build_conversion_table()
+
+@functools.lru_cache(maxsize=1024)
+def _compound_conversion(from_unit, to_unit):
+    from_factor, from_dimension = parse_unit(from_unit)
+    to_factor, to_dimension = parse_unit(to_unit)
+    if from_dimension != to_dimension:
+        raise UnitError("単位の次元が一致しません")
+    return _conversion_step(from_factor / to_factor)
+
+def get_conversion(from_unit, to_unit):
+    """単位変換の (演算子, 数値) を返す"""
+    step = CONVERSION_TABLE.get((from_unit, to_unit))
+    if step is None:
+        if from_unit is None or to_unit is None:
+            raise UnitError("未対応の単位変換です")
+        step = _compound_conversion(from_unit, to_unit)
+    return step
+
+def format_unit_value(number):
+    """不要な小数点以下の0を削除"""
+    return f"{number:.10f}".rstrip('0').rstrip('.')
+
+def convert(value, from_unit, to_unit):
+    """値を変換し、(結果, 途中式) を返す"""
+    op, factor = get_conversion(from_unit, to_unit)
+    result = value * factor if op == '*' else value / factor
+    symbol = '×' if op == '*' else '÷'
+    intermediate = f"{format_unit_value(value)}{symbol}{format_unit_value(factor)}={format_unit_value(result)}"
+    return result, intermediate
+
+def convert_array(values, from_unit, to_unit):
+    """値の配列をまとめて変換 (NumPyがあれば配列演算で処理)"""
+    op, factor = get_conversion(from_unit, to_unit)
+    if np is not None:
+        array = np.asarray(values, dtype=np.float64)
+        return array * factor if op == '*' else array / factor
+    values = [float(value) for value in values]
+    if op == '*':
+        return [value * factor for value in values]
+    return [value / factor for value in values]
@@ -0,0 +1,599 @@
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+import wave
+from array import array
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+try:
+    import speech_recognition as sr
+except ImportError:
+    sr = None
+
+try:
+    import vosk
+except ImportError:
+    vosk = None
+
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
+
+# 入力の形式 (16kHz、16bit、モノラル)
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# VAD の判定単位 (ミリ秒)。webrtcvad は 10 / 20 / 30 ms のみ受け付ける
+FRAME_MS = 30
+
+# リングバッファに保持する音声の長さ (秒)。認識が追いつかない場合は古い音声から捨てる
+RING_SECONDS = 10
+
+# 起動直後に環境ノイズを測る時間 (ミリ秒)
+CALIBRATION_MS = 500
+
+# 発話開始とみなす連続した有声フレーム数
+START_FRAMES = 3
+
+# 発話終了とみなす無音の長さ (ミリ秒)
+END_SILENCE_MS = 300
+
+# 発話開始の直前から含める音声の長さ (ミリ秒)
+PREROLL_MS = 300
+
+# 1つの発話の最大長 (ミリ秒)。超えたら区切って認識する
+MAX_SEGMENT_MS = 10000
+
+# エネルギーVAD: 環境ノイズの何倍を有声とみなすか、および最小のしきい値 (RMS)
+ENERGY_RATIO = 3.0
+MIN_ENERGY = 300
+
+# 音量を出力する間隔 (ミリ秒)
+LEVEL_INTERVAL_MS = 100
+
+# 無音のときの音量 (dBFS)。16bit の量子化ノイズ程度
+MIN_DBFS = -96.0
+
+# 16bit PCM の最大振幅
+FULL_SCALE = 32768
+
+# 再生用の認識器が1文字を出すのに要する音声の長さ (ミリ秒)
+REPLAY_MS_PER_CHAR = 120
+
+class RecognitionError(Exception):
+    """認識器の呼び出しに失敗した (ネットワークエラーなど)"""
+
+def frame_bytes(frame_ms=FRAME_MS, sample_rate=SAMPLE_RATE):
+    return sample_rate * frame_ms // 1000 * SAMPLE_WIDTH
+
+def frame_levels(frame):
+    """16bit PCM のフレームの (二乗の合計, サンプル数, ピーク) を返す (フレームはコピーしない)"""
+    if np is not None:
+        samples = np.frombuffer(frame, dtype='<i2')
+        if not samples.size:
+            return 0, 0, 0
+        values = samples.astype(np.float64)
+        return float(np.dot(values, values)), samples.size, max(int(samples.max()), -int(samples.min()))
+    if sys.byteorder == 'little':
+        samples = memoryview(frame).cast('h')
+    else:
+        samples = array('h', frame)
+        samples.byteswap()
+    if not len(samples):
+        return 0, 0, 0
+    return sum(sample * sample for sample in samples), len(samples), max(max(samples), -min(samples))
+
+def frame_rms(frame):
+    """16bit PCM のフレームの二乗平均平方根"""
+    squares, count, _ = frame_levels(frame)
+    return (squares / count) ** 0.5 if count else 0.0
+
+def to_dbfs(value):
+    """振幅をフルスケール基準のデシベルにする"""
+    if value <= 0:
+        return MIN_DBFS
+    # round() の結果が -0.0 になる場合は 0.0 にする
+    return max(MIN_DBFS, round(20 * math.log10(value / FULL_SCALE), 1)) or 0.0
+
+class LevelMeter:
+    """フレームごとの音量をまとめ、一定間隔で RMS とピーク (dBFS) を出力する
+
+    間隔は音声の長さで数えるため、入力が実時間なら出力も一定の頻度になる。
+    """
+
+    def __init__(self, emit, interval_ms=LEVEL_INTERVAL_MS, frame_ms=FRAME_MS, vad=None):
+        self.emit = emit
+        self.frames_per_report = max(1, interval_ms // frame_ms)
+        self.vad = vad
+        self._frames = 0
+        self._squares = 0
+        self._count = 0
+        self._peak = 0
+
+    def feed(self, frame):
+        squares, count, peak = frame_levels(frame)
+        self._squares += squares
+        self._count += count
+        if peak > self._peak:
+            self._peak = peak
+        self._frames += 1
+        if self._frames >= self.frames_per_report:
+            self.publish()
+
+    def publish(self):
+        if not self._frames:
+            return
+        message = {
+            "status": "level",
+            "rms_dbfs": to_dbfs((self._squares / self._count) ** 0.5 if self._count else 0),
+            "peak_dbfs": to_dbfs(self._peak)
+        }
+        # エネルギーVAD の環境ノイズとしきい値 (自動調整の結果)
+        if isinstance(self.vad, EnergyVAD):
+            message["noise_dbfs"] = to_dbfs(self.vad.noise)
+            message["threshold_dbfs"] = to_dbfs(self.vad.threshold)
+        self.emit(message)
+        self._frames = 0
+        self._squares = 0
+        self._count = 0
+        self._peak = 0
+
+class AudioRingBuffer:
+    """固定長のリングバッファ (書き込みは音声入力のスレッド、読み出しは VAD のスレッド)
+
+    読み出しが遅れて満杯になった場合は古い音声から捨て、捨てたバイト数を dropped に数える。
+    """
+
+    def __init__(self, capacity):
+        # サンプルの途中で区切らないよう、容量はサンプル幅の倍数にする
+        self.capacity = capacity - capacity % SAMPLE_WIDTH
+        self._buffer = bytearray(self.capacity)
+        self._read = 0
+        self._write = 0
+        self._cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def write(self, data):
+        if len(data) > self.capacity:
+            data = data[-self.capacity:]
+        with self._cond:
+            overflow = self._write + len(data) - self._read - self.capacity
+            if overflow > 0:
+                self._read += overflow
+                self.dropped += overflow
+            offset = self._write % self.capacity
+            first = min(len(data), self.capacity - offset)
+            view = memoryview(data)
+            self._buffer[offset:offset + first] = view[:first]
+            self._buffer[:len(data) - first] = view[first:]
+            self._write += len(data)
+            self._cond.notify()
+
+    def read(self, size, timeout=None):
+        """size バイトを読み出す (閉じられて足りない場合は None)"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._write - self._read >= size or self.closed, timeout):
+                return None
+            if self._write - self._read < size:
+                return None
+            offset = self._read % self.capacity
+            first = min(size, self.capacity - offset)
+            data = bytes(self._buffer[offset:offset + first]) + bytes(self._buffer[:size - first])
+            self._read += size
+            return data
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+class EnergyVAD:
+    """フレームのエネルギーで有声か判定する (しきい値は環境ノイズから自動で決める)"""
+
+    name = 'energy'
+
+    def __init__(self, ratio=ENERGY_RATIO, min_energy=MIN_ENERGY, calibration_frames=CALIBRATION_MS // FRAME_MS):
+        self.ratio = ratio
+        self.min_energy = min_energy
+        self.calibration_frames = calibration_frames
+        self._calibrated = 0
+        self.noise = 0.0
+
+    @property
+    def threshold(self):
+        return max(self.min_energy, self.noise * self.ratio)
+
+    def is_speech(self, frame):
+        energy = frame_rms(frame)
+        if self._calibrated < self.calibration_frames:
+            # 起動直後の音声は環境ノイズとして平均する
+            self._calibrated += 1
+            self.noise += (energy - self.noise) / self._calibrated
+            return False
+        speech = energy > self.threshold
+        if not speech:
+            # 環境ノイズの変化にゆっくり追従する
+            self.noise += (energy - self.noise) * 0.05
+        return speech
+
+class WebRTCVAD:
+    """webrtcvad による判定 (雑音に強い。未インストールなら使えない)"""
+
+    name = 'webrtc'
+
+    def __init__(self, aggressiveness=2, sample_rate=SAMPLE_RATE):
+        if webrtcvad is None:
+            raise RuntimeError("webrtcvad がインストールされていません")
+        self._vad = webrtcvad.Vad(aggressiveness)
+        self.sample_rate = sample_rate
+
+    def is_speech(self, frame):
+        return self._vad.is_speech(frame, self.sample_rate)
+
+def create_vad(kind='auto'):
+    """VAD を作る (auto は webrtcvad があればそれを使う)"""
+    if kind == 'webrtc' or (kind == 'auto' and webrtcvad is not None):
+        return WebRTCVAD()
+    if kind in ('auto', 'energy'):
+        return EnergyVAD()
+    raise ValueError(f"未対応のVADです: {kind}")
+
+class Segmenter:
+    """VAD の判定から発話の区間を切り出す
+
+    feed() はフレームごとに ('start', None) / ('audio', frame) / ('end', None) のイベントを返す。
+    """
+
+    def __init__(self, vad, frame_ms=FRAME_MS, start_frames=START_FRAMES,
+                 end_silence_ms=END_SILENCE_MS, preroll_ms=PREROLL_MS, max_segment_ms=MAX_SEGMENT_MS):
+        self.vad = vad
+        self.start_frames = start_frames
+        self.end_frames = max(1, end_silence_ms // frame_ms)
+        self.max_frames = max(1, max_segment_ms // frame_ms)
+        self._preroll = deque(maxlen=max(start_frames, preroll_ms // frame_ms))
+        self.triggered = False
+        self._voiced = 0
+        self._silent = 0
+        self._length = 0
+
+    def feed(self, frame):
+        speech = self.vad.is_speech(frame)
+        if not self.triggered:
+            self._preroll.append(frame)
+            self._voiced = self._voiced + 1 if speech else 0
+            if self._voiced < self.start_frames:
+                return []
+            # 発話の開始: 直前の音声も含めて認識器に渡す
+            self.triggered = True
+            self._silent = 0
+            self._length = len(self._preroll)
+            events = [('start', None)] + [('audio', buffered) for buffered in self._preroll]
+            self._preroll.clear()
+            return events
+
+        self._length += 1
+        self._silent = 0 if speech else self._silent + 1
+        events = [('audio', frame)]
+        if self._silent >= self.end_frames or self._length >= self.max_frames:
+            events.append(('end', None))
+            self._reset()
+        return events
+
+    def flush(self):
+        """入力の終了時に、途中の発話を終わらせる"""
+        if not self.triggered:
+            return []
+        self._reset()
+        return [('end', None)]
+
+    def _reset(self):
+        self.triggered = False
+        self._voiced = 0
+        self._silent = 0
+        self._length = 0
+
+class Recognizer:
+    """認識器のインターフェース
+
+    begin() で発話を始め、accept() にフレームを順に渡す (途中結果があれば文字列を返す)。
+    end() で発話を終えて確定した文字列を返す (聞き取れなければ空文字列)。
+    """
+
+    name = 'base'
+
+    def begin(self):
+        pass
+
+    def accept(self, frame):
+        return None
+
+    def end(self):
+        return ''
+
+    def close(self):
+        pass
+
+class VoskRecognizer(Recognizer):
+    """Vosk によるオフライン認識 (ネットワーク不要、認識しながら途中結果を返す)"""
+
+    name = 'vosk'
+
+    def __init__(self, model_path, sample_rate=SAMPLE_RATE):
+        if vosk is None:
+            raise RuntimeError("vosk がインストールされていません")
+        if not model_path or not os.path.isdir(model_path):
+            raise RuntimeError("Voskのモデルが見つかりません")
+        vosk.SetLogLevel(-1)
+        self.model = vosk.Model(model_path)
+        self.sample_rate = sample_rate
+        self._recognizer = None
+        self._done = []
+
+    def begin(self):
+        self._recognizer = vosk.KaldiRecognizer(self.model, self.sample_rate)
+        self._done = []
+
+    def accept(self, frame):
+        if self._recognizer.AcceptWaveform(frame):
+            self._done.append(_join_words(json.loads(self._recognizer.Result()).get('text', '')))
+            return ''.join(self._done)
+        return ''.join(self._done) + _join_words(json.loads(self._recognizer.PartialResult()).get('partial', ''))
+
+    def end(self):
+        self._done.append(_join_words(json.loads(self._recognizer.FinalResult()).get('text', '')))
+        self._recognizer = None
+        return ''.join(self._done)
+
+def _join_words(text):
+    # 日本語のモデルは単語を空白で区切って返す
+    return text.replace(' ', '')
+
+class GoogleRecognizer(Recognizer):
+    """speech_recognition 経由の Google 音声認識 (発話の終了後にまとめて送る)"""
+
+    name = 'google'
+
+    def __init__(self, language='ja-JP', sample_rate=SAMPLE_RATE):
+        if sr is None:
+            raise RuntimeError("speech_recognition がインストールされていません")
+        self._recognizer = sr.Recognizer()
+        self.language = language
+        self.sample_rate = sample_rate
+        self._frames = []
+
+    def begin(self):
+        self._frames = []
+
+    def accept(self, frame):
+        self._frames.append(frame)
+        return None
+
+    def end(self):
+        audio = sr.AudioData(b''.join(self._frames), self.sample_rate, SAMPLE_WIDTH)
+        self._frames = []
+        try:
+            return self._recognizer.recognize_google(audio, language=self.language)
+        except sr.UnknownValueError:
+            return ''
+        except sr.RequestError as e:
+            raise RecognitionError(str(e))
+
+class ReplayRecognizer(Recognizer):
+    """テスト用: 台本のファイルを1行ずつ、発話ごとの認識結果として返す
+
+    途中結果として、受け取った音声の長さに応じて先頭から少しずつ文字を返す。
+    """
+
+    name = 'replay'
+
+    def __init__(self, transcript_path, frame_ms=FRAME_MS):
+        with open(transcript_path, encoding='utf-8') as f:
+            self._lines = deque(line.strip() for line in f if line.strip())
+        self.frame_ms = frame_ms
+        self._text = ''
+        self._frames = 0
+
+    def begin(self):
+        self._text = self._lines.popleft() if self._lines else ''
+        self._frames = 0
+
+    def accept(self, frame):
+        self._frames += 1
+        return self._text[:self._frames * self.frame_ms // REPLAY_MS_PER_CHAR] or None
+
+    def end(self):
+        return self._text
+
+def create_recognizer(backend='auto', model_path=None, transcript_path=None):
+    """認識器を作る (auto は Vosk のモデルがあればオフライン認識、なければ Google)"""
+    model_path = model_path or os.environ.get('VOSK_MODEL_PATH')
+    if backend == 'replay':
+        return ReplayRecognizer(transcript_path)
+    if backend == 'vosk' or (backend == 'auto' and vosk is not None and model_path and os.path.isdir(model_path)):
+        return VoskRecognizer(model_path)
+    if backend in ('auto', 'google'):
+        return GoogleRecognizer()
+    raise ValueError(f"未対応の認識方式です: {backend}")
+
+class MicrophoneSource:
+    """マイクの音声をコールバックでリングバッファに書き込む (読み出しを待たない)"""
+
+    def __init__(self, frame_ms=FRAME_MS):
+        if pyaudio is None:
+            raise RuntimeError("pyaudio がインストールされていません")
+        self.frame_ms = frame_ms
+        self._audio = pyaudio.PyAudio()
+        self._stream = None
+
+    @property
+    def device_name(self):
+        return self._audio.get_default_input_device_info()['name']
+
+    def start(self, ring):
+        def callback(data, frame_count, time_info, status):
+            ring.write(data)
+            return (None, pyaudio.paContinue)
+
+        self._stream = self._audio.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=SAMPLE_RATE,
+            input=True,
+            frames_per_buffer=SAMPLE_RATE * self.frame_ms // 1000,
+            stream_callback=callback
+        )
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        self._audio.terminate()
+
+class WavFileSource:
+    """WAVファイルをマイクの代わりに流す (テストや再現用、realtime=False なら待たずに流す)"""
+
+    def __init__(self, path, frame_ms=FRAME_MS, realtime=True):
+        self.path = path
+        self.frame_ms = frame_ms
+        self.realtime = realtime
+        self.device_name = os.path.basename(path)
+        with wave.open(path, 'rb') as f:
+            if (f.getnchannels(), f.getsampwidth(), f.getframerate()) != (1, SAMPLE_WIDTH, SAMPLE_RATE):
+                raise ValueError(f"WAVファイルは {SAMPLE_RATE}Hz、16bit、モノラルにしてください")
+        self._stopped = threading.Event()
+
+    def start(self, ring):
+        threading.Thread(target=self._run, args=(ring,), name='voice-wav', daemon=True).start()
+
+    def _run(self, ring):
+        samples = SAMPLE_RATE * self.frame_ms // 1000
+        started = time.monotonic()
+        sent = 0
+        with wave.open(self.path, 'rb') as f:
+            while not self._stopped.is_set():
+                data = f.readframes(samples)
+                if not data:
+                    break
+                ring.write(data)
+                sent += 1
+                if self.realtime:
+                    delay = started + sent * self.frame_ms / 1000 - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        ring.close()
+
+    def stop(self):
+        self._stopped.set()
+
+# 音量 (VAD のスレッド) と認識結果 (認識スレッド) の行が混ざらないようにする
+_print_lock = threading.Lock()
+
+def print_json(message):
+    line = json.dumps(message, ensure_ascii=False)
+    with _print_lock:
+        print(line)
+        sys.stdout.flush()
+
+class VoicePipeline:
+    """音声入力 → リングバッファ → VAD による区切り → 認識スレッド の順に処理する
+
+    認識は別スレッドで行うため、ネットワーク待ちの間も音声の読み取りと区切りは止まらない。
+    途中結果は {"status": "partial"}、確定した結果は {"status": "success"} の JSON 行で出力する。
+    annotate を渡すと、確定した文字列から作った項目 (dict) を success の行に加える。
+    level_interval_ms ごとに音量を {"status": "level"} の行で出力する (0 なら出力しない)。
+    """
+
+    def __init__(self, source, recognizer, vad=None, emit=print_json, frame_ms=FRAME_MS, annotate=None,
+                 level_interval_ms=LEVEL_INTERVAL_MS):
+        self.source = source
+        self.recognizer = recognizer
+        self.vad = vad or create_vad()
+        self.emit = emit
+        self.frame_ms = frame_ms
+        self.annotate = annotate
+        self.ring = AudioRingBuffer(frame_bytes(frame_ms) * (RING_SECONDS * 1000 // frame_ms))
+        self.segmenter = Segmenter(self.vad, frame_ms)
+        self.meter = LevelMeter(emit, level_interval_ms, frame_ms, self.vad) if level_interval_ms else None
+        self._events = queue.Queue()
+        self._worker = threading.Thread(target=self._recognize_loop, name='voice-recognizer', daemon=True)
+
+    def run(self):
+        """入力が終わるまで (または stop() まで) 処理を続ける"""
+        self._worker.start()
+        self.source.start(self.ring)
+        size = frame_bytes(self.frame_ms)
+        try:
+            while True:
+                frame = self.ring.read(size)
+                if frame is None:
+                    break
+                if self.meter is not None:
+                    self.meter.feed(frame)
+                for event in self.segmenter.feed(frame):
+                    self._events.put(event)
+        finally:
+            for event in self.segmenter.flush():
+                self._events.put(event)
+            self._events.put(None)
+            self.source.stop()
+            self._worker.join()
+            self.recognizer.close()
+
+    def stop(self):
+        self.ring.close()
+
+    def _recognize_loop(self):
+        segment = 0
+        started = None
+        partial = None
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            kind, frame = event
+            try:
+                if kind == 'start':
+                    segment += 1
+                    started = time.monotonic()
+                    partial = None
+                    self.recognizer.begin()
+                elif kind == 'audio':
+                    text = self.recognizer.accept(frame)
+                    # 変化したときだけ途中結果を出す
+                    if text and text != partial:
+                        partial = text
+                        self.emit({
+                            "status": "partial",
+                            "text": text,
+                            "segment": segment,
+                            "elapsed_ms": round((time.monotonic() - started) * 1000)
+                        })
+                else:
+                    finished = time.monotonic()
+                    text = self.recognizer.end()
+                    message = {"status": "success" if text else "no_speech", "text": text, "segment": segment}
+                    if text and self.annotate is not None:
+                        message.update(self.annotate(text))
+                    message["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+                    message["latency_ms"] = round((time.monotonic() - finished) * 1000)
+                    self.emit(message)
+            except RecognitionError as e:
+                self.emit({"text": "", "status": "error", "message": str(e), "segment": segment})
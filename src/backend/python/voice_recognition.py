@@ -1,82 +1,65 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import speech_recognition as sr
-import pyaudio
+import argparse
 import json
 import sys
 import io
 
+import calculator
+import japanese_expression
+import voice_pipeline
+
 # 標準出力のエンコーディングをUTF-8に設定
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 
+def annotate_expression(text):
+    """読み上げが式なら、変換した式と計算結果を返す (式でなければ何も加えない)"""
+    try:
+        expression = japanese_expression.convert(text)
+    except ValueError:
+        return {}
+    return {"expression": expression, "calculation": calculator.calculate(expression)}
+
 def main():
-    recognizer = sr.Recognizer()
-    
+    parser = argparse.ArgumentParser(description="音声認識 (結果をJSON行で出力)")
+    parser.add_argument('--backend', choices=['auto', 'vosk', 'google', 'replay'], default='auto',
+                        help="認識方式 (auto は Vosk のモデルがあればオフライン認識)")
+    parser.add_argument('--model', help="Voskのモデルのディレクトリ (既定は環境変数 VOSK_MODEL_PATH)")
+    parser.add_argument('--vad', choices=['auto', 'energy', 'webrtc'], default='auto', help="発話区間の検出方式")
+    parser.add_argument('--wav', help="マイクの代わりに流すWAVファイル (16kHz、16bit、モノラル)")
+    parser.add_argument('--level-interval', type=int, default=voice_pipeline.LEVEL_INTERVAL_MS,
+                        help="音量を出力する間隔 (ミリ秒、0 で出力しない)")
+    parser.add_argument('--transcript', help="--backend replay で返す台本 (1行が1発話)")
+    args = parser.parse_args()
+
     try:
-        with sr.Microphone() as source:
-            print(json.dumps({"status": "info", "message": "マイクテストを開始します..."}, ensure_ascii=False))
-            sys.stdout.flush()
-            
-            # マイクの情報を取得
-            p = pyaudio.PyAudio()
-            device_info = p.get_default_input_device_info()
-            print(json.dumps({
-                "status": "info", 
-                "message": f"マイク入力デバイス: {device_info['name']}"
-            }, ensure_ascii=False))
-            
-            # 環境ノイズを調整
-            print(json.dumps({"status": "info", "message": "環境ノイズを調整中..."}, ensure_ascii=False))
-            recognizer.adjust_for_ambient_noise(source, duration=1)
-            
-            # 実際の音声レベルをモニタリング
-            print(json.dumps({"status": "info", "message": "音声レベルをテスト中..."}, ensure_ascii=False))
-            for _ in range(5):  # 5秒間テスト
-                try:
-                    audio = recognizer.listen(source, timeout=1, phrase_time_limit=1)
-                    level = max(abs(x) for x in audio.get_raw_data())
-                    print(json.dumps({
-                        "status": "info",
-                        "message": f"音声レベル: {level}"
-                    }, ensure_ascii=False))
-                except sr.WaitTimeoutError:
-                    print(json.dumps({
-                        "status": "info",
-                        "message": "音声が検出されませんでした"
-                    }, ensure_ascii=False))
-                sys.stdout.flush()
-            
-            p.terminate()  # PyAudioのクリーンアップ
-            
-            # 通常の音声認識処理を続ける
-            print(json.dumps({"status": "info", "message": "音声認識を開始しました"}, ensure_ascii=False))
-            sys.stdout.flush()
-            
-            while True:
-                try:
-                    # タイムアウト時間を延長（5秒）
-                    audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-                    text = recognizer.recognize_google(audio, language='ja-JP')
-                    
-                    result = {"text": text, "status": "success"}
-                    print(json.dumps(result, ensure_ascii=False))
-                    sys.stdout.flush()
-                    
-                except sr.WaitTimeoutError:
-                    # タイムアウトは正���なケースとして処理
-                    continue
-                    
-                except sr.UnknownValueError:
-                    result = {"text": "", "status": "no_speech"}
-                    print(json.dumps(result, ensure_ascii=False))
-                    sys.stdout.flush()
-                    
-                except sr.RequestError as e:
-                    result = {"text": "", "status": "error", "message": str(e)}
-                    print(json.dumps(result, ensure_ascii=False))
-                    sys.stdout.flush()
-                    
+        print(json.dumps({"status": "info", "message": "マイクテストを開始します..."}, ensure_ascii=False))
+        sys.stdout.flush()
+
+        recognizer = voice_pipeline.create_recognizer(args.backend, args.model, args.transcript)
+        if args.wav:
+            source = voice_pipeline.WavFileSource(args.wav)
+        else:
+            source = voice_pipeline.MicrophoneSource()
+        print(json.dumps({
+            "status": "info",
+            "message": f"マイク入力デバイス: {source.device_name}"
+        }, ensure_ascii=False))
+
+        # 環境ノイズは最初の音声から VAD が自動で調整する
+        pipeline = voice_pipeline.VoicePipeline(
+            source, recognizer, voice_pipeline.create_vad(args.vad), annotate=annotate_expression,
+            level_interval_ms=args.level_interval
+        )
+        print(json.dumps({
+            "status": "info",
+            "message": f"音声認識を開始しました ({recognizer.name} / {pipeline.vad.name})"
+        }, ensure_ascii=False))
+        sys.stdout.flush()
+
+        pipeline.run()
+
     except KeyboardInterrupt:
         sys.exit(0)
     except Exception as e:
@@ -88,4 +71,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
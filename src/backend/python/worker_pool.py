@@ -0,0 +1,433 @@
+import argparse
+import codecs
+import collections
+import itertools
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import framing
+
+try:
+    import resource
+except ImportError:
+    # Windows では CPU時間の上限を使えないため、経過時間だけで打ち切る
+    resource = None
+
+# 常に起動しておく計算プロセスの数
+DEFAULT_POOL_SIZE = max(2, min(4, os.cpu_count() or 1))
+
+# 1リクエストあたりの制限時間 (秒)。計算プロセスのCPU時間の上限として設定し、超えたプロセスは起動し直す
+REQUEST_TIMEOUT = 5.0
+
+# CPU時間の上限を使える環境での経過時間の上限 (制限時間の倍数)。CPUを使わずに止まったプロセスを打ち切る
+WALL_CLOCK_FACTOR = 3
+
+# CPU時間の上限を超えた計算プロセスが受け取るシグナル
+_SIGXCPU = getattr(signal, 'SIGXCPU', None)
+
+# 制限時間の確認間隔 (秒)
+MONITOR_INTERVAL = 0.05
+
+# プロセスの異常終了に巻き込まれたリクエストを再送する回数の上限
+MAX_ATTEMPTS = 2
+
+# calculator.PROTOCOL_VERSION と同じ値
+PROTOCOL_VERSION = 1
+
+TIMEOUT_ERROR = "計算がタイムアウトしました"
+WORKER_ERROR = "計算プロセスが終了しました"
+
+def calculator_command():
+    """計算プロセスの起動コマンド"""
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "calculator.py")]
+
+class _Pending:
+    """計算プロセスに送ったリクエストと、その結果を受け取る Future"""
+
+    def __init__(self, request, future, deadline):
+        self.request = request
+        self.future = future
+        self.deadline = deadline
+        self.attempts = 1
+
+class _Worker:
+    """計算プロセス1つ分の入出力"""
+
+    def __init__(self, pool, slot, command):
+        self.pool = pool
+        self.slot = slot
+        self.ready = False
+        self.alive = True
+        self.pending = {}
+        self._outbox = queue.Queue()
+        env = dict(os.environ)
+        if pool.cpu_limited:
+            env['CALCULATOR_CPU_LIMIT'] = str(pool.timeout)
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+            env=env
+        )
+        # hello の応答までJSON行、以降は決まった形式のフレーム
+        self.channel = framing.Channel(self.process.stdout, self.process.stdin)
+        # 書き込みは専用スレッドで行い、計算中で入力を読まないプロセスにプール全体が止められないようにする
+        threading.Thread(target=self._write_loop, name=f'calculator-{slot}-writer', daemon=True).start()
+        threading.Thread(target=self._read_loop, name=f'calculator-{slot}-reader', daemon=True).start()
+
+    def send(self, message):
+        # 形式は書き込む時点のもので変換する (hello の応答より後に送るものはフレームになる)
+        self._outbox.put(message)
+
+    def kill(self):
+        self.alive = False
+        self._outbox.put(None)
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                break
+            try:
+                data = self.channel.encode(message)
+            except (TypeError, ValueError):
+                continue
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+            except (OSError, ValueError):
+                break
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+
+    def _read_loop(self):
+        while True:
+            try:
+                response = self.channel.read()
+            except framing.FramingError:
+                # 応答の境界が分からなくなったプロセスは使えない
+                self.kill()
+                break
+            except ValueError:
+                continue
+            if response is None:
+                break
+            if isinstance(response, str):
+                try:
+                    response = json.loads(response)
+                except json.JSONDecodeError:
+                    continue
+            if not isinstance(response, dict):
+                continue
+            if response.get('id') == 0 and not self.channel.framed and response.get('framing', framing.JSON_LINES) != framing.JSON_LINES:
+                # hello の応答で決まった形式に、受付可能にする前に切り替える
+                self.channel.codec = framing.negotiate(response['framing'])
+            self.pool._on_response(self, response)
+        self.process.wait()
+        self.pool._on_worker_exit(self)
+
+class WorkerPool:
+    """起動済みの計算プロセスを複数保持し、リクエストを振り分ける
+
+    応答待ちの少ないプロセスへ送り、制限時間を超えたプロセスは強制終了して
+    バックグラウンドで起動し直す。重い式が1つあっても他のリクエストは止まらない。
+    制限時間は計算プロセスのCPU時間の上限 (RLIMIT_CPU) とし、経過時間はその
+    WALL_CLOCK_FACTOR 倍で打ち切る。上限を設定できない環境では経過時間で打ち切る。
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, timeout=REQUEST_TIMEOUT, command=None, formats=None):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.cpu_limited = resource is not None and _SIGXCPU is not None
+        self.wall_timeout = timeout * WALL_CLOCK_FACTOR if self.cpu_limited else timeout
+        self.command = command or calculator_command()
+        # 計算プロセスとの間で使うフレーム形式 (優先順、空ならJSON行のまま)
+        self.formats = framing.available_formats() if formats is None else list(formats)
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._backlog = []
+        # セッションは状態を持つため同じプロセスに送り、プロセスが終了したら入力済みの文字列で復元する
+        self._session_workers = {}
+        self._session_texts = {}
+        self._closed = False
+        self.workers = [None] * self.size
+        for slot in range(self.size):
+            self._spawn(slot)
+        self._monitor = threading.Thread(target=self._monitor_loop, name='calculator-monitor', daemon=True)
+        self._monitor.start()
+
+    def _spawn(self, slot):
+        worker = _Worker(self, slot, self.command)
+        with self._lock:
+            if self._closed:
+                worker.kill()
+                return
+            self.workers[slot] = worker
+        # hello の応答が返ったら受付可能とする
+        hello = {"id": 0, "command": "hello"}
+        if self.formats:
+            hello["framing"] = self.formats
+        worker.send(hello)
+
+    def _respawn(self, slot):
+        if not self._closed:
+            threading.Thread(target=self._spawn, args=(slot,), name=f'calculator-{slot}-spawn', daemon=True).start()
+
+    def submit(self, request):
+        """リクエスト (dict または式の文字列) を送り、応答を受け取る Future を返す"""
+        if not isinstance(request, dict):
+            request = {"expression": str(request)}
+        if request.get('command') == 'hello' and 'framing' in request:
+            # 計算プロセスとの間の形式はプールが決めるため転送しない
+            request = {key: value for key, value in request.items() if key != 'framing'}
+        future = Future()
+        with self._lock:
+            if self._closed:
+                future.set_result({"error": WORKER_ERROR})
+                return future
+            self._dispatch(_Pending(request, future, None))
+        return future
+
+    def request(self, request, timeout=None):
+        """リクエストを送り、応答を待って返す"""
+        return self.submit(request).result(timeout)
+
+    def _choose_worker(self, request):
+        ready = [worker for worker in self.workers if worker is not None and worker.alive and worker.ready]
+        if not ready:
+            return None
+        if request.get('command') == 'session':
+            worker = self._session_workers.get(request.get('session', 'default'))
+            if worker is not None and worker.alive:
+                return worker
+        return min(ready, key=lambda worker: len(worker.pending))
+
+    def _dispatch(self, pending):
+        # self._lock を保持した状態で呼ぶ
+        worker = self._choose_worker(pending.request)
+        if worker is None:
+            self._backlog.append(pending)
+            return
+        request = pending.request
+        if request.get('command') == 'session':
+            request = self._route_session(worker, request, pending.attempts > 1)
+        internal_id = next(self._ids)
+        pending.deadline = time.monotonic() + self.wall_timeout
+        worker.pending[internal_id] = pending
+        worker.send({**request, "id": internal_id})
+
+    def _route_session(self, worker, request, resend):
+        key = request.get('session', 'default')
+        text = self._session_texts.get(key, '')
+        action = request.get('action')
+        if resend:
+            # 再送時は入力済みの文字列をまとめて設定し直す (二重に追加しないため)
+            request = {"command": "session", "session": key, "action": "set", "text": text}
+        elif self._session_workers.get(key) is not worker and action not in ('set', 'clear'):
+            if text:
+                worker.send({"id": 0, "command": "session", "session": key, "action": "set", "text": text})
+        self._session_workers[key] = worker
+        if not resend:
+            self._session_texts[key] = _apply_session_action(text, request)
+        return request
+
+    def _on_response(self, worker, response):
+        internal_id = response.get('id')
+        with self._lock:
+            if internal_id == 0:
+                # 最初の id 0 は hello の応答 (以降はセッション復元の応答なので読み捨てる)
+                if not worker.ready and worker.alive:
+                    worker.ready = True
+                    backlog, self._backlog = self._backlog, []
+                    for pending in backlog:
+                        self._dispatch(pending)
+                return
+            pending = worker.pending.pop(internal_id, None)
+        if pending is not None:
+            pending.future.set_result(_restore_id(response, pending.request))
+
+    def _on_worker_exit(self, worker):
+        with self._lock:
+            if self.workers[worker.slot] is not worker:
+                return
+            self.workers[worker.slot] = None
+            now = None
+            if _SIGXCPU is not None and worker.process.returncode == -_SIGXCPU and worker.pending:
+                # 上限のある計算プロセスは1件ずつ順に処理するため、上限を超えたのは最も古いリクエスト。
+                # それだけを制限時間超過とし、残りは別のプロセスに送り直す
+                now = min(pending.deadline for pending in worker.pending.values())
+            self._fail_worker(worker, WORKER_ERROR, now)
+        self._respawn(worker.slot)
+
+    def _fail_worker(self, worker, error, now=None):
+        # self._lock を保持した状態で呼ぶ
+        worker.alive = False
+        for key in [key for key, owner in self._session_workers.items() if owner is worker]:
+            del self._session_workers[key]
+        pending_items, worker.pending = list(worker.pending.values()), {}
+        for pending in pending_items:
+            if now is not None and pending.deadline <= now:
+                pending.future.set_result(_restore_id({"error": TIMEOUT_ERROR}, pending.request))
+            elif pending.attempts >= MAX_ATTEMPTS:
+                pending.future.set_result(_restore_id({"error": error}, pending.request))
+            else:
+                # 巻き込まれただけのリクエストは別のプロセスに送り直す
+                pending.attempts += 1
+                self._dispatch(pending)
+
+    def _monitor_loop(self):
+        while not self._closed:
+            time.sleep(MONITOR_INTERVAL)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                for worker in self.workers:
+                    if worker is None or not worker.alive:
+                        continue
+                    if any(pending.deadline <= now for pending in worker.pending.values()):
+                        self.workers[worker.slot] = None
+                        self._fail_worker(worker, TIMEOUT_ERROR, now)
+                        expired.append(worker)
+            for worker in expired:
+                worker.kill()
+                self._respawn(worker.slot)
+
+    def close(self):
+        """すべての計算プロセスを終了する"""
+        with self._lock:
+            self._closed = True
+            workers = [worker for worker in self.workers if worker is not None]
+            self.workers = [None] * self.size
+            for pending in self._backlog:
+                pending.future.set_result(_restore_id({"error": WORKER_ERROR}, pending.request))
+            self._backlog = []
+            for worker in workers:
+                for pending in worker.pending.values():
+                    pending.future.set_result(_restore_id({"error": WORKER_ERROR}, pending.request))
+                worker.pending = {}
+        for worker in workers:
+            worker.kill()
+            worker.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _apply_session_action(text, request):
+    """セッションの差分を手元の文字列にも反映する (プロセス終了時の復元用)"""
+    action = request.get('action')
+    if action == 'append':
+        return text + str(request.get('text', ''))
+    if action == 'backspace':
+        count = int(request.get('count', 1))
+        return text[:-count] if count > 0 else text
+    if action == 'clear':
+        return ''
+    if action == 'set':
+        return str(request.get('text', ''))
+    return text
+
+def _restore_id(response, request):
+    """内部のidを呼び出し元のidに戻す (idのないリクエストには id / v を付けない)"""
+    response = dict(response)
+    response.pop('id', None)
+    if 'id' in request:
+        response['id'] = request['id']
+        response.setdefault('v', PROTOCOL_VERSION)
+    else:
+        response.pop('v', None)
+    return response
+
+def main():
+    """標準入出力を calculator.py と同じ形式で受け付け、プールに振り分ける
+
+    idつきのリクエストには終わった順に、idなしのリクエストには受け取った順に応答する。
+    """
+    parser = argparse.ArgumentParser(description="計算プロセスのプール")
+    parser.add_argument('-n', '--workers', type=int,
+                        default=int(os.environ.get('CALCULATOR_WORKERS', DEFAULT_POOL_SIZE)),
+                        help="起動しておく計算プロセスの数")
+    parser.add_argument('-t', '--timeout', type=float,
+                        default=float(os.environ.get('CALCULATOR_TIMEOUT', REQUEST_TIMEOUT)),
+                        help="1リクエストあたりの制限時間 (秒)")
+    args = parser.parse_args()
+
+    # 呼び出し元とも hello で長さ付きフレームに切り替えられる
+    channel = framing.Channel(sys.stdin.buffer, sys.stdout.buffer)
+    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer)
+
+    # 応答待ちのidなしのリクエスト (受け取った順)
+    untagged = collections.deque()
+    untagged_lock = threading.Lock()
+
+    def write_response(future):
+        channel.write(future.result())
+
+    def write_untagged_responses(_future):
+        # 先頭から終わっているものだけを書き、後のものは前の応答を待たせる
+        with untagged_lock:
+            while untagged and untagged[0].done():
+                channel.write(untagged.popleft().result())
+
+    with WorkerPool(args.workers, args.timeout) as pool:
+        outstanding = set()
+        while True:
+            try:
+                message = channel.read()
+            except framing.FramingError as e:
+                channel.write({"error": str(e)})
+                break
+            except ValueError as e:
+                channel.write({"error": str(e)})
+                continue
+            if message is None:
+                break
+            if channel.framed:
+                data = message if isinstance(message, dict) else {"expression": str(message)}
+            else:
+                line = message
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    data = None
+                if not isinstance(data, dict) or ('id' not in data and 'command' not in data and 'expression' not in data):
+                    # JSON以外や対象外のリクエストは式として計算する
+                    data = {"expression": line}
+            if data.get('command') == 'hello' and 'framing' in data:
+                # 応答を書いてから切り替えるため、ここで待つ
+                channel.reply_hello(pool.request(data), framing.negotiate(data['framing']))
+                continue
+            future = pool.submit(data)
+            outstanding.add(future)
+            if 'id' in data:
+                future.add_done_callback(write_response)
+            else:
+                with untagged_lock:
+                    untagged.append(future)
+                future.add_done_callback(write_untagged_responses)
+            future.add_done_callback(outstanding.discard)
+        # 標準入力が閉じられたら残りの応答を待って終了
+        for future in list(outstanding):
+            future.result()
+        write_untagged_responses(None)
+
+if __name__ == "__main__":
+    main()
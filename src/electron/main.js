@@ -2,20 +2,211 @@ const { app, BrowserWindow, ipcMain, protocol } = require('electron');
 const path = require('path');
 const { spawn } = require('child_process');
 const fs = require('fs');
+const net = require('net');
+const { EventEmitter } = require('events');
+const { PassThrough } = require('stream');
 
 let pythonProcess = null;
 let voiceRecognitionProcess = null;
+// 計算プロセスへの応答待ちリクエスト（idごと）
+const pendingCalculations = new Map();
+let nextCalculationId = 1;
+let lastDeliveredCalculationId = 0;
+let calculatorStdoutBuffer = '';
 let screenshotProcess = null;
+// スクリーンショットのデーモンへの応答待ちリクエスト（idごと）
+const pendingScreenshots = new Map();
+let nextScreenshotId = 1;
+let screenshotStdoutBuffer = '';
+// ヘルパーを読み込み済みのPythonから起動するランチャー (開発時のみ)
+let launcherProcess = null;
+let launcherAddress = null;
 let win = null;
 
+// ランチャーを起動し、待ち受けのアドレスを受け取る
+function startLauncher() {
+  if (process.env.NODE_ENV !== 'development' || launcherProcess) {
+    return;
+  }
+  const launcherScript = path.join(__dirname, '../backend/python/launcher.py');
+  launcherProcess = spawn('python', [launcherScript]);
+  let buffer = '';
+  const onData = (data) => {
+    buffer += data.toString();
+    const newline = buffer.indexOf('\n');
+    if (newline < 0) {
+      return;
+    }
+    launcherProcess.stdout.off('data', onData);
+    try {
+      const message = JSON.parse(buffer.slice(0, newline));
+      if (message.status === 'listening') {
+        // Unixドメインソケットのパス、または host:port
+        const match = /^([^/]*):(\d+)$/.exec(message.address);
+        launcherAddress = match ? { host: match[1], port: Number(match[2]) } : { path: message.address };
+        console.log(`ランチャーの準備完了 (${message.strategy}, 読み込み ${message.preload_ms}ms)`);
+      }
+    } catch (error) {
+      console.error('ランチャーの出力のパースエラー:', error);
+    }
+  };
+  launcherProcess.stdout.on('data', onData);
+  launcherProcess.stderr.on('data', (data) => {
+    console.error(`Launcher stderr: ${data}`);
+  });
+  launcherProcess.on('error', (error) => {
+    console.error('ランチャーの起動エラー:', error);
+  });
+  launcherProcess.on('close', () => {
+    launcherProcess = null;
+    launcherAddress = null;
+  });
+}
+
+// Pythonのヘルパーを起動する (ランチャーが使えればそこから、使えなければ通常どおり spawn)
+// 返す値は stdin / stdout / stderr / kill() / 'close' イベントを持ち、ChildProcess と同じように扱える
+function spawnHelper(helper, script, args = [], options = {}) {
+  if (!launcherAddress) {
+    return spawn('python', [script, ...args], options);
+  }
+  const helperProcess = new EventEmitter();
+  helperProcess.stdin = new PassThrough();
+  helperProcess.stdout = new PassThrough();
+  helperProcess.stderr = new PassThrough();
+  helperProcess.pid = null;
+  helperProcess.killed = false;
+  let fallback = null;
+  let started = false;
+
+  const useFallback = (reason) => {
+    console.warn(`ランチャーを使わずに ${helper} を起動します: ${reason}`);
+    fallback = spawn('python', [script, ...args], options);
+    helperProcess.pid = fallback.pid;
+    fallback.stdout.pipe(helperProcess.stdout);
+    fallback.stderr.pipe(helperProcess.stderr);
+    helperProcess.stdin.pipe(fallback.stdin);
+    fallback.on('error', (error) => helperProcess.emit('error', error));
+    fallback.on('close', (code) => helperProcess.emit('close', code));
+  };
+
+  const socket = net.createConnection(launcherAddress, () => {
+    socket.write(JSON.stringify({ command: 'spawn', helper, args }) + '\n');
+  });
+
+  helperProcess.kill = () => {
+    helperProcess.killed = true;
+    if (fallback) {
+      return fallback.kill();
+    }
+    if (helperProcess.pid) {
+      try {
+        process.kill(helperProcess.pid);
+      } catch (error) {
+        // 終了済み
+      }
+    }
+    socket.destroy();
+    return true;
+  };
+
+  // 最初の1行は起動の通知、以降はヘルパーの標準出力
+  let header = Buffer.alloc(0);
+  const onHeader = (chunk) => {
+    header = Buffer.concat([header, chunk]);
+    const newline = header.indexOf(10);
+    if (newline < 0) {
+      return;
+    }
+    socket.pause();
+    socket.off('data', onHeader);
+    let message = null;
+    try {
+      message = JSON.parse(header.slice(0, newline).toString());
+    } catch (error) {
+      // 下で通常の起動に切り替える
+    }
+    if (!message || message.status !== 'started') {
+      socket.destroy();
+      useFallback(message ? message.message : '応答を解釈できません');
+      return;
+    }
+    started = true;
+    helperProcess.pid = message.pid;
+    const rest = header.slice(newline + 1);
+    if (rest.length) {
+      helperProcess.stdout.write(rest);
+    }
+    socket.pipe(helperProcess.stdout);
+    helperProcess.stdin.pipe(socket);
+    if (helperProcess.killed) {
+      helperProcess.kill();
+    }
+  };
+  socket.on('data', onHeader);
+  socket.on('error', (error) => {
+    if (!started && !fallback) {
+      useFallback(error.message);
+    }
+  });
+  socket.on('close', () => {
+    if (started) {
+      helperProcess.emit('close', null);
+    }
+  });
+  return helperProcess;
+}
+
 function handlePythonProcessError(error) {
   console.error('Pythonプロセスエラー:', error);
+  rejectPendingCalculations(error);
   if (pythonProcess) {
     pythonProcess.kill();
     pythonProcess = null;
   }
 }
 
+// 応答待ちのリクエストをすべて失敗させる
+function rejectPendingCalculations(error) {
+  for (const pending of pendingCalculations.values()) {
+    clearTimeout(pending.timeout);
+    pending.reject(error);
+  }
+  pendingCalculations.clear();
+}
+
+// 計算プロセスの出力を行単位で読み、idが一致するリクエストに応答を渡す
+function handleCalculatorOutput(data) {
+  calculatorStdoutBuffer += data.toString();
+  const lines = calculatorStdoutBuffer.split('\n');
+  calculatorStdoutBuffer = lines.pop();
+  for (const line of lines) {
+    if (!line.trim()) {
+      continue;
+    }
+    let result;
+    try {
+      result = JSON.parse(line);
+    } catch (e) {
+      // JSON以外の出力は無視
+      continue;
+    }
+    const pending = pendingCalculations.get(result.id);
+    if (!pending) {
+      // タイムアウト済みなどで待っているリクエストがない応答は破棄
+      continue;
+    }
+    pendingCalculations.delete(result.id);
+    clearTimeout(pending.timeout);
+    // 後から送った式の結果がすでに返っている場合は古い応答として印を付ける
+    if (result.id < lastDeliveredCalculationId) {
+      result.stale = true;
+    } else {
+      lastDeliveredCalculationId = result.id;
+    }
+    pending.resolve(result);
+  }
+}
+
 function createWindow() {
   win = new BrowserWindow({
     width: 805,
@@ -103,8 +294,9 @@ function createWindow() {
   }
 
   // Pythonプロセスの起動と監視
+  // 開発時は計算プロセスのプール (worker_pool.py) を起動し、重い式で入力が止まらないようにする
   const pythonScript = path.join(process.env.NODE_ENV === 'development' 
-    ? path.join(__dirname, '../backend/python/calculator.py')
+    ? path.join(__dirname, '../backend/python/worker_pool.py')
     : path.join(process.resourcesPath, 'calculator'));
   
   console.log('Pythonスクリプトのパス:', pythonScript);
@@ -125,13 +317,24 @@ function createWindow() {
       console.log(`Python stdout: ${data.toString()}`);
     });
 
+    calculatorStdoutBuffer = '';
+    pythonProcess.stdout.on('data', handleCalculatorOutput);
+
     pythonProcess.on('close', (code) => {
       console.log(`Pythonプロセスが終了しました。終了コード: ${code}`);
+      rejectPendingCalculations(new Error('Pythonプロセスが終了しました'));
       pythonProcess = null;
     });
   } catch (error) {
     console.error('Pythonプロセスの起動に失敗:', error);
   }
+
+  // 最初のキャプチャを待たせないように、スクリーンショットのデーモンを先に起動しておく
+  try {
+    startScreenshotDaemon();
+  } catch (error) {
+    console.error('スクリーンショットプロセスの起動に失敗:', error);
+  }
 }
 
 // アプリケーションの準備が整ったら
@@ -142,6 +345,8 @@ app.whenReady().then(() => {
     callback(pathname);
   });
 
+  // 音声認識などのヘルパーを素早く起動できるように、ランチャーを先に起動しておく
+  startLauncher();
   createWindow();
 });
 
@@ -155,6 +360,9 @@ app.on('window-all-closed', () => {
   if (screenshotProcess) {
     screenshotProcess.kill();
   }
+  if (launcherProcess) {
+    launcherProcess.kill();
+  }
   if (process.platform !== 'darwin') {
     app.quit();
   }
@@ -174,56 +382,32 @@ ipcMain.handle('calculate', async (event, expression) => {
       return;
     }
 
-    let responseData = '';
-    const responseHandler = (data) => {
-      responseData += data.toString();
-      try {
-        // 改行で分割して最後の有効なJSONを探す
-        const lines = responseData.split('\n');
-        for (const line of lines) {
-          if (line.trim()) {
-            try {
-              const result = JSON.parse(line);
-              pythonProcess.stdout.removeListener('data', responseHandler);
-              pythonProcess.removeListener('error', errorHandler);
-              clearTimeout(timeout);
-              resolve(result);
-              return;
-            } catch (e) {
-              // このラインは有効なJSONではない、次のラインを試す
-              continue;
-            }
-          }
-        }
-      } catch (error) {
-        // JSONのパースに敗した場合は、データが完全に受信されていない可能性があるため継続
-      }
-    };
-
-    pythonProcess.stdout.on('data', responseHandler);
-
-    // エラーハンドリング
-    const errorHandler = (error) => {
-      pythonProcess.stdout.removeListener('data', responseHandler);
-      clearTimeout(timeout);
-      reject(error);
-    };
-    pythonProcess.once('error', errorHandler);
+    // JSONのコマンドはそのまま、式は expression としてidを付けて送信
+    const id = nextCalculationId++;
+    let request;
+    try {
+      const parsed = JSON.parse(expression);
+      request = parsed && typeof parsed === 'object' && !Array.isArray(parsed)
+        ? { ...parsed, id }
+        : { id, expression };
+    } catch (e) {
+      request = { id, expression };
+    }
 
     // タイムアウト設定（30秒に延長）
     const timeout = setTimeout(() => {
-      pythonProcess.stdout.removeListener('data', responseHandler);
-      pythonProcess.removeListener('error', errorHandler);
+      pendingCalculations.delete(id);
       reject(new Error('計算がタイムアウトしました'));
     }, 30000);
 
+    pendingCalculations.set(id, { resolve, reject, timeout });
+
     try {
-      // 式を直接送信（改行を含めて一度に送信）
-      pythonProcess.stdin.write(expression + '\n');
+      // 応答はidで対応付けるため、前の応答を待たずに送信できる
+      pythonProcess.stdin.write(JSON.stringify(request) + '\n');
     } catch (error) {
       clearTimeout(timeout);
-      pythonProcess.stdout.removeListener('data', responseHandler);
-      pythonProcess.removeListener('error', errorHandler);
+      pendingCalculations.delete(id);
       reject(error);
     }
   });
@@ -274,7 +458,7 @@ ipcMain.handle('start-voice-recognition', async () => {
     const voiceScript = path.join(__dirname, '../backend/python/voice_recognition.py');
     
     try {
-      voiceRecognitionProcess = spawn('python', [voiceScript], {
+      voiceRecognitionProcess = spawnHelper('voice', voiceScript, [], {
         env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
       });
 
@@ -327,44 +511,94 @@ ipcMain.handle('stop-voice-recognition', async () => {
   });
 }); 
 
-// IPCハンドラーを追加
-ipcMain.handle('take-screenshot', async () => {
-  return new Promise((resolve, reject) => {
-    const screenshotScript = path.join(process.env.NODE_ENV === 'development' 
-      ? path.join(__dirname, '../backend/python/screenshot.py')
-      : path.join(process.resourcesPath, 'screenshot'));
-    
-    try {
-      screenshotProcess = spawn('python', [screenshotScript]);
-      
-      let responseData = '';
-      
-      screenshotProcess.stdout.on('data', (data) => {
-        responseData += data.toString();
-        try {
-          const result = JSON.parse(responseData);
-          resolve(result);
-        } catch (e) {
-          // JSONのパースに失敗した場合、データが完全ではない可能性があるので続行
-        }
-      });
+// スクリーンショットのデーモンを起動 (起動済みなら再利用)
+function startScreenshotDaemon() {
+  if (screenshotProcess && !screenshotProcess.killed) {
+    return screenshotProcess;
+  }
+  const screenshotScript = path.join(process.env.NODE_ENV === 'development' 
+    ? path.join(__dirname, '../backend/python/screenshot.py')
+    : path.join(process.resourcesPath, 'screenshot'));
+
+  screenshotProcess = spawnHelper('screenshot', screenshotScript, ['--daemon']);
+  screenshotStdoutBuffer = '';
+
+  screenshotProcess.stdout.on('data', (data) => {
+    screenshotStdoutBuffer += data.toString();
+    const lines = screenshotStdoutBuffer.split('\n');
+    screenshotStdoutBuffer = lines.pop();
+    for (const line of lines) {
+      let result;
+      try {
+        result = JSON.parse(line);
+      } catch (e) {
+        continue;
+      }
+      const pending = pendingScreenshots.get(result.id);
+      if (pending) {
+        pendingScreenshots.delete(result.id);
+        pending.resolve(result);
+      }
+    }
+  });
 
-      screenshotProcess.stderr.on('data', (data) => {
-        console.error(`Screenshot stderr: ${data}`);
-      });
+  screenshotProcess.stderr.on('data', (data) => {
+    console.error(`Screenshot stderr: ${data}`);
+  });
 
-      screenshotProcess.on('error', (error) => {
-        reject(error);
-      });
+  screenshotProcess.on('error', (error) => {
+    console.error('スクリーンショットプロセスの起動エラー:', error);
+  });
 
-      screenshotProcess.on('close', (code) => {
-        if (code !== 0) {
-          reject(new Error(`Screenshot process exited with code ${code}`));
-        }
-        screenshotProcess = null;
-      });
+  screenshotProcess.on('close', (code) => {
+    console.log(`スクリーンショットプロセスが終了しました。終了コード: ${code}`);
+    for (const pending of pendingScreenshots.values()) {
+      pending.reject(new Error(`Screenshot process exited with code ${code}`));
+    }
+    pendingScreenshots.clear();
+    screenshotProcess = null;
+  });
+  return screenshotProcess;
+}
+
+// デーモンにコマンドを送り、同じidの応答を待つ
+function sendScreenshotCommand(command) {
+  return new Promise((resolve, reject) => {
+    const daemon = startScreenshotDaemon();
+    const id = nextScreenshotId++;
+    pendingScreenshots.set(id, { resolve, reject });
+    try {
+      daemon.stdin.write(JSON.stringify({ ...command, id }) + '\n');
     } catch (error) {
+      pendingScreenshots.delete(id);
       reject(error);
     }
   });
+}
+
+// IPCハンドラーを追加
+ipcMain.handle('take-screenshot', async (event, options = {}) => {
+  // 範囲を選択してキャプチャし、デーモンのバックグラウンドスレッドで縮小・エンコードする
+  // (既定は長辺2048pxのPNG。format / max_dimension / color / compress_level / quality で変更できる)
+  // 生の画像は使わないため共有メモリには置かず (shared: false)、エンコード結果をBase64で応答に含める (inline)
+  const encoded = await sendScreenshotCommand({
+    command: 'capture',
+    shared: false,
+    encode: { format: 'png', ...options, inline: true }
+  });
+  if (encoded.status !== 'success') {
+    return encoded;
+  }
+
+  const image = encoded.data;
+  return {
+    status: 'success',
+    image,
+    type: encoded.type,
+    url: `data:${encoded.type};base64,${image}`,
+    width: encoded.width,
+    height: encoded.height,
+    bytes: encoded.bytes,
+    encodeMs: encoded.encode_ms
+  };
 }); 
\ No newline at end of file
@@ -10,11 +10,26 @@ contextBridge.exposeInMainWorld('electronAPI', {
       throw error;
     }
   },
+  // キー入力の差分 (append / backspace / clear / set) を送って逐次計算する (count は backspace で削除する文字数)
+  calculateDelta: async (action, text = '', count = 1) => {
+    try {
+      const result = await ipcRenderer.invoke('calculate', JSON.stringify({
+        command: 'session',
+        action,
+        text,
+        count
+      }));
+      return result;
+    } catch (error) {
+      console.error('計算エラー:', error);
+      throw error;
+    }
+  },
   resizeWindow: (width, height) => ipcRenderer.invoke('resize-window', width, height),
   togglePanelSize: (isOpen) => ipcRenderer.invoke('toggle-panel-size', isOpen),
   startVoiceRecognition: () => ipcRenderer.invoke('start-voice-recognition'),
   stopVoiceRecognition: () => ipcRenderer.invoke('stop-voice-recognition'),
-  takeScreenshot: () => ipcRenderer.invoke('take-screenshot'),
+  takeScreenshot: (options) => ipcRenderer.invoke('take-screenshot', options),
   toggleAlwaysOnTop: (shouldPin) => ipcRenderer.send('toggle-always-on-top', shouldPin),
   onVoiceRecognitionResult: (callback) => {
     ipcRenderer.on('voice-recognition-result', (_, result) => callback(result));
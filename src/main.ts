@@ -1,5 +1,5 @@
 import { app, BrowserWindow, ipcMain } from 'electron';
-import { spawn } from 'child_process';
+import { spawn, ChildProcess } from 'child_process';
 import { join } from 'path';
 
 ipcMain.handle('take-screenshot', async () => {
@@ -33,37 +33,94 @@ ipcMain.handle('take-screenshot', async () => {
   });
 });
 
-// AutoCAD延長機能の実装
-ipcMain.handle('execute-extension', async () => {
-  return new Promise((resolve, reject) => {
-    const scriptPath = join(__dirname, 'backend', 'python', 'autocad_extension.py');
-    const pythonProcess = spawn('python', [scriptPath]);
-    
-    let stdoutData = '';
-    let stderrData = '';
-
-    pythonProcess.stdout.on('data', (data) => {
-      stdoutData += data.toString();
-    });
+// AutoCADの計測サービス (起動したままにして接続と読み込み済みのLISPを再利用する)
+let cadProcess: ChildProcess | null = null;
+let cadStdoutBuffer = '';
+let nextCadId = 1;
+const pendingCad = new Map<number, { resolve: (result: any) => void; reject: (error: Error) => void }>();
 
-    pythonProcess.stderr.on('data', (data) => {
-      stderrData += data.toString();
-    });
+function startCadService(): ChildProcess {
+  if (cadProcess && !cadProcess.killed) {
+    return cadProcess;
+  }
+  const scriptPath = join(__dirname, 'backend', 'python', 'cad_measurement.py');
+  const service = spawn('python', [scriptPath]);
+  cadProcess = service;
+  cadStdoutBuffer = '';
 
-    pythonProcess.on('close', (code) => {
-      if (code === 0 && stdoutData) {
-        try {
-          const result = JSON.parse(stdoutData);
-          resolve({
-            status: 'success',
-            distance: result.distance
-          });
-        } catch (error) {
-          reject(new Error('Failed to parse AutoCAD data'));
+  service.stdout?.on('data', (data) => {
+    cadStdoutBuffer += data.toString();
+    const lines = cadStdoutBuffer.split('\n');
+    cadStdoutBuffer = lines.pop() ?? '';
+    for (const line of lines) {
+      let result;
+      try {
+        result = JSON.parse(line);
+      } catch (error) {
+        continue;
+      }
+      if (result.id === undefined) {
+        // 起動時の ready などの通知 (接続に失敗した場合は計測時に再試行される)
+        if (result.message) {
+          console.log(`AutoCAD service: ${result.message}`);
         }
-      } else {
-        reject(new Error(stderrData || 'AutoCAD process failed'));
+        continue;
       }
-    });
+      const pending = pendingCad.get(result.id);
+      if (pending) {
+        pendingCad.delete(result.id);
+        pending.resolve(result);
+      }
+    }
+  });
+
+  service.stderr?.on('data', (data) => {
+    console.error(`AutoCAD service stderr: ${data}`);
   });
-}); 
\ No newline at end of file
+
+  service.on('close', (code) => {
+    for (const pending of pendingCad.values()) {
+      pending.reject(new Error(`AutoCAD process exited with code ${code}`));
+    }
+    pendingCad.clear();
+    if (cadProcess === service) {
+      cadProcess = null;
+    }
+  });
+  return service;
+}
+
+function sendCadCommand(command: Record<string, unknown>): Promise<any> {
+  return new Promise((resolve, reject) => {
+    const service = startCadService();
+    const id = nextCadId++;
+    pendingCad.set(id, { resolve, reject });
+    try {
+      service.stdin?.write(JSON.stringify({ ...command, id }) + '\n');
+    } catch (error) {
+      pendingCad.delete(id);
+      reject(error as Error);
+    }
+  });
+}
+
+// AutoCAD延長機能の実装
+// mode: 'distance' (2点間、既定) / 'points' / 'polyline' / 'selection' (区間・累計・面積をまとめて返す)
+ipcMain.handle('execute-extension', async (event, options: { mode?: string; count?: number } = {}) => {
+  const result = await sendCadCommand({ ...options, command: 'measure' });
+  if (result.status === 'success') {
+    // mode 指定の計測と、count 回の計測をまとめた応答 (results) はそのまま返す
+    if (result.mode || result.results) {
+      const { id, index, ...measurement } = result;
+      return measurement;
+    }
+    return {
+      status: 'success',
+      distance: result.distance
+    };
+  }
+  if (result.status === 'cancelled') {
+    return result;
+  }
+  throw new Error(result.message || 'AutoCAD process failed');
+});
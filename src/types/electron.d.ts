@@ -1,7 +1,21 @@
+interface ScreenshotOptions {
+  format?: 'png' | 'jpeg' | 'webp';
+  max_dimension?: number | null;
+  color?: 'rgb' | 'grayscale' | 'palette';
+  compress_level?: number;
+  quality?: number;
+}
+
 interface ElectronAPI {
-  takeScreenshot: () => Promise<{
-    status: 'success' | 'error';
+  takeScreenshot: (options?: ScreenshotOptions) => Promise<{
+    status: 'success' | 'error' | 'cancelled';
     image?: string;
+    type?: string;
+    url?: string;
+    width?: number;
+    height?: number;
+    bytes?: number;
+    encodeMs?: number;
     message?: string;
   }>;
 }
@@ -1,6 +1,7 @@
 interface Window {
   electronAPI: {
     calculate: (data: any) => Promise<any>;
+    calculateDelta: (action: 'append' | 'backspace' | 'clear' | 'set', text?: string, count?: number) => Promise<any>;
     resizeWindow: (width: number, height: number) => Promise<void>;
     togglePanelSize: (isOpen: boolean) => Promise<void>;
     startVoiceRecognition: () => Promise<void>;
@@ -25,6 +26,7 @@ declare global {
   interface Window {
     electronAPI: {
       calculate: (data: any) => Promise<any>;
+      calculateDelta: (action: 'append' | 'backspace' | 'clear' | 'set', text?: string, count?: number) => Promise<any>;
       resizeWindow: (width: number, height: number) => Promise<void>;
       togglePanelSize: (isOpen: boolean) => Promise<void>;
       startVoiceRecognition: () => Promise<void>;